@@ -0,0 +1,170 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import RVE_pipeline
+
+# Runs the pipeline over a whole set of recordings without the GUI, for headless machines. Each recording gets its
+# parameters from a file written like Fourier_Filtering/instructions.txt (see RVE_pipeline.read_parameter_file) and its
+# results saved as <name>.rve.npz in the output folder (in the same sub folders as the recordings, if they come from
+# more than one folder). Recordings are spread over a process pool, one per worker.
+# With --store the results go into a <name>.rvestore results store instead (see RVE_store), written while they are
+# worked out and readable a range at a time, which suits recordings hours long.
+#
+#   python RVE_batch.py recordings/ --parameters parameters.txt --output results/
+#   python RVE_batch.py "recordings/*.mat" other.mat --parameters parameters.txt --workers 8 --cache
+#   python RVE_batch.py long_recordings/ --parameters parameters.txt --store
+def main(arguments = None):
+
+    parser = argparse.ArgumentParser(description="Works out the RVE entropy of a batch of recordings.")
+    parser.add_argument("recordings", nargs="+", help="recording files, folders (every .mat in them) or glob patterns")
+    parser.add_argument("--parameters", required=True, help="parameter file in the instructions.txt format")
+    parser.add_argument("--output", default="rve_results", help="folder for the .npz results")
+    parser.add_argument("--workers", type=int, default=None, help="processes to use, defaults to the number of cores")
+    parser.add_argument("--cache", action="store_true", help="use (and fill) the on disk result cache (not with --store)")
+    parser.add_argument("--overwrite", action="store_true", help="work out recordings that already have a result")
+    parser.add_argument("--store", action="store_true", help="save each result as a chunked .rvestore folder rather than a .npz")
+    options = parser.parse_args(arguments)
+
+    parameter_sections = RVE_pipeline.read_parameter_file(options.parameters)
+    recording_paths = find_recordings(options.recordings)
+    if not recording_paths:
+        print("No recordings found.")
+        return 1
+
+    # Every output path is worked out before anything runs, so two recordings can never write over each other.
+    try:
+        output_paths = output_paths_for(options.output, recording_paths, options.store)
+    except ValueError as error:
+        print(f"Can't run the batch: {error}")
+        return 2
+
+    # A recording the parameter file has nothing for fails on its own, the rest of the batch still runs.
+    jobs = []
+    failures = 0
+    for recording_path in recording_paths:
+        output_path = output_paths[recording_path]
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if os.path.exists(output_path) and not options.overwrite:
+            print(f"Skipping {recording_path}, {output_path} already exists")
+            continue
+        try:
+            parameters = RVE_pipeline.parameters_for_recording(parameter_sections, recording_path)
+        except ValueError as error:
+            failures += 1
+            print(f"{recording_path} failed: {error}")
+            continue
+        jobs.append((recording_path, parameters, output_path))
+
+    if not jobs:
+        return 1 if failures else 0
+
+    return max(run_batch(jobs, options.workers, options.cache, options.store), 1 if failures else 0)
+
+# Works out every (recording, parameters, output path) job on a process pool, printing each one as it finishes along
+# with the overall throughput so far. Returns 0 if they all worked, 1 if any failed.
+def run_batch(jobs, workers = None, use_cache = False, use_store = False):
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    batch_start = time.perf_counter()
+    samples_done = 0
+    failures = 0
+
+    # spawn rather than fork, numba's threading layer doesn't survive being forked.
+    with ProcessPoolExecutor(max_workers=max(min(workers, len(jobs)), 1), mp_context=multiprocessing.get_context("spawn")) as pool:
+        running_jobs = {pool.submit(process_recording, recording_path, parameters, output_path, use_cache, use_store): recording_path
+                        for recording_path, parameters, output_path in jobs}
+
+        for jobs_done, finished_job in enumerate(as_completed(running_jobs), start=1):
+            recording_path = running_jobs[finished_job]
+            try:
+                sample_count, recording_seconds = finished_job.result()
+            except Exception as error:
+                failures += 1
+                print(f"[{jobs_done}/{len(jobs)}] {recording_path} failed: {error}")
+                continue
+
+            samples_done += sample_count
+            batch_seconds = time.perf_counter() - batch_start
+            print(f"[{jobs_done}/{len(jobs)}] {recording_path}: {sample_count} samples in {recording_seconds:.2f} s | "
+                  f"overall {samples_done / batch_seconds / 1e6:.2f} M samples/s")
+
+    batch_seconds = time.perf_counter() - batch_start
+    print(f"{len(jobs) - failures} of {len(jobs)} recordings done in {batch_seconds:.1f} s "
+          f"({samples_done / max(batch_seconds, 1e-9) / 1e6:.2f} M samples/s)")
+
+    return 1 if failures else 0
+
+# What each pool worker runs for one recording. Returns the number of samples (over every channel) and how long it took.
+def process_recording(recording_path, parameters, output_path, use_cache = False, use_store = False):
+
+    recording_start = time.perf_counter()
+
+    # The store is written a chunk at a time, the result cache only holds whole results so isn't used for it.
+    if use_store:
+        with RVE_pipeline.run_pipeline_to_store(recording_path, parameters, output_path) as results_store:
+            sample_count = results_store.channel_count * results_store.sample_count
+        return sample_count, time.perf_counter() - recording_start
+
+    result_cache = None
+    if use_cache:
+        import RVE_cache
+        result_cache = RVE_cache.RVEResultCache()
+
+    pipeline_results = RVE_pipeline.run_pipeline(recording_path, parameters, result_cache)
+    RVE_pipeline.save_results(output_path, pipeline_results, parameters)
+
+    return int(np.size(pipeline_results["signal"])), time.perf_counter() - recording_start
+
+# Expands the command line into a sorted list of recording files with no repeats (the same file reached two ways,
+# like one.mat and ./one.mat, only counts once).
+def find_recordings(recording_arguments):
+
+    recording_paths = []
+    for recording_argument in recording_arguments:
+        if os.path.isdir(recording_argument):
+            recording_paths.extend(glob.glob(os.path.join(recording_argument, "*.mat")))
+        else:
+            recording_paths.extend(path for path in glob.glob(recording_argument) if os.path.isfile(path))
+
+    recording_paths_by_file = {}
+    for recording_path in sorted(recording_paths):
+        recording_paths_by_file.setdefault(os.path.normcase(os.path.abspath(recording_path)), recording_path)
+
+    return sorted(recording_paths_by_file.values())
+
+# {recording path: where its result goes}. Each result is named after the recording's path below the folder every
+# recording shares, so r1/one.mat and r2/one.mat become r1/one.rve.npz and r2/one.rve.npz in the output folder and
+# recordings from a single folder just keep their names. Raises a ValueError if two recordings would still end up with
+# the same result (one.mat and one.MAT, say).
+def output_paths_for(output_folder, recording_paths, use_store = False):
+
+    if not recording_paths:
+        return {}
+
+    common_folder = os.path.commonpath([os.path.dirname(os.path.abspath(recording_path)) for recording_path in recording_paths])
+
+    output_paths = {}
+    recordings_by_output = {}
+    for recording_path in recording_paths:
+        relative_path = os.path.relpath(os.path.abspath(recording_path), common_folder)
+        output_path = os.path.join(output_folder, os.path.splitext(relative_path)[0] + (".rvestore" if use_store else ".rve.npz"))
+
+        output_key = os.path.normcase(os.path.abspath(output_path)).lower()
+        if output_key in recordings_by_output:
+            raise ValueError(f"{recordings_by_output[output_key]} and {recording_path} would both be saved as {output_path}")
+        recordings_by_output[output_key] = recording_path
+        output_paths[recording_path] = output_path
+
+    return output_paths
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# Optional like in RVE_function, so the lfilter engine can still be timed on a machine without it.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import RVE_function
+import RVE_loader
+
+PROGRAM_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SIGNAL_PATH = os.path.join(PROGRAM_FOLDER, "Fourier_Filtering", "signal.mat")
+
+# The default sweep, lengths in samples and samples_per_window values.
+DEFAULT_LENGTHS = [10_000, 100_000, 1_000_000, 10_000_000]
+DEFAULT_WINDOWS = [3, 4, 5, 6, 7, 8]
+
+# Settings for a single epsilon step run in the sweep, the same as rve_of_singal's defaults at signal.mat's frequency.
+SWEEP_FREQUENCY = 1200
+SWEEP_EPSILON_STEP = 4
+SWEEP_τ_CONST = 1
+
+# The sweep runs in low memory mode by default, otherwise 10M samples at samples_per_window = 8 needs several GB just for
+# the argsort. --chunk-size 0 runs it all in one go instead.
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# The composite graphs from Fourier_Filtering/instructions.txt. signal_brain.mat isn't shipped, so that one runs on a
+# synthetic signal of the same frequency and length.
+COMPOSITE_SETTINGS = [
+    {"name": "signal.mat", "frequency": 1200, "duration": 40, "f_crits_min": 6, "f_crits_max": 50, "f_crits_step": 1,
+     "τ_const": 1.0, "samples_per_window": 5},
+    {"name": "signal_brain.mat (synthetic)", "frequency": 600, "duration": 617.5, "f_crits_min": 40, "f_crits_max": 110,
+     "f_crits_step": 10, "τ_const": 0.75, "samples_per_window": 5},
+]
+
+# Repeatable benchmarks for the entropy pipeline. Every run reports the best and median wall time, the throughput in
+# samples per second and the peak numpy allocation (from a separate tracemalloc run so it doesn't slow the timed ones).
+# Numba compile time is measured up front, once per kernel and code dtype, so it never ends up in the throughput.
+# Results are saved as JSON, and --compare old.json lines them up against an earlier run to spot regressions.
+#
+#   python RVE_benchmark.py                           full sweep, 10k to 10M samples, samples_per_window 3 to 8
+#   python RVE_benchmark.py --quick                   10k and 100k only, for a quick check
+#   python RVE_benchmark.py --compare before.json     also prints the change against an earlier result file
+#   python RVE_benchmark.py --cold-start              also times a new process from import to its first result
+#   python RVE_benchmark.py --dtypes float64 float32  runs everything in both precisions
+def main(arguments = None):
+
+    parser = argparse.ArgumentParser(description="Benchmarks the RVE entropy pipeline.")
+    parser.add_argument("--lengths", type=int, nargs="+", default=DEFAULT_LENGTHS, help="signal lengths to sweep, in samples")
+    parser.add_argument("--windows", type=int, nargs="+", default=DEFAULT_WINDOWS, help="samples_per_window values to sweep")
+    parser.add_argument("--engines", nargs="+", default=["incremental"], help="entropy engines to benchmark")
+    parser.add_argument("--dtypes", nargs="+", default=["float64"], help="precisions to benchmark (float64, float32)")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="chunk size for the sweep, 0 for none")
+    parser.add_argument("--parallel", default=None, help="parallel backend for the composite runs (thread, process, prange)")
+    parser.add_argument("--quick", action="store_true", help="only sweep 10k and 100k samples")
+    parser.add_argument("--skip-sweep", action="store_true", help="only run the composite benchmarks")
+    parser.add_argument("--skip-composite", action="store_true", help="only run the length sweep")
+    parser.add_argument("--cold-start", action="store_true", help="also time a fresh process to its first result")
+    parser.add_argument("--output", default=None, help="where to save the JSON results")
+    parser.add_argument("--compare", default=None, help="an earlier JSON result file to compare against")
+    options = parser.parse_args(arguments)
+
+    if options.quick:
+        options.lengths = [length for length in options.lengths if length <= 100_000]
+    chunk_size = options.chunk_size if options.chunk_size > 0 else None
+
+    report = {"machine": machine_details(), "started": datetime.datetime.now().isoformat(timespec="seconds"),
+              "options": {"lengths": options.lengths, "windows": options.windows, "engines": options.engines, "dtypes": options.dtypes,
+                          "repeats": options.repeats, "chunk_size": chunk_size, "parallel": options.parallel},
+              "jit_compile": measure_jit_compile(options.engines), "results": []}
+
+    for compile_result in report["jit_compile"]:
+        print(f"compile  {compile_result['kernel']:<32} {compile_result['compile_seconds']:8.3f} s")
+
+    if options.cold_start:
+        report["cold_start"] = measure_cold_start()
+        for cache_state, cold_start in report["cold_start"].items():
+            print(f"cold start ({cache_state:<8}) import {cold_start['import_seconds']:6.3f} s  first result {cold_start['first_result_seconds']:6.3f} s  "
+                  f"process total {cold_start['process_seconds']:6.3f} s")
+
+    if not options.skip_sweep:
+        for length in options.lengths:
+            time_signal, signal = synthetic_signal(length, SWEEP_FREQUENCY)
+            for engine in options.engines:
+                for samples_per_window in options.windows:
+                    for dtype in options.dtypes:
+                        result = benchmark_single_step(time_signal, signal, engine, samples_per_window, options.repeats, chunk_size, dtype)
+                        report["results"].append(result)
+                        print_result(result)
+
+    if not options.skip_composite:
+        for settings in COMPOSITE_SETTINGS:
+            time_signal, signal = composite_signal(settings)
+            for engine in options.engines:
+                for dtype in options.dtypes:
+                    result = benchmark_composite(time_signal, signal, settings, engine, options.repeats, options.parallel, dtype)
+                    report["results"].append(result)
+                    print_result(result)
+
+    output_path = options.output or f"rve_benchmark_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_path, "w") as output_file:
+        json.dump(report, output_file, indent=2, ensure_ascii=False)
+    print(f"Saved to {output_path}")
+
+    if options.compare is not None:
+        with open(options.compare) as compare_file:
+            print_comparison(json.load(compare_file), report)
+
+    return report
+
+# First call minus second call of every compiled kernel on a tiny signal, i.e. how long numba spent compiling (or
+# loading from its cache). Bin numbers are uint8 up to samples_per_window = 5 and uint16 above, which numba compiles
+# separately, so both get measured.
+def measure_jit_compile(engines):
+
+    time_signal, signal = synthetic_signal(2000, SWEEP_FREQUENCY)
+    compile_results = []
+
+    for engine in engines:
+        for samples_per_window in (5, 8):
+            code_dtype = RVE_function.pattern_code_dtype(samples_per_window)
+
+            def run_kernel():
+                RVE_function.rve_scale_entropy(signal, SWEEP_FREQUENCY, SWEEP_τ_CONST, 1, samples_per_window, engine)
+
+            compile_results.append({"kernel": f"{engine} ({np.dtype(code_dtype).name} codes)", **first_call_overhead(run_kernel)})
+
+    entropy_arrays = RVE_function.rve_scale_entropy(signal, SWEEP_FREQUENCY, SWEEP_τ_CONST, 1, 5)
+
+    def run_smoothing():
+        RVE_function.entropy_smooth_and_differentiate(time_signal, entropy_arrays)
+
+    compile_results.append({"kernel": "smooth_differentiate_kernel", **first_call_overhead(run_smoothing)})
+
+    return compile_results
+
+# What a new session or batch worker sees: a fresh Python process that imports the pipeline, loads signal.mat and works
+# out one rve_of_singal. Run once against an empty numba cache (everything gets compiled) and then again now that the
+# first run has filled it (the compiled kernels are just loaded).
+def measure_cold_start():
+
+    cold_start_script = (
+        "import time\n"
+        "process_start = time.perf_counter()\n"
+        "import json, sys\n"
+        f"sys.path.insert(0, {PROGRAM_FOLDER!r})\n"
+        "import numpy as np\n"
+        "import RVE_function, RVE_loader\n"
+        "imported = time.perf_counter()\n"
+        f"signal = np.asarray(RVE_loader.load_signal({SIGNAL_PATH!r}, use_sidecar=False), dtype=np.float64)\n"
+        "RVE_function.rve_of_singal(np.arange(np.size(signal)) / 1200, signal, 1200)\n"
+        "finished = time.perf_counter()\n"
+        "print(json.dumps({'import_seconds': imported - process_start, 'first_result_seconds': finished - imported}))\n"
+    )
+
+    cold_starts = {}
+    with tempfile.TemporaryDirectory() as numba_cache_folder:
+        for cache_state in ("no cache", "cached"):
+            clocker_start = time.perf_counter()
+            finished_process = subprocess.run([sys.executable, "-c", cold_start_script], capture_output=True, text=True, check=True,
+                                              env={**os.environ, "NUMBA_CACHE_DIR": numba_cache_folder})
+            cold_start = json.loads(finished_process.stdout.strip().splitlines()[-1])
+            cold_start["process_seconds"] = time.perf_counter() - clocker_start
+            cold_starts[cache_state] = cold_start
+
+    return cold_starts
+
+def first_call_overhead(run):
+
+    clocker_start = time.perf_counter()
+    run()
+    first_call = time.perf_counter() - clocker_start
+
+    clocker_start = time.perf_counter()
+    run()
+    second_call = time.perf_counter() - clocker_start
+
+    return {"first_call_seconds": first_call, "steady_call_seconds": second_call, "compile_seconds": max(first_call - second_call, 0)}
+
+# One epsilon step over a synthetic signal, the work rve_of_singal does.
+def benchmark_single_step(time_signal, signal, engine, samples_per_window, repeats, chunk_size, dtype = "float64"):
+
+    def run():
+        RVE_function.rve_scale_entropy(signal, SWEEP_FREQUENCY, SWEEP_τ_CONST, SWEEP_EPSILON_STEP, samples_per_window, engine, chunk_size, np.dtype(dtype))
+
+    result = {"kind": "single_step", "name": "synthetic", "length": int(np.size(signal)), "samples_per_window": samples_per_window,
+              "engine": engine, "dtype": dtype, "epsilon_step": SWEEP_EPSILON_STEP, "chunk_size": chunk_size}
+    result.update(time_run(run, repeats, np.size(signal)))
+
+    return result
+
+# A whole composite graph, the work rve_frequency_averager does for one of the instructions.txt settings.
+def benchmark_composite(time_signal, signal, settings, engine, repeats, parallel, dtype = "float64"):
+
+    def run():
+        RVE_function.rve_frequency_averager(time_signal, signal, settings["frequency"], settings["f_crits_min"], settings["f_crits_max"],
+                                           settings["f_crits_step"], settings["τ_const"], settings["samples_per_window"], engine, parallel,
+                                           dtype=np.dtype(dtype))
+
+    epsilon_step_crits = RVE_function.epsilon_steps_for_crits(settings["frequency"], settings["f_crits_min"], settings["f_crits_max"], settings["f_crits_step"])
+    result = {"kind": "composite", "name": settings["name"], "length": int(np.size(signal)), "samples_per_window": settings["samples_per_window"],
+              "engine": engine, "dtype": dtype, "critical_frequencies": int(np.size(epsilon_step_crits)),
+              "distinct_epsilon_steps": int(np.size(np.unique(epsilon_step_crits))), "parallel": parallel}
+    result.update(time_run(run, repeats, np.size(signal)))
+
+    return result
+
+# Peak memory from one run under tracemalloc, then the timings from repeats runs without it.
+def time_run(run, repeats, sample_count):
+
+    tracemalloc.start()
+    run()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    run_seconds = []
+    for _ in range(repeats):
+        clocker_start = time.perf_counter()
+        run()
+        run_seconds.append(time.perf_counter() - clocker_start)
+
+    best_seconds = min(run_seconds)
+
+    return {"best_seconds": best_seconds, "median_seconds": float(np.median(run_seconds)), "run_seconds": run_seconds,
+            "samples_per_second": sample_count / best_seconds, "peak_bytes": int(peak_bytes)}
+
+# Noise with a slow sine underneath and a burst of a faster one in the middle third, always the same for a given
+# length so runs can be compared.
+def synthetic_signal(length, frequency, seed = 0):
+
+    random_generator = np.random.default_rng(seed)
+    time_signal = np.arange(length) / frequency
+
+    signal = np.sin(2 * np.pi * 10 * time_signal) + random_generator.standard_normal(length)
+    burst = slice(length // 3, 2 * length // 3)
+    signal[burst] += 2 * np.sin(2 * np.pi * 40 * time_signal[burst])
+
+    return time_signal, signal
+
+def composite_signal(settings):
+
+    sample_count = int(settings["duration"] * settings["frequency"])
+    if settings["name"] == "signal.mat":
+        signal = np.asarray(RVE_loader.load_signal(SIGNAL_PATH, use_sidecar=False), dtype=np.float64)[:sample_count]
+        return np.arange(np.size(signal)) / settings["frequency"], signal
+
+    return synthetic_signal(sample_count, settings["frequency"])
+
+def machine_details():
+
+    try:
+        git_commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROGRAM_FOLDER, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+
+    return {"platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "python": sys.version.split()[0], "numpy": np.__version__, "numba": None if numba is None else numba.__version__, "git_commit": git_commit}
+
+# Reports from before there was a dtype choice were all float64.
+def result_key(result):
+
+    return (result["kind"], result["name"], result["length"], result["samples_per_window"], result["engine"], result.get("dtype", "float64"))
+
+def result_label(result):
+
+    return (f"{result['kind']:<11} {result['name'][:28]:<28} {result['engine']:<11} {result.get('dtype', 'float64'):<7} "
+            f"m={result['samples_per_window']} N={result['length']:>9}")
+
+def print_result(result):
+
+    print(f"{result_label(result)}  {result['best_seconds']:9.4f} s  {result['samples_per_second'] / 1e6:8.2f} M samples/s  "
+          f"{result['peak_bytes'] / 1024 ** 2:9.1f} MB peak")
+
+# Lines up the runs that both reports have and prints how much faster or slower each one got.
+def print_comparison(old_report, new_report, threshold = 0.1):
+
+    old_results = {result_key(result): result for result in old_report["results"]}
+    print(f"\nAgainst {old_report['machine'].get('git_commit')} ({old_report['started']}):")
+
+    for result in new_report["results"]:
+        old_result = old_results.get(result_key(result))
+        if old_result is None:
+            continue
+        speed_ratio = result["samples_per_second"] / old_result["samples_per_second"]
+        memory_ratio = result["peak_bytes"] / max(old_result["peak_bytes"], 1)
+        flag = "  SLOWER" if speed_ratio < 1 - threshold else ("  faster" if speed_ratio > 1 + threshold else "")
+        print(f"{result_label(result)}  speed x{speed_ratio:5.2f}  memory x{memory_ratio:5.2f}{flag}")
+
+if __name__ == "__main__":
+    main()
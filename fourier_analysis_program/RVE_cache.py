@@ -0,0 +1,219 @@
+import hashlib
+import os
+import numpy as np
+
+import RVE_function
+
+# Default place for the cache, shared between GUI sessions and scripts.
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".rve_cache")
+
+# Default size limit for everything in the cache folder, 1 GB.
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+# Keeps the entropy and time arrays of every single epsilon step that has been worked out as .npy files, named after a
+# hash of the signal, the time array and all of the parameters. Same signal and parameters -> same name, so a repeated
+# run just loads the files. Composite runs are stitched together from the cached single steps, so adding a critical
+# frequency only works out the new step. Once the folder grows past max_bytes the least recently used results go first.
+class RVEResultCache:
+    def __init__(self, cache_folder = DEFAULT_CACHE_FOLDER, max_bytes = DEFAULT_MAX_BYTES):
+
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    # Cached version of RVE_function.rve_of_singal, same arguments and same answer.
+    def rve_of_singal(self, time_signal, signal, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, engine = "incremental", chunk_size = None, dtype = np.float64):
+
+        data_hash = hash_signal_and_time(time_signal, signal)
+        cache_key = scale_cache_key(data_hash, frequency, τ_const, epsilon_step, samples_per_window, engine, dtype,
+                                    key_chunk_size(np.size(signal), epsilon_step, samples_per_window, chunk_size))
+
+        cached_result = self.load(cache_key)
+        if cached_result is not None:
+            return cached_result
+
+        entropy_arrays, time_entropy = RVE_function.rve_of_singal(time_signal, signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype)
+        self.store(cache_key, entropy_arrays, time_entropy)
+
+        return entropy_arrays, time_entropy
+
+    # Cached version of RVE_function.rve_frequency_averager. Only the epsilon steps that aren't in the cache yet get
+    # worked out (in parallel if asked), and the sum is done the same way so the answer is the same too.
+    def rve_frequency_averager(self, time_signal, signal, frequency, f_crits_min = 3, f_crits_max = 20, f_crits_step = 1, τ_const = 0.75, samples_per_window = 5, engine = "incremental", parallel = None, workers = None, chunk_size = None, dtype = np.float64):
+
+        epsilon_step_crits = RVE_function.epsilon_steps_for_crits(frequency, f_crits_min, f_crits_max, f_crits_step)
+        distinct_epsilon_steps, epsilon_step_counts = RVE_function.distinct_epsilon_steps_with_counts(epsilon_step_crits)
+
+        # prange and batch work every step out in one go whatever chunk_size is.
+        scale_chunk_size = None if parallel in ("prange", "batch") else chunk_size
+        data_hash = hash_signal_and_time(time_signal, signal)
+        cache_keys = [scale_cache_key(data_hash, frequency, τ_const, epsilon_step_i, samples_per_window, engine, dtype,
+                                      key_chunk_size(np.size(signal), epsilon_step_i, samples_per_window, scale_chunk_size))
+                      for epsilon_step_i in distinct_epsilon_steps]
+
+        entropy_arrays_per_scale = [self.load(cache_key) for cache_key in cache_keys]
+        entropy_arrays_per_scale = [None if cached_result is None else cached_result[0] for cached_result in entropy_arrays_per_scale]
+        missing_scales = [scale for scale, entropy_arrays in enumerate(entropy_arrays_per_scale) if entropy_arrays is None]
+
+        if missing_scales:
+            missing_epsilon_steps = distinct_epsilon_steps[missing_scales]
+            if parallel is None:
+                computed_per_scale = [RVE_function.rve_scale_entropy(signal, frequency, τ_const, epsilon_step_i, samples_per_window, engine, chunk_size, dtype)
+                                      for epsilon_step_i in missing_epsilon_steps]
+            else:
+                computed_per_scale = RVE_function.rve_scales_parallel(signal, frequency, missing_epsilon_steps, τ_const, samples_per_window, engine, parallel, workers, chunk_size, dtype)
+
+            for scale, entropy_arrays in zip(missing_scales, computed_per_scale):
+                entropy_arrays_per_scale[scale] = entropy_arrays
+                self.store(cache_keys[scale], entropy_arrays, time_signal[:np.size(entropy_arrays)])
+
+        entropy_arrays_averaged = RVE_function.composite_of_scales(entropy_arrays_per_scale, epsilon_step_counts, np.size(signal), dtype)
+        entropy_time_averaged = time_signal[0:np.size(entropy_arrays_averaged)]
+
+        return entropy_arrays_averaged, entropy_time_averaged
+
+    # Cached version of RVE_function.rve_of_singal_progressive. A cached result comes back straight away as one step,
+    # otherwise the result is only stored once every chunk is done (stopping part way through stores nothing).
+    def rve_of_singal_progressive(self, time_signal, signal, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, engine = "incremental", chunk_size = 65536, dtype = np.float64):
+
+        data_hash = hash_signal_and_time(time_signal, signal)
+        cache_key = scale_cache_key(data_hash, frequency, τ_const, epsilon_step, samples_per_window, engine, dtype,
+                                    key_chunk_size(np.size(signal), epsilon_step, samples_per_window, chunk_size))
+
+        cached_result = self.load(cache_key)
+        if cached_result is not None:
+            yield 1, 1, cached_result[0], cached_result[1]
+            return
+
+        entropy_arrays, time_entropy = np.zeros(0), time_signal[:0]
+        for windows_done, total_windows, entropy_arrays, time_entropy in RVE_function.rve_of_singal_progressive(time_signal, signal, frequency, τ_const, epsilon_step,
+                                                                                                                   samples_per_window, engine, chunk_size, dtype):
+            yield windows_done, total_windows, entropy_arrays, time_entropy
+
+        self.store(cache_key, entropy_arrays, time_entropy)
+
+    # Cached version of RVE_function.rve_frequency_averager_progressive, every finished step is stored as it completes.
+    def rve_frequency_averager_progressive(self, time_signal, signal, frequency, f_crits_min = 3, f_crits_max = 20, f_crits_step = 1, τ_const = 0.75, samples_per_window = 5, engine = "incremental", chunk_size = None, dtype = np.float64):
+
+        data_hash = hash_signal_and_time(time_signal, signal)
+
+        def cached_scale_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype):
+
+            cache_key = scale_cache_key(data_hash, frequency, τ_const, epsilon_step, samples_per_window, engine, dtype,
+                                        key_chunk_size(np.size(signal), epsilon_step, samples_per_window, chunk_size))
+            cached_result = self.load(cache_key)
+            if cached_result is not None:
+                return cached_result[0]
+
+            entropy_arrays = RVE_function.rve_scale_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype)
+            self.store(cache_key, entropy_arrays, time_signal[:np.size(entropy_arrays)])
+
+            return entropy_arrays
+
+        yield from RVE_function.rve_frequency_averager_progressive(time_signal, signal, frequency, f_crits_min, f_crits_max, f_crits_step, τ_const,
+                                                                   samples_per_window, engine, chunk_size, cached_scale_entropy, dtype)
+
+    # Returns (entropy_arrays, time_entropy) for the key, or None if it isn't cached. A hit counts as a use for the LRU.
+    def load(self, cache_key):
+
+        entropy_path, time_path = self.paths_for(cache_key)
+        try:
+            entropy_arrays = np.load(entropy_path)
+            time_entropy = np.load(time_path)
+        except (OSError, ValueError):
+            return None
+
+        for used_path in (entropy_path, time_path):
+            try:
+                os.utime(used_path)
+            except OSError:
+                pass
+
+        return entropy_arrays, time_entropy
+
+    # Saves a result under the key (via temporary files so a reader never sees half a file) and evicts if needed.
+    def store(self, cache_key, entropy_arrays, time_entropy):
+
+        for final_path, array in zip(self.paths_for(cache_key), (entropy_arrays, time_entropy)):
+            temporary_path = f"{final_path}.{os.getpid()}.tmp"
+            with open(temporary_path, "wb") as cache_file:
+                np.save(cache_file, np.asarray(array))
+            os.replace(temporary_path, final_path)
+
+        self.evict()
+
+    # Deletes the least recently used results until the folder fits in max_bytes.
+    def evict(self):
+
+        results = {}
+        total_bytes = 0
+        for file_name in os.listdir(self.cache_folder):
+            if not file_name.endswith(".npy"):
+                continue
+            file_path = os.path.join(self.cache_folder, file_name)
+            try:
+                file_stats = os.stat(file_path)
+            except OSError:
+                continue
+            cache_key = file_name.split(".")[0]
+            last_used, result_bytes = results.get(cache_key, (0, 0))
+            results[cache_key] = (max(last_used, file_stats.st_mtime_ns), result_bytes + file_stats.st_size)
+            total_bytes += file_stats.st_size
+
+        for cache_key, (last_used, result_bytes) in sorted(results.items(), key=lambda result: result[1][0]):
+            if total_bytes <= self.max_bytes:
+                break
+            for file_path in self.paths_for(cache_key):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+            total_bytes -= result_bytes
+
+    # Empties the cache folder of results.
+    def clear(self):
+
+        for file_name in os.listdir(self.cache_folder):
+            if file_name.endswith(".npy"):
+                os.remove(os.path.join(self.cache_folder, file_name))
+
+    def paths_for(self, cache_key):
+
+        return (os.path.join(self.cache_folder, f"{cache_key}.entropy.npy"),
+                os.path.join(self.cache_folder, f"{cache_key}.time.npy"))
+
+# Hash of the raw bytes (plus type and shape) of the signal and its time array.
+def hash_signal_and_time(time_signal, signal):
+
+    data_hash = hashlib.blake2b(digest_size=20)
+    for array in (signal, time_signal):
+        array = np.ascontiguousarray(array)
+        data_hash.update(f"{array.dtype.str}{array.shape}".encode())
+        data_hash.update(array.view(np.uint8).data)
+
+    return data_hash.hexdigest()
+
+# The name a single epsilon step result is stored under. Only results in a dtype other than float64 get it in the
+# name, so the float64 results cached before there was a choice are still found. The same goes for chunk_size (see
+# key_chunk_size): the running totals start again at every chunk, which moves the last bits of the answer, so a chunked
+# result is never handed out for a run done in one go or with other chunks.
+def scale_cache_key(data_hash, frequency, τ_const, epsilon_step, samples_per_window, engine, dtype = np.float64, chunk_size = None):
+
+    parameters = f"{data_hash}|{float(frequency)!r}|{float(τ_const)!r}|{int(epsilon_step)}|{int(samples_per_window)}|{engine}"
+    if np.dtype(dtype) != np.float64:
+        parameters += f"|{np.dtype(dtype).name}"
+    if chunk_size is not None:
+        parameters += f"|chunk {int(chunk_size)}"
+
+    return hashlib.blake2b(parameters.encode(), digest_size=20).hexdigest()
+
+# The chunk_size a step of a signal signal_size samples long is keyed under. None when it doesn't split the windows up at
+# all (no chunk_size, or one with room for every window), as that gives the same answer as working it out in one go.
+def key_chunk_size(signal_size, epsilon_step, samples_per_window, chunk_size):
+
+    total_windows = signal_size - (samples_per_window - 1) * epsilon_step
+    if chunk_size is None or chunk_size >= total_windows:
+        return None
+
+    return int(chunk_size)
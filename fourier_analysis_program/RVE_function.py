@@ -1,55 +1,217 @@
-import itertools
-import time
+import math
+import multiprocessing
+import os
+import tracemalloc
 import numpy as np
 
-from numba import njit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import RVE_trace
+
+# Without numba the kernels below still run, but as plain (very slow) Python. engine="lfilter" is the one to use then,
+# it only needs NumPy and scipy.
+try:
+    from numba import njit, prange
+    numba_available = True
+except ImportError:
+    numba_available = False
+    prange = range
+
+    def njit(*kernel, **options):
+        if kernel and callable(kernel[0]):
+            return kernel[0]
+        return lambda kernel_function: kernel_function
+
+# Every kernel below is compiled with cache=True, so numba keeps the machine code in __pycache__ and only the very
+# first run after the code changes pays for compiling. Later sessions (and process pool workers) just load it.
 
 # Below function will return an np array and corresponding time.
-def rve_of_singal(time_signal, signal, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5):
+# engine picks the entropy loop: "incremental" (default, O(1) per sample), "dense" (the original full histogram pass)
+# "sparse" (only keeps the patterns that actually turn up, for samples_per_window of 6 and up, see SparseHistogram) or
+# "lfilter" (NumPy and scipy only, no compiling, see lfilter_rve_rows).
+# chunk_size switches on the low memory mode, see rve_entropy_chunked. How long it took is in RVE_trace if tracing is on.
+# dtype is what the histograms and the entropy are kept in. np.float32 halves the memory the results take and agrees
+# with float64 to around 1e-6 (see the README), which is plenty for plotting.
+def rve_of_singal(time_signal, signal, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, engine = "incremental", chunk_size = None, dtype = np.float64):
 
-    clocker_start = time.time()
+    with RVE_trace.span("rve_of_singal", samples=np.size(signal), scales=1):
+        entropy_arrays = rve_scale_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype)
 
-    # Creates a window that gets an amount of variables AKA: [1, 2, 3, 4] -> [1, 2], [2, 3],...
-    total_bins = np.math.factorial(samples_per_window)
+    time_entropy = time_signal[:np.size(entropy_arrays, axis=0)]
+
+    return entropy_arrays, time_entropy
+
+# The entropy of a single epsilon step, either all in one go or chunk_size windows at a time.
+def rve_scale_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine = "incremental", chunk_size = None, dtype = np.float64):
+
+    if chunk_size is None:
+        pattern_codes = rve_pattern_codes(signal, epsilon_step, samples_per_window)
+        return rve_entropy_from_codes(pattern_codes, frequency, τ_const, samples_per_window, engine, dtype)
+
+    return rve_entropy_chunked(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype)
+
+# Low memory mode. Windowing, argsort and bin numbers are only ever worked out for chunk_size windows at a time and
+# the histogram carries on from one chunk to the next, so apart from the output the memory used depends on chunk_size
+# and not on how long the recording is. The dense engine gives exactly the same values as doing it all at once, the
+# incremental one rebuilds its running totals at every chunk so agrees to within its usual 1e-10.
+def rve_entropy_chunked(signal, frequency, τ_const, epsilon_step, samples_per_window, engine = "incremental", chunk_size = 65536, dtype = np.float64):
+
+    entropy_arrays = np.zeros(0)
+    for _, _, entropy_arrays in rve_entropy_chunked_steps(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype):
+        pass
+
+    return entropy_arrays
+
+# Does the work for rve_entropy_chunked, yielding (windows done, total windows, entropy_arrays) after every chunk.
+# Only the first "windows done" values of entropy_arrays are filled in at that point.
+def rve_entropy_chunked_steps(signal, frequency, τ_const, epsilon_step, samples_per_window, engine = "incremental", chunk_size = 65536, dtype = np.float64):
+
+    entropy_arrays = None
+    for chunk_start, chunk_finish, max_section_width, chunk_entropy in rve_entropy_chunks(signal, frequency, τ_const, epsilon_step, samples_per_window,
+                                                                                         engine, chunk_size, dtype):
+        if entropy_arrays is None:
+            entropy_arrays = np.zeros(max_section_width, dtype)
+        entropy_arrays[chunk_start:chunk_finish] = chunk_entropy
+
+        yield chunk_finish, max_section_width, entropy_arrays
+
+# The chunks themselves, yielding (chunk start, chunk finish, total windows, the chunk's entropy) without keeping any of
+# them, so a caller that writes them out somewhere (RVE_store) only ever holds one chunk.
+def rve_entropy_chunks(signal, frequency, τ_const, epsilon_step, samples_per_window, engine = "incremental", chunk_size = 65536, dtype = np.float64):
+
+    total_bins = math.factorial(samples_per_window)
+    histy_stuff = new_histogram(total_bins, engine, dtype)
+    alpha_filter = np.exp(-1 / (frequency * τ_const))
+
+    # Each window reaches this many samples along the signal.
+    window_span = (samples_per_window - 1) * epsilon_step + 1
+    max_section_width = max(np.size(signal) - window_span + 1, 0)
+
+    for chunk_start in range(0, max_section_width, chunk_size):
+        chunk_finish = min(chunk_start + chunk_size, max_section_width)
+
+        # The kernels leave histy_stuff where they finished, so the next chunk picks up from it.
+        pattern_codes = rve_pattern_codes(signal[chunk_start:chunk_finish + window_span - 1], epsilon_step, samples_per_window)
+
+        yield chunk_start, chunk_finish, max_section_width, rve_entropy_kernel(pattern_codes, histy_stuff, alpha_filter, total_bins, engine)
+
+# rve_of_singal a chunk at a time, for callers that want to show progress or stop part way through (like the GUI).
+# Yields (windows done, total windows, entropy so far, time so far) after every chunk, the last one is the full answer.
+def rve_of_singal_progressive(time_signal, signal, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, engine = "incremental", chunk_size = 65536, dtype = np.float64):
+
+    for windows_done, total_windows, entropy_arrays in rve_entropy_chunked_steps(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype):
+        yield windows_done, total_windows, entropy_arrays[:windows_done], time_signal[:windows_done]
+
+# Same as rve_of_singal in low memory mode, but also hands back the peak number of bytes numpy allocated on the way
+# (measured with tracemalloc, including the output array). The only thing not counted is the chunk_size float64
+# scratch array the numba kernel allocates for itself.
+def low_memory_rve(time_signal, signal, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, engine = "incremental", chunk_size = 65536, dtype = np.float64):
+
+    already_tracing = tracemalloc.is_tracing()
+    if already_tracing:
+        traced_before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+    else:
+        traced_before = 0
+        tracemalloc.start()
+
+    try:
+        entropy_arrays = rve_entropy_chunked(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype)
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+
+    time_entropy = time_signal[:np.size(entropy_arrays, axis=0)]
+
+    return entropy_arrays, time_entropy, traced_peak - traced_before
+
+# Windows the signal for one epsilon step and returns the bin number of every window.
+def rve_pattern_codes(signal, epsilon_step, samples_per_window):
 
     # This will get us all the ranked values needed for the window.
-    signal_noised_window = np.lib.stride_tricks.sliding_window_view(signal,
-                                                                    samples_per_window * epsilon_step - (
-                                                                                epsilon_step - 1))
-    signal_noised_window = signal_noised_window[:, ::epsilon_step]  # This will step over 4 values.
-    signal_noised_window_indices = np.argsort(signal_noised_window, axis=1)
+    with RVE_trace.span("windowing") as stage:
+        signal_noised_window = np.lib.stride_tricks.sliding_window_view(signal,
+                                                                        samples_per_window * epsilon_step - (
+                                                                                    epsilon_step - 1))
+        signal_noised_window = signal_noised_window[:, ::epsilon_step]  # This will step over 4 values.
+        signal_noised_window_indices = np.argsort(signal_noised_window, axis=1)
+        stage.count("windows", np.size(signal_noised_window_indices, axis=0))
 
-    # Get all of the "permutations" that can be done with the provided samples per window. So it should be the factorial!
-    all_to_bin_list_sequential = np.array(list(itertools.permutations(range(samples_per_window), samples_per_window)))
+    # Turns every ordering into the bin it belongs to up front, instead of searching the permutation table per window.
+    with RVE_trace.span("pattern_encoding", windows=np.size(signal_noised_window_indices, axis=0)):
+        return ordinal_pattern_codes(signal_noised_window_indices)
 
-    # Generates the array where we will bin the values.
-    histy_stuff = np.zeros(total_bins)
-    histy_stuff[:] = 1  # We need to set all values to 1 initially.
+# Runs the decaying histogram over the bin numbers and returns the normalised shannon entropy of every window.
+def rve_entropy_from_codes(pattern_codes, frequency, τ_const, samples_per_window, engine = "incremental", dtype = np.float64):
+
+    # Creates a window that gets an amount of variables AKA: [1, 2, 3, 4] -> [1, 2], [2, 3],...
+    total_bins = math.factorial(samples_per_window)
+
+    # Generates the array where we will bin the values, every bin starts at 1.
+    histy_stuff = new_histogram(total_bins, engine, dtype)
 
     # For the window, how big should the values be?
     # This is important as we would need to dampen the values based on an over time function:
     # α = exp(−1/fτ) for the over time function.
     alpha_filter = np.exp(-1 / (frequency * τ_const))
 
+    # And so we get our histogram from this.
+    return rve_entropy_kernel(pattern_codes, histy_stuff, alpha_filter, total_bins, engine)
+
+# Hands the bin numbers to the compiled loop that engine asks for, the entropy comes back in histy_stuff's dtype. When tracing, the span counts a compile if numba
+# had to compile the kernel for these argument types on this call (so the time includes the compile).
+def rve_entropy_kernel(pattern_codes, histy_stuff, alpha_filter, total_bins, engine = "incremental"):
+
     # Indeed next we will need to take the while loop so we only take x amount of variables into account. Make it >30
-    max_section_width = np.size(signal_noised_window_indices, axis=0)
+    max_section_width = np.size(pattern_codes, axis=0)
 
-    # And so we get our histogram from this.
-    entropy_arrays = optimised_rve(signal_noised_window_indices, histy_stuff, alpha_filter, all_to_bin_list_sequential, total_bins, max_section_width, samples_per_window)
+    if engine == "incremental":
+        entropy_kernel = incremental_rve
+    elif engine == "dense":
+        entropy_kernel = optimised_rve
+    elif engine == "sparse":
+        with RVE_trace.span("entropy_loop", samples=max_section_width) as stage:
+            signatures_before = compiled_signature_count(sparse_rve)
+            entropy_arrays = histy_stuff.run(pattern_codes, alpha_filter)
+            stage.count("compiles", compiled_signature_count(sparse_rve) - signatures_before)
+        return entropy_arrays
+    elif engine == "lfilter":
+        with RVE_trace.span("entropy_loop", samples=max_section_width):
+            return lfilter_rve_rows(pattern_codes[np.newaxis], histy_stuff[np.newaxis], alpha_filter, total_bins)[0]
+    else:
+        raise ValueError(f"Unknown RVE engine: {engine}")
 
-    clocker_for_loop = time.time()
-    print(clocker_for_loop - clocker_start)
+    with RVE_trace.span("entropy_loop", samples=max_section_width) as stage:
+        signatures_before = compiled_signature_count(entropy_kernel)
+        entropy_arrays = entropy_kernel(pattern_codes, histy_stuff, alpha_filter, total_bins, max_section_width)
+        stage.count("compiles", compiled_signature_count(entropy_kernel) - signatures_before)
 
-    time_entropy = time_signal[:np.size(entropy_arrays, axis=0)]
+    return entropy_arrays
 
-    return entropy_arrays, time_entropy
+# How many argument types numba has compiled kernel for so far (always 0 without numba).
+def compiled_signature_count(kernel):
+
+    return len(getattr(kernel, "signatures", ()))
+
+# The starting histogram for engine, 1 in every bin. A plain array of total_bins for the dense and incremental engines,
+# a SparseHistogram (which only stores the bins that get used) for the sparse one. lfilter uses the plain array too.
+# dtype is what the histogram is kept in, and so what the entropy comes out as.
+def new_histogram(total_bins, engine = "incremental", dtype = np.float64):
+
+    if engine == "sparse":
+        return SparseHistogram(total_bins, dtype)
+
+    return np.ones(total_bins, dtype)
 
 # Realistically we want to average the outputted entropy first. Below effectively smoothens curve.
-def entropy_window_averager(time_entropy, entropy_arrays):
+# dtype is what the answer comes back as, see smoothing_dtype.
+def entropy_window_averager(time_entropy, entropy_arrays, size_of_window = 400, dtype = None):
 
-    size_of_window = 400 # Window averaging size.
-    to_average_entropy = np.lib.stride_tricks.sliding_window_view(entropy_arrays, size_of_window)
-    entropy_averaged = np.sum(to_average_entropy, axis=1) / size_of_window
+    dtype = smoothing_dtype(entropy_arrays, dtype)
+    with RVE_trace.span("smoothing", samples=np.size(entropy_arrays)):
+        to_average_entropy = np.lib.stride_tricks.sliding_window_view(entropy_arrays, size_of_window)
+        entropy_averaged = (np.sum(to_average_entropy, axis=1) / size_of_window).astype(dtype, copy=False)
     time_entropy_averaged = time_entropy[0:np.size(entropy_averaged)]
 
     return entropy_averaged, time_entropy_averaged
@@ -57,45 +219,190 @@ def entropy_window_averager(time_entropy, entropy_arrays):
 # After that we want to take the differentiation of the average in order to find the whereabouts of maximal changes.
 # This function also auto-smoothens. Accepts a parameter to suggest "Smoothness" amount.
 # You can specify the order of differentiation by changing o_differ. Default 1.
-# Best accepts entropic values that are averaged.
-def entropy_differentiator(time_entropy, entropy_averaged, size_of_window = 400, o_differ = 1):
+# Best accepts entropic values that are averaged. In float32 the differences are only as good as the averages they come
+# from, entropy_smooth_and_differentiate keeps them more accurate.
+def entropy_differentiator(time_entropy, entropy_averaged, size_of_window = 400, o_differ = 1, dtype = None):
 
-    entropy_arrays_differentiated = np.abs(np.diff(entropy_averaged, o_differ))
-    to_average_diff = np.lib.stride_tricks.sliding_window_view(entropy_arrays_differentiated, size_of_window)
-    diff_averaged = np.sum(to_average_diff, axis=1) / size_of_window
+    dtype = smoothing_dtype(entropy_averaged, dtype)
+    with RVE_trace.span("smoothing", samples=np.size(entropy_averaged)):
+        entropy_arrays_differentiated = np.abs(np.diff(entropy_averaged, o_differ))
+        to_average_diff = np.lib.stride_tricks.sliding_window_view(entropy_arrays_differentiated, size_of_window)
+        diff_averaged = (np.sum(to_average_diff, axis=1) / size_of_window).astype(dtype, copy=False)
     time_diff_averaged = time_entropy[0:np.size(diff_averaged)]
 
     return diff_averaged, time_diff_averaged
 
+# entropy_window_averager followed by entropy_differentiator in one go, for when both the smoothed entropy and its
+# smoothed difference are wanted. Same answer (to floating point tolerance, around 1e-14) but O(N) whatever the window
+# sizes, and the only full length arrays made are the two that are returned. A size_of_window of 1 skips the first
+# smoothing, i.e. just entropy_differentiator on the raw entropy. diff_size_of_window defaults to size_of_window.
+# dtype as for entropy_window_averager. Even in float32 the differences come from the float64 averages, so they keep
+# their accuracy when they are tiny.
+def entropy_smooth_and_differentiate(time_entropy, entropy_arrays, size_of_window = 400, o_differ = 1, diff_size_of_window = None, dtype = None):
+
+    if diff_size_of_window is None:
+        diff_size_of_window = size_of_window
+    if size_of_window < 1 or diff_size_of_window < 1 or o_differ < 0:
+        raise ValueError("Window sizes must be at least 1 and o_differ can't be negative")
+
+    with RVE_trace.span("smoothing", samples=np.size(entropy_arrays)):
+        entropy_averaged, diff_averaged = smooth_differentiate_kernel(np.ascontiguousarray(entropy_arrays, dtype=smoothing_dtype(entropy_arrays, dtype)),
+                                                                      size_of_window, o_differ, diff_size_of_window)
+    time_entropy_averaged = time_entropy[0:np.size(entropy_averaged)]
+    time_diff_averaged = time_entropy[0:np.size(diff_averaged)]
+
+    return entropy_averaged, time_entropy_averaged, diff_averaged, time_diff_averaged
+
+# The dtype the smoothing hands back: dtype if one is given, otherwise whatever floating point type the entropy
+# already is (float64 for anything else).
+def smoothing_dtype(entropy_arrays, dtype = None):
+
+    if dtype is not None:
+        return np.dtype(dtype)
+
+    entropy_dtype = np.asarray(entropy_arrays).dtype
+    if np.issubdtype(entropy_dtype, np.floating):
+        return entropy_dtype
+
+    return np.dtype(np.float64)
+
+# The loop behind entropy_smooth_and_differentiate. Both moving averages are running sums (add the value coming in,
+# take off the one going out). Every window's worth of steps the sum is added up again from scratch so rounding can't
+# build up over a long recording, which only costs another O(N) overall. The n-th order difference is the binomial sum
+# np.diff(x, n)[i] = Σ (-1)^(n-k) C(n,k) x[i+k], worked out from the averages as they are made, and the last
+# diff_size_of_window differences sit in a small ring buffer for the second average. The outputs are in entropy_arrays'
+# dtype, but the sums, the last o_differ + 1 averages and the differences are all kept in float64.
+@njit(nogil=True, cache=True)
+def smooth_differentiate_kernel(entropy_arrays, size_of_window, o_differ, diff_size_of_window):
+
+    averaged_size = max(np.size(entropy_arrays) - size_of_window + 1, 0)
+    differentiated_size = max(averaged_size - o_differ, 0)
+    diff_averaged_size = max(differentiated_size - diff_size_of_window + 1, 0)
+
+    entropy_averaged = np.zeros(averaged_size, entropy_arrays.dtype)
+    diff_averaged = np.zeros(diff_averaged_size, entropy_arrays.dtype)
+    recent_averages = np.zeros(o_differ + 1)
+
+    diff_weights = np.zeros(o_differ + 1)
+    binomial = 1.0
+    for k in range(o_differ + 1):
+        diff_weights[o_differ - k] = binomial if k % 2 == 0 else -binomial
+        binomial = binomial * (o_differ - k) / (k + 1)
+
+    diff_ring = np.zeros(diff_size_of_window)
+    window_sum = 0.0
+    diff_window_sum = 0.0
+
+    for i in range(averaged_size):
+        if i % size_of_window == 0:
+            window_sum = 0.0
+            for j in range(i, i + size_of_window):
+                window_sum += entropy_arrays[j]
+        else:
+            window_sum += entropy_arrays[i + size_of_window - 1] - entropy_arrays[i - 1]
+        entropy_averaged[i] = window_sum / size_of_window
+        recent_averages[i % (o_differ + 1)] = window_sum / size_of_window
+
+        if i < o_differ:
+            continue
+
+        # The difference that the newest average completes, and where it lands in the second window.
+        diff_index = i - o_differ
+        diff_value = 0.0
+        for k in range(o_differ + 1):
+            diff_value += diff_weights[k] * recent_averages[(diff_index + k) % (o_differ + 1)]
+        diff_value = abs(diff_value)
+
+        ring_position = diff_index % diff_size_of_window
+        if diff_index >= diff_size_of_window:
+            diff_window_sum -= diff_ring[ring_position]
+        diff_ring[ring_position] = diff_value
+        diff_window_sum += diff_value
+
+        averaged_index = diff_index - diff_size_of_window + 1
+        if averaged_index < 0:
+            continue
+        if averaged_index % diff_size_of_window == 0:
+            diff_window_sum = 0.0
+            for r in range(diff_size_of_window):
+                diff_window_sum += diff_ring[r]
+        diff_averaged[averaged_index] = diff_window_sum / diff_size_of_window
+
+    return entropy_averaged, diff_averaged
+
+# The moving average of smooth_differentiate_kernel for values that arrive a block at a time (RVE_stream). entropy_ring
+# holds the last size_of_window values, values_seen is how many came before this block and window_sum the running sum
+# at the end of the last one. Returns the averages this block completes and the new running sum, O(1) per value with
+# the same add it up again every window's worth of steps.
+@njit(nogil=True, cache=True)
+def running_average_kernel(entropy_arrays, entropy_ring, values_seen, window_sum):
+
+    size_of_window = np.size(entropy_ring)
+    first_average = max(values_seen - size_of_window + 1, 0)
+    entropy_averaged = np.zeros(max(values_seen + np.size(entropy_arrays) - size_of_window + 1, 0) - first_average)
+
+    for i in range(np.size(entropy_arrays)):
+        value_number = values_seen + i
+        ring_position = value_number % size_of_window
+        if value_number >= size_of_window:
+            window_sum -= entropy_ring[ring_position]
+        entropy_ring[ring_position] = entropy_arrays[i]
+        window_sum += entropy_arrays[i]
+
+        averaged_index = value_number - size_of_window + 1
+        if averaged_index < 0:
+            continue
+        if averaged_index % size_of_window == 0:
+            window_sum = 0.0
+            for k in range(size_of_window):
+                window_sum += entropy_ring[(averaged_index + k) % size_of_window]
+        entropy_averaged[averaged_index - first_average] = window_sum / size_of_window
+
+    return entropy_averaged, window_sum
+
+# Converts each row of argsort indices into its bin number, i.e. its position in the lexicographic order that
+# itertools.permutations(range(samples_per_window)) would list it in. This is the Lehmer code (factorial base rank):
+# for every position we count how many later values are smaller and weight that count by (remaining positions)!.
+# Works on the whole matrix at once so the JIT loop only has to index the histogram.
+def ordinal_pattern_codes(signal_noised_window_indices):
+
+    samples_per_window = np.size(signal_noised_window_indices, axis=1)
+    pattern_codes = np.zeros(np.size(signal_noised_window_indices, axis=0), dtype=pattern_code_dtype(samples_per_window))
+
+    for position in range(samples_per_window - 1):
+        current_column = signal_noised_window_indices[:, position:position + 1]
+        smaller_after = np.sum(signal_noised_window_indices[:, position + 1:] < current_column, axis=1)
+        np.add(pattern_codes, smaller_after * math.factorial(samples_per_window - 1 - position), out=pattern_codes, casting="unsafe")
+
+    return pattern_codes
+
+# The narrowest unsigned type that can hold every bin number, uint8 up to 5 samples per window, uint16 up to 8 and
+# uint32 up to 12.
+def pattern_code_dtype(samples_per_window):
+
+    return np.min_scalar_type(math.factorial(samples_per_window) - 1)
+
 # Below is the particular function that takes all the processing time, we compile this using njit.
 
-@njit
-def optimised_rve(signal_noised_window_indices, histy_stuff, alpha_filter, all_to_bin_list_sequential, total_bins, max_section_width, samples_per_window):
+@njit(nogil=True, cache=True)
+def optimised_rve(pattern_codes, histy_stuff, alpha_filter, total_bins, max_section_width):
 
-    entropy_arrays = np.zeros(max_section_width)  # To input values
+    entropy_arrays = np.zeros(max_section_width, histy_stuff.dtype)  # To input values
 
-    for i_x, ordering in enumerate(signal_noised_window_indices[:]):  # Enumerate simply creates for us a counter, i_x
+    for i_x in range(max_section_width):
 
         # alpha_filter practically makes the latest window be the most important.
         histy_stuff *= alpha_filter
 
-        # A discount np.all function
-        total_size = samples_per_window
-        discount_np_all = np.where(all_to_bin_list_sequential == ordering, 1, 0)
-        discount_summed_bins = np.sum(discount_np_all, axis=1)
-        discount_isthistrue = np.where(discount_summed_bins == total_size, True, False)
-
-        # Counts all the categories as needed
-        histy_stuff[np.where(discount_isthistrue)[0][0]] += 1
+        # Counts all the categories as needed, the bin was already worked out by ordinal_pattern_codes.
+        histy_stuff[pattern_codes[i_x]] += 1
 
         # Normalises and finds the probability of stuff.
         histy_stuff_normalised = histy_stuff / np.sum(histy_stuff)
 
-        # To make sure our NAN does not occur
-        histy_stuff_normalised = np.where(histy_stuff_normalised < 10 ** (-75), 10 ** (-75), histy_stuff_normalised)
-
-        # Figuring out shannon entropy.
-        sum_p_ln_p = np.sum(-histy_stuff_normalised * np.log(histy_stuff_normalised))
+        # Figuring out shannon entropy. To make sure our NAN does not occur, empty bins take the log of 1 instead of 0
+        # (0 ln 0 = 0). Clamping to 1e-75 did the same job but that underflows to 0 in float32.
+        sum_p_ln_p = np.sum(-histy_stuff_normalised * np.log(histy_stuff_normalised + (histy_stuff_normalised == 0)))
         shannon_entropy = sum_p_ln_p / np.log(total_bins)
 
         # Plot into i_x the shanon entropy that we get.
@@ -103,39 +410,749 @@ def optimised_rve(signal_noised_window_indices, histy_stuff, alpha_filter, all_t
 
     return entropy_arrays
 
+# How far the global decay scale of incremental_rve may shrink before the histogram is rescaled and its totals rebuilt.
+# Rebuilding also throws away any rounding drift that has built up in the running p ln p total.
+RENORMALISE_SCALE = 1e-8
+
+# u ln u with the 0 ln 0 = 0 convention, for bins that have decayed away completely.
+@njit(cache=True)
+def u_ln_u(value):
+    if value > 0:
+        return value * np.log(value)
+    return 0.0
+
+# Same answer as optimised_rve but only the touched bin is updated each step, so the cost per sample does not grow
+# with total_bins. The histogram is stored as histy_stuff = decay_scale * unscaled_bins, so decaying every bin is
+# just decay_scale *= alpha_filter. With S = sum(u) and T = sum(u ln u) kept as running totals the entropy is
+#     -sum(p ln p) = ln(S) - T / S,    p = u / S
+# and adding 1 to a bin only changes that bin's share of S and T.
+# Agrees with optimised_rve to within 1e-10 absolute. The running totals are always float64 whatever dtype
+# histy_stuff is, so a float32 histogram only costs the rounding of each stored bin.
+@njit(nogil=True, cache=True)
+def incremental_rve(pattern_codes, histy_stuff, alpha_filter, total_bins, max_section_width):
+
+    entropy_arrays = np.zeros(max_section_width, histy_stuff.dtype)  # To input values
+
+    unscaled_bins = histy_stuff.copy()
+    decay_scale = 1.0
+    running_sum = 0.0
+    running_u_ln_u = 0.0
+    for bin_i in range(total_bins):
+        running_sum += unscaled_bins[bin_i]
+        running_u_ln_u += u_ln_u(unscaled_bins[bin_i])
+
+    log_total_bins = np.log(total_bins)
+
+    for i_x in range(max_section_width):
+
+        # The whole histogram decays at once through the scale factor.
+        decay_scale *= alpha_filter
+
+        # Once the scale gets small fold it back into the bins, otherwise 1 / decay_scale overflows eventually.
+        if decay_scale < RENORMALISE_SCALE:
+            running_sum = 0.0
+            running_u_ln_u = 0.0
+            for bin_i in range(total_bins):
+                unscaled_bins[bin_i] *= decay_scale
+                running_sum += unscaled_bins[bin_i]
+                running_u_ln_u += u_ln_u(unscaled_bins[bin_i])
+            decay_scale = 1.0
+
+        # Adding 1 to the real histogram is adding 1 / decay_scale to the unscaled one.
+        bin_k = pattern_codes[i_x]
+        increment = 1.0 / decay_scale
+        running_u_ln_u -= u_ln_u(unscaled_bins[bin_k])
+        unscaled_bins[bin_k] += increment
+        running_u_ln_u += u_ln_u(unscaled_bins[bin_k])
+        running_sum += increment
+
+        entropy_arrays[i_x] = (np.log(running_sum) - running_u_ln_u / running_sum) / log_total_bins
+
+    # Leaves histy_stuff in the same decayed state optimised_rve would.
+    histy_stuff[:] = unscaled_bins * decay_scale
+
+    return entropy_arrays
+
+# The histogram for the sparse engine. Every bin starts at 1 and decays at the same rate, so all the bins whose pattern
+# hasn't turned up yet always hold the same value. Those are kept as one shared background value and a count, and only
+# the patterns that have actually been seen get a slot of their own. Memory and time then go with how many distinct
+# patterns the signal has, not with samples_per_window!, which is what makes samples_per_window of 6 to 9 usable.
+# Carries on from one run() to the next like histy_stuff does, so it works in the low memory mode too.
+class SparseHistogram:
+    def __init__(self, total_bins, dtype = np.float64):
+
+        self.total_bins = total_bins
+
+        # Seen bin numbers (sorted) and their values, plus the value every other bin has.
+        self.observed_codes = np.zeros(0, dtype=np.int64)
+        self.observed_values = np.zeros(0, dtype)
+        self.background_value = 1.0
+
+    # Runs the bin numbers through sparse_rve and returns their entropy, leaving the histogram where it finished.
+    def run(self, pattern_codes, alpha_filter):
+
+        # Patterns new in this run get a slot that starts at the background value.
+        new_codes = np.union1d(self.observed_codes, np.unique(pattern_codes).astype(np.int64))
+        new_values = np.full(np.size(new_codes), self.background_value, self.observed_values.dtype)
+        new_values[np.searchsorted(new_codes, self.observed_codes)] = self.observed_values
+
+        slot_numbers = np.searchsorted(new_codes, pattern_codes)
+        entropy_arrays, self.background_value = sparse_rve(slot_numbers, new_values, self.background_value, self.total_bins - np.size(new_codes),
+                                                           alpha_filter, self.total_bins, np.size(pattern_codes))
+        self.observed_codes, self.observed_values = new_codes, new_values
+
+        return entropy_arrays
+
+    # The full total_bins histogram, the same thing histy_stuff holds for the other engines.
+    def dense_bins(self):
+
+        histy_stuff = np.full(self.total_bins, self.background_value, self.observed_values.dtype)
+        histy_stuff[self.observed_codes] = self.observed_values
+
+        return histy_stuff
+
+# incremental_rve over slots instead of bins: slot_values holds the seen patterns and the background_bins other bins
+# all sit at background_value. Same running S and T totals and global decay scale, so it agrees with incremental_rve
+# to rounding, but each renormalise only goes over the slots. Leaves slot_values decayed and returns the entropy and
+# the decayed background value.
+@njit(nogil=True, cache=True)
+def sparse_rve(slot_numbers, slot_values, background_value, background_bins, alpha_filter, total_bins, max_section_width):
+
+    entropy_arrays = np.zeros(max_section_width, slot_values.dtype)  # To input values
+
+    unscaled_slots = slot_values.copy()
+    unscaled_background = background_value
+    decay_scale = 1.0
+    running_sum = background_bins * unscaled_background
+    running_u_ln_u = background_bins * u_ln_u(unscaled_background)
+    for slot in range(np.size(unscaled_slots)):
+        running_sum += unscaled_slots[slot]
+        running_u_ln_u += u_ln_u(unscaled_slots[slot])
+
+    log_total_bins = np.log(total_bins)
+
+    for i_x in range(max_section_width):
+
+        decay_scale *= alpha_filter
+
+        if decay_scale < RENORMALISE_SCALE:
+            unscaled_background *= decay_scale
+            running_sum = background_bins * unscaled_background
+            running_u_ln_u = background_bins * u_ln_u(unscaled_background)
+            for slot in range(np.size(unscaled_slots)):
+                unscaled_slots[slot] *= decay_scale
+                running_sum += unscaled_slots[slot]
+                running_u_ln_u += u_ln_u(unscaled_slots[slot])
+            decay_scale = 1.0
+
+        slot = slot_numbers[i_x]
+        increment = 1.0 / decay_scale
+        running_u_ln_u -= u_ln_u(unscaled_slots[slot])
+        unscaled_slots[slot] += increment
+        running_u_ln_u += u_ln_u(unscaled_slots[slot])
+        running_sum += increment
+
+        entropy_arrays[i_x] = (np.log(running_sum) - running_u_ln_u / running_sum) / log_total_bins
+
+    slot_values[:] = unscaled_slots * decay_scale
+
+    return entropy_arrays, unscaled_background * decay_scale
+
+# How many float64 values (about 16 MB) the lfilter engine's indicator matrix may hold at once. Blocks of windows are
+# sized to fit, so memory doesn't grow with the recording.
+LFILTER_BLOCK_VALUES = 1 << 21
+
+# The engine for when numba isn't there or compiling isn't worth it: plain NumPy and scipy.signal.lfilter. Each bin of
+# the histogram is a first order IIR filter, h_k[t] = alpha_filter * h_k[t-1] + [code_t == k], so a block of windows
+# becomes an indicator stream per bin run through lfilter, then the p ln p sum for every window at once.
+# pattern_code_rows is (rows, windows) and histograms (rows, total_bins), one row per channel or epsilon step. They all
+# go through lfilter together (the batch axis), and histograms are left where they finished so the next call carries
+# on from them. Only the bins that turn up in a block get an indicator stream. The rest only decay over the block, so
+# their share of S = sum(u) and T = sum(u ln u) is the row's totals for those bins times alpha^(t+1).
+# Agrees with incremental_rve to within 1e-10 (same 0 ln 0 = 0 convention). Works in histograms' dtype, with S and
+# T added up in float64.
+def lfilter_rve_rows(pattern_code_rows, histograms, alpha_filter, total_bins, block_size = None):
+
+    from scipy.signal import lfilter
+    from scipy.special import xlogy
+
+    row_count, max_section_width = np.shape(pattern_code_rows)
+    entropy_rows = np.zeros((row_count, max_section_width), histograms.dtype)
+    filter_a = np.array([1.0, -alpha_filter], histograms.dtype)
+    filter_b = np.ones(1, histograms.dtype)
+    log_total_bins = np.log(total_bins)
+    log_alpha = np.log(alpha_filter)
+
+    # At most row_count * min(total_bins, block_size) bins turn up in a block.
+    if block_size is None:
+        block_size = LFILTER_BLOCK_VALUES // max(row_count * total_bins, 1)
+        if block_size < total_bins:
+            block_size = math.isqrt(LFILTER_BLOCK_VALUES // max(row_count, 1))
+    block_size = max(block_size, 1)
+
+    for block_start in range(0, max_section_width, block_size):
+        block_codes = pattern_code_rows[:, block_start:block_start + block_size]
+        block_width = np.size(block_codes, axis=1)
+
+        # Numbers every bin across all the rows, so one unique call finds the bins each row uses in this block.
+        row_bins = np.arange(row_count, dtype=np.int64)[:, np.newaxis] * total_bins + block_codes
+        seen_bins, seen_columns = np.unique(row_bins, return_inverse=True)
+        seen_columns = seen_columns.reshape(row_count, block_width)
+
+        indicators = np.zeros((np.size(seen_bins), block_width), histograms.dtype)
+        indicators[seen_columns, np.arange(block_width)] = 1
+        starting_values = histograms.reshape(-1)[seen_bins]
+        seen_values, _ = lfilter(filter_b, filter_a, indicators, axis=1, zi=(filter_a.dtype.type(alpha_filter) * starting_values)[:, np.newaxis])
+
+        # seen_bins is sorted, so each row's bins sit together.
+        row_starts = np.searchsorted(seen_bins, np.arange(row_count) * total_bins)
+        running_sum = np.add.reduceat(seen_values, row_starts, axis=0, dtype=np.float64)
+        running_u_ln_u = np.add.reduceat(xlogy(seen_values, seen_values), row_starts, axis=0, dtype=np.float64)
+
+        unseen = np.ones(row_count * total_bins, dtype=bool)
+        unseen[seen_bins] = False
+        unseen = unseen.reshape(row_count, total_bins)
+        unseen_sum = np.sum(histograms, axis=1, where=unseen, dtype=np.float64)
+        unseen_u_ln_u = np.sum(xlogy(histograms, histograms), axis=1, where=unseen, dtype=np.float64)
+
+        # ln(alpha^(t+1)) is worked out directly so it stays finite once alpha^(t+1) itself underflows to 0.
+        decay_steps = np.arange(1, block_width + 1)
+        decay = np.exp(decay_steps * log_alpha)
+        running_sum += unseen_sum[:, np.newaxis] * decay
+        running_u_ln_u += decay * (unseen_sum[:, np.newaxis] * decay_steps * log_alpha + unseen_u_ln_u[:, np.newaxis])
+
+        entropy_rows[:, block_start:block_start + block_width] = (np.log(running_sum) - running_u_ln_u / running_sum) / log_total_bins
+
+        histograms *= decay[-1]
+        np.put(histograms, seen_bins, seen_values[:, -1])
+
+    return entropy_rows
+
+# The batch backend only makes sense for the lfilter engine, the others have no batch axis.
+def check_batch_engine(engine):
+
+    if engine != "lfilter":
+        raise ValueError(f"The batch backend needs engine=\"lfilter\", not {engine!r}")
+
+# Runs a list of bin number arrays (one per epsilon step or channel) through the lfilter engine as one batch and hands
+# back one entropy array per input. Shorter rows are padded out to the longest, the padding's entropy is thrown away.
+def lfilter_entropy_rows(pattern_codes_per_row, frequency, τ_const, samples_per_window, dtype = np.float64):
+
+    row_sizes = [np.size(pattern_codes) for pattern_codes in pattern_codes_per_row]
+    pattern_code_rows = np.zeros((len(row_sizes), max(row_sizes, default=0)), dtype=pattern_code_dtype(samples_per_window))
+    for row, pattern_codes in enumerate(pattern_codes_per_row):
+        pattern_code_rows[row, :row_sizes[row]] = pattern_codes
+
+    total_bins = math.factorial(samples_per_window)
+    histograms = np.ones((len(row_sizes), total_bins), dtype)
+    alpha_filter = np.exp(-1 / (frequency * τ_const))
+    with RVE_trace.span("entropy_loop", samples=int(np.sum(row_sizes)), scales=len(row_sizes)):
+        entropy_rows = lfilter_rve_rows(pattern_code_rows, histograms, alpha_filter, total_bins)
+
+    return [entropy_rows[row, :row_size] for row, row_size in enumerate(row_sizes)]
+
+# rve_of_singal split up in time, for a single long recording on several cores. The windows are cut into segments that
+# are worked out at the same time, each one starting from a fresh histogram a warm-up halo of windows before its
+# first window. Everything older than the halo has decayed by alpha_filter^halo, so with the halo from
+# warm_up_halo_length every value is within tolerance (absolute, on the 0-1 normalised entropy) of the sequential
+# answer. The first segment has nothing before it so it's exact. segments defaults to workers, and parallel is
+# "thread" (the kernels and argsort release the GIL) or "process" (the signal goes through shared memory).
+# Tolerances much under 1e-10 end up below the rounding noise of the incremental engine itself.
+def rve_of_singal_parallel_in_time(time_signal, signal, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, engine = "incremental", tolerance = 1e-6, segments = None, parallel = "thread", workers = None):
+
+    if workers is None:
+        workers = os.cpu_count()
+    if segments is None:
+        segments = workers
+
+    total_bins = math.factorial(samples_per_window)
+    alpha_filter = np.exp(-1 / (frequency * τ_const))
+    halo_length = warm_up_halo_length(alpha_filter, total_bins, tolerance)
+
+    window_span = (samples_per_window - 1) * epsilon_step + 1
+    max_section_width = max(np.size(signal) - window_span + 1, 0)
+    segment_edges = np.linspace(0, max_section_width, max(segments, 1) + 1).astype(np.int64)
+    segment_jobs = [(max(segment_start - halo_length, 0), segment_start, segment_finish)
+                    for segment_start, segment_finish in zip(segment_edges[:-1], segment_edges[1:]) if segment_finish > segment_start]
+
+    if parallel == "thread":
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entropy_per_segment = list(pool.map(lambda segment_job: rve_segment_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, *segment_job),
+                                                segment_jobs))
+    elif parallel == "process":
+        entropy_per_segment = run_with_shared_signal(signal, rve_segment_from_shared_memory,
+                                                     [(frequency, τ_const, epsilon_step, samples_per_window, engine, *segment_job) for segment_job in segment_jobs],
+                                                     workers)
+    else:
+        raise ValueError(f"Unknown parallel backend: {parallel}")
+
+    entropy_arrays = np.concatenate(entropy_per_segment) if entropy_per_segment else np.zeros(0)
+
+    return entropy_arrays, time_signal[:np.size(entropy_arrays)]
+
+# The entropy of windows segment_start to segment_finish, warmed up from a fresh histogram at halo_start.
+def rve_segment_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, halo_start, segment_start, segment_finish):
+
+    window_span = (samples_per_window - 1) * epsilon_step + 1
+    pattern_codes = rve_pattern_codes(signal[halo_start:segment_finish + window_span - 1], epsilon_step, samples_per_window)
+    entropy_arrays = rve_entropy_from_codes(pattern_codes, frequency, τ_const, samples_per_window, engine)
+
+    return entropy_arrays[segment_start - halo_start:]
+
+# Process pool worker: attaches to the shared signal and works out one time segment.
+def rve_segment_from_shared_memory(shared_name, signal_shape, frequency, τ_const, epsilon_step, samples_per_window, engine, halo_start, segment_start, segment_finish):
+
+    shared_block = shared_memory.SharedMemory(name=shared_name)
+    try:
+        signal = np.ndarray(signal_shape, dtype=np.float64, buffer=shared_block.buf)
+        entropy_arrays = rve_segment_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, halo_start, segment_start, segment_finish)
+        del signal
+    finally:
+        shared_block.close()
+
+    return entropy_arrays
+
+# The shortest warm-up halo (in windows) that keeps every entropy value within tolerance of the sequential answer.
+# Starting fresh L windows early instead of at the very beginning only changes the histogram by what had built up
+# before then, which has decayed to at most alpha^(L+1) (1 / (1 - alpha) + total_bins), while the histogram holds at
+# least (1 - alpha^(L+1)) / (1 - alpha). So the two normalised histograms are at most
+#     T = alpha^(L+1) (1 + total_bins (1 - alpha)) / (1 - alpha^(L+1))
+# apart in total variation, and by the Fannes-Audenaert inequality the entropies differ by at most
+# (T ln(total_bins - 1) + h(T)) / ln(total_bins), h being the binary entropy. Later windows in the segment are closer.
+def warm_up_halo_length(alpha_filter, total_bins, tolerance):
+
+    # The largest T that stays within tolerance, the bound only grows with T up to 1/2.
+    lowest_distance, highest_distance = 0.0, 0.5
+    for _ in range(200):
+        middle_distance = (lowest_distance + highest_distance) / 2
+        if entropy_error_bound(middle_distance, total_bins) <= tolerance:
+            lowest_distance = middle_distance
+        else:
+            highest_distance = middle_distance
+
+    if lowest_distance <= 0:
+        raise ValueError(f"Tolerance {tolerance} is too small to reach")
+
+    # alpha^(L+1) = x with x (1 + total_bins (1 - alpha)) / (1 - x) <= T.
+    decayed_fraction = lowest_distance / (1 + total_bins * (1 - alpha_filter) + lowest_distance)
+
+    return max(int(math.ceil(math.log(decayed_fraction) / math.log(alpha_filter))) - 1, 0)
+
+# Largest difference in normalised entropy between two distributions over total_bins bins that are total_variation apart.
+def entropy_error_bound(total_variation, total_bins):
+
+    if total_variation <= 0:
+        return 0.0
+    binary_entropy = -total_variation * math.log(total_variation) - (1 - total_variation) * math.log(1 - total_variation)
+
+    return (total_variation * math.log(max(total_bins - 1, 1)) + binary_entropy) / math.log(total_bins)
+
+# For tuning τ_const: the entropy for every value in τ_consts from a single windowing and argsort of the signal.
+# Returns a (len(τ_consts), N) matrix, row i being what rve_of_singal(..., τ_const=τ_consts[i], engine="incremental")
+# gives (bit for bit), along with the matching time.
+def rve_tau_sweep(time_signal, signal, frequency, τ_consts, epsilon_step = 4, samples_per_window = 5):
+
+    pattern_codes = rve_pattern_codes(signal, epsilon_step, samples_per_window)
+    alpha_filters = np.exp(-1 / (frequency * np.asarray(τ_consts, dtype=np.float64).ravel()))
+
+    max_section_width = np.size(pattern_codes)
+    with RVE_trace.span("entropy_loop", samples=max_section_width * np.size(alpha_filters), scales=np.size(alpha_filters)) as stage:
+        signatures_before = compiled_signature_count(incremental_rve_sweep)
+        entropy_matrix = incremental_rve_sweep(pattern_codes, alpha_filters, math.factorial(samples_per_window), max_section_width)
+        stage.count("compiles", compiled_signature_count(incremental_rve_sweep) - signatures_before)
+
+    return entropy_matrix, time_signal[:max_section_width]
+
+# rve_tau_sweep for several (samples_per_window, epsilon_step) pairs at once. Each pair is windowed once and all of the
+# τ_consts are run over it. Returns {(samples_per_window, epsilon_step): (entropy matrix, time)}.
+def rve_parameter_sweep(time_signal, signal, frequency, τ_consts, window_step_pairs):
+
+    return {(samples_per_window, epsilon_step): rve_tau_sweep(time_signal, signal, frequency, τ_consts, epsilon_step, samples_per_window)
+            for samples_per_window, epsilon_step in window_step_pairs}
+
+# incremental_rve for several decay rates in one loop over the bin numbers. Every alpha_filter gets its own histogram,
+# decay scale and running totals, and the steps are the same as incremental_rve's so each row matches it exactly.
+@njit(nogil=True, cache=True)
+def incremental_rve_sweep(pattern_codes, alpha_filters, total_bins, max_section_width):
+
+    sweep_size = np.size(alpha_filters)
+    entropy_matrix = np.zeros((sweep_size, max_section_width))
+
+    unscaled_bins = np.ones((sweep_size, total_bins))
+    decay_scales = np.ones(sweep_size)
+    running_sums = np.zeros(sweep_size)
+    running_u_ln_us = np.zeros(sweep_size)
+    for sweep_i in range(sweep_size):
+        for bin_i in range(total_bins):
+            running_sums[sweep_i] += unscaled_bins[sweep_i, bin_i]
+            running_u_ln_us[sweep_i] += u_ln_u(unscaled_bins[sweep_i, bin_i])
+
+    log_total_bins = np.log(total_bins)
+
+    for i_x in range(max_section_width):
+
+        bin_k = pattern_codes[i_x]
+        for sweep_i in range(sweep_size):
+
+            decay_scales[sweep_i] *= alpha_filters[sweep_i]
+
+            if decay_scales[sweep_i] < RENORMALISE_SCALE:
+                running_sums[sweep_i] = 0.0
+                running_u_ln_us[sweep_i] = 0.0
+                for bin_i in range(total_bins):
+                    unscaled_bins[sweep_i, bin_i] *= decay_scales[sweep_i]
+                    running_sums[sweep_i] += unscaled_bins[sweep_i, bin_i]
+                    running_u_ln_us[sweep_i] += u_ln_u(unscaled_bins[sweep_i, bin_i])
+                decay_scales[sweep_i] = 1.0
+
+            increment = 1.0 / decay_scales[sweep_i]
+            running_u_ln_us[sweep_i] -= u_ln_u(unscaled_bins[sweep_i, bin_k])
+            unscaled_bins[sweep_i, bin_k] += increment
+            running_u_ln_us[sweep_i] += u_ln_u(unscaled_bins[sweep_i, bin_k])
+            running_sums[sweep_i] += increment
+
+            entropy_matrix[sweep_i, i_x] = (np.log(running_sums[sweep_i]) - running_u_ln_us[sweep_i] / running_sums[sweep_i]) / log_total_bins
+
+    return entropy_matrix
+
 # Below takes a range of f_crit values -> epsilon and sums up all of the graphs into one big one.
+# parallel spreads the scales over the cores: None runs them one after another, "prange" runs them inside one numba
+# parallel loop, "thread" uses a thread pool (the kernels release the GIL) and "process" uses a process pool that reads
+# the signal from shared memory. "batch" is for engine="lfilter", it puts every scale on the lfilter engine's batch axis
+# instead of using more cores. workers defaults to os.cpu_count(). Every backend adds the scales up in the same order
+# as the sequential loop, so the result is bit-identical whichever one is picked (batch agrees to rounding).
+# chunk_size runs every scale in the low memory mode (prange and batch need all the bin numbers up front so ignore it).
+def rve_frequency_averager(time_signal, signal, frequency, f_crits_min = 3, f_crits_max = 20, f_crits_step = 1, τ_const = 0.75, samples_per_window = 5, engine = "incremental", parallel = None, workers = None, chunk_size = None, dtype = np.float64):
 
-def rve_frequency_averager(time_signal, signal, frequency, f_crits_min = 3, f_crits_max = 20, f_crits_step = 1, τ_const = 0.75, samples_per_window = 5):
+    epsilon_step_crits = epsilon_steps_for_crits(frequency, f_crits_min, f_crits_max, f_crits_step)
 
-    f_crits = np.arange(f_crits_min, f_crits_max, f_crits_step)
-    epsilon_step_crits = np.ceil(frequency / (2 * f_crits))
-    epsilon_step_crits = epsilon_step_crits  # Removes repeat values. Try one without rmv repeat vals
+    # Removes repeat values. Neighbouring critical frequencies often round up to the same step, so each distinct step
+    # is only worked out once and then counted as many times as it came up.
+    distinct_epsilon_steps, epsilon_step_counts = distinct_epsilon_steps_with_counts(epsilon_step_crits)
 
-    # To avoid an int error, we vectorise and then return practically the same values but in int forms.
-    epsilon_step_crits = np.vectorize(int)(epsilon_step_crits)
+    with RVE_trace.span("rve_frequency_averager", samples=np.size(signal), scales=np.size(distinct_epsilon_steps)):
+        if parallel is None:
+            entropy_arrays_per_scale = (rve_of_singal(time_signal, signal, frequency, τ_const, epsilon_step_i, samples_per_window, engine, chunk_size, dtype)[0]
+                                        for epsilon_step_i in distinct_epsilon_steps)
+        else:
+            entropy_arrays_per_scale = rve_scales_parallel(signal, frequency, distinct_epsilon_steps, τ_const, samples_per_window, engine, parallel, workers, chunk_size, dtype)
+
+        # Our final averaged shenanigans, time to plot.
+        entropy_arrays_averaged = composite_of_scales(entropy_arrays_per_scale, epsilon_step_counts, np.size(signal), dtype)
+
+    entropy_time_averaged = time_signal[0:np.size(entropy_arrays_averaged)]
+
+    return entropy_arrays_averaged, entropy_time_averaged
+
+# rve_frequency_averager one epsilon step at a time, for callers that want to show progress or stop part way through.
+# Yields (steps done, total steps, composite so far, time so far) after every distinct epsilon step, where the composite
+# so far is the average of the steps finished up to then. The sum is done in the same order as rve_frequency_averager
+# so the last one is identical to it. scale_entropy works out a single step and defaults to rve_scale_entropy; the
+# result cache passes its own in so finished steps are loaded instead.
+def rve_frequency_averager_progressive(time_signal, signal, frequency, f_crits_min = 3, f_crits_max = 20, f_crits_step = 1, τ_const = 0.75, samples_per_window = 5, engine = "incremental", chunk_size = None, scale_entropy = None, dtype = np.float64):
+
+    if scale_entropy is None:
+        scale_entropy = rve_scale_entropy
+
+    epsilon_step_crits = epsilon_steps_for_crits(frequency, f_crits_min, f_crits_max, f_crits_step)
+    distinct_epsilon_steps, epsilon_step_counts = distinct_epsilon_steps_with_counts(epsilon_step_crits)
 
-    # Keeps a track of the lowest array size to remove last element entropy bias for the sum, starting from largest
-    # possible value.
     lowest_array_size = np.size(signal)
-    entropy_arrays_summer = np.zeros(np.size(signal))
+    entropy_arrays_summer = np.zeros(np.size(signal), dtype)
+    counted_so_far = 0
+
+    for scale, (epsilon_step_i, epsilon_step_count) in enumerate(zip(distinct_epsilon_steps, epsilon_step_counts)):
+
+        entropy_arrays_temp = scale_entropy(signal, frequency, τ_const, epsilon_step_i, samples_per_window, engine, chunk_size, dtype)
+        current_array_size = np.size(entropy_arrays_temp)
 
-    # Now for some multi-processing batch shenanigans that will clearly not be pain. TO BE DONE LATER
-    # BATCH_SIZE = epsilon_step_crits // os.cpu_count()  # Hopefully finds the most efficient batch size to compute to this set number.
+        with RVE_trace.span("composite_sum", samples=current_array_size, scales=1):
+            entropy_arrays_summer[0:current_array_size] = entropy_arrays_summer[0:current_array_size] + entropy_arrays_temp * entropy_arrays_summer.dtype.type(epsilon_step_count)
+        if lowest_array_size > current_array_size:
+            lowest_array_size = current_array_size
+        counted_so_far += epsilon_step_count
+
+        yield scale + 1, np.size(distinct_epsilon_steps), entropy_arrays_summer[0:lowest_array_size] / entropy_arrays_summer.dtype.type(counted_so_far), time_signal[0:lowest_array_size]
+
+# Adds up the entropy of each distinct epsilon step, weighted by how many critical frequencies gave that step, and
+# divides by the number of critical frequencies. The sum is kept in dtype.
+def composite_of_scales(entropy_arrays_per_scale, epsilon_step_counts, signal_size, dtype = np.float64):
 
-    for epsilon_step_i in epsilon_step_crits:
+    # Keeps a track of the lowest array size to remove last element entropy bias for the sum, starting from largest
+    # possible value.
+    lowest_array_size = signal_size
+    entropy_arrays_summer = np.zeros(signal_size, dtype)
+
+    for entropy_arrays_temp, epsilon_step_count in zip(entropy_arrays_per_scale, epsilon_step_counts):
 
-        entropy_arrays_temp, time_entropy_temp = rve_of_singal(time_signal, signal, frequency, τ_const, epsilon_step_i, samples_per_window)
         current_array_size = np.size(entropy_arrays_temp)
 
-        entropy_arrays_summer[0:current_array_size] = entropy_arrays_summer[0:current_array_size] + entropy_arrays_temp
+        # Only the adding up, entropy_arrays_per_scale can be a generator that works each scale out as it's asked for.
+        with RVE_trace.span("composite_sum", samples=current_array_size, scales=1):
+            entropy_arrays_summer[0:current_array_size] = entropy_arrays_summer[0:current_array_size] + entropy_arrays_temp * entropy_arrays_summer.dtype.type(epsilon_step_count)
         if lowest_array_size > current_array_size:
             lowest_array_size = current_array_size
 
-    # Our final averaged shenanigans, time to plot.
-    entropy_arrays_averaged = entropy_arrays_summer[0:lowest_array_size] / np.size(epsilon_step_crits)
-    entropy_time_averaged = time_signal[0:lowest_array_size]
+    return entropy_arrays_summer[0:lowest_array_size] / entropy_arrays_summer.dtype.type(np.sum(epsilon_step_counts))
 
-    return entropy_arrays_averaged, entropy_time_averaged
+# Turns the critical frequency range into the epsilon step for each frequency, ε = ceil(f / 2f_crit).
+def epsilon_steps_for_crits(frequency, f_crits_min, f_crits_max, f_crits_step):
+
+    f_crits = np.arange(f_crits_min, f_crits_max, f_crits_step)
+    epsilon_step_crits = np.ceil(frequency / (2 * f_crits))
+
+    # To avoid an int error, we vectorise and then return practically the same values but in int forms.
+    return np.vectorize(int, otypes=[np.int64])(epsilon_step_crits)
+
+# Returns each epsilon step once, in the order they first come up, along with how many times it came up.
+def distinct_epsilon_steps_with_counts(epsilon_step_crits):
+
+    distinct_epsilon_steps, first_seen, epsilon_step_counts = np.unique(epsilon_step_crits, return_index=True, return_counts=True)
+    first_seen_order = np.argsort(first_seen)
+
+    return distinct_epsilon_steps[first_seen_order], epsilon_step_counts[first_seen_order]
+
+# Computes the entropy of every epsilon step at once and hands them back as a list in the same order as
+# epsilon_step_crits.
+def rve_scales_parallel(signal, frequency, epsilon_step_crits, τ_const, samples_per_window, engine = "incremental", parallel = "thread", workers = None, chunk_size = None, dtype = np.float64):
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if parallel == "prange":
+        pattern_codes_per_scale = [rve_pattern_codes(signal, epsilon_step_i, samples_per_window) for epsilon_step_i in epsilon_step_crits]
+        return prange_entropy_rows(pattern_codes_per_scale, frequency, τ_const, samples_per_window, engine, dtype)
+
+    elif parallel == "batch":
+        check_batch_engine(engine)
+        pattern_codes_per_scale = [rve_pattern_codes(signal, epsilon_step_i, samples_per_window) for epsilon_step_i in epsilon_step_crits]
+        return lfilter_entropy_rows(pattern_codes_per_scale, frequency, τ_const, samples_per_window, dtype)
+
+    elif parallel == "thread":
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda epsilon_step_i: rve_scale_entropy(signal, frequency, τ_const, epsilon_step_i, samples_per_window, engine, chunk_size, dtype),
+                                 epsilon_step_crits))
+
+    elif parallel == "process":
+        return run_with_shared_signal(signal, rve_scale_from_shared_memory,
+                                      [(frequency, τ_const, int(epsilon_step_i), samples_per_window, engine, chunk_size, dtype) for epsilon_step_i in epsilon_step_crits],
+                                      workers)
+
+    else:
+        raise ValueError(f"Unknown parallel backend: {parallel}")
+
+# Works out the entropy of every channel of a (channels, samples) recording, such as a 32-64 channel EEG file, and
+# returns a (channels, N) matrix with one row per channel along with the matching time. The channels are spread over
+# the cores with the same parallel backends as rve_frequency_averager, defaulting to a thread pool.
+def rve_of_channels(time_signal, signals, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, engine = "incremental", parallel = "thread", workers = None, chunk_size = None, dtype = np.float64):
+
+    entropy_matrix = rve_channels_parallel(signals, frequency, np.array([epsilon_step]), τ_const, samples_per_window, engine, parallel, workers, chunk_size, dtype)
+    time_entropy = time_signal[:np.size(entropy_matrix, axis=1)]
+
+    return entropy_matrix, time_entropy
+
+# Composite version of rve_of_channels, each row is what rve_frequency_averager gives for that channel.
+def rve_frequency_averager_channels(time_signal, signals, frequency, f_crits_min = 3, f_crits_max = 20, f_crits_step = 1, τ_const = 0.75, samples_per_window = 5, engine = "incremental", parallel = "thread", workers = None, chunk_size = None, dtype = np.float64):
+
+    epsilon_step_crits = epsilon_steps_for_crits(frequency, f_crits_min, f_crits_max, f_crits_step)
+    entropy_matrix = rve_channels_parallel(signals, frequency, epsilon_step_crits, τ_const, samples_per_window, engine, parallel, workers, chunk_size, dtype)
+    entropy_time_averaged = time_signal[:np.size(entropy_matrix, axis=1)]
+
+    return entropy_matrix, entropy_time_averaged
+
+# Does the work for rve_of_channels and rve_frequency_averager_channels, one composite (or single step) per channel.
+def rve_channels_parallel(signals, frequency, epsilon_step_crits, τ_const, samples_per_window, engine = "incremental", parallel = "thread", workers = None, chunk_size = None, dtype = np.float64):
+
+    signals = np.atleast_2d(signals)
+    channel_count, signal_size = np.shape(signals)
+    distinct_epsilon_steps, epsilon_step_counts = distinct_epsilon_steps_with_counts(epsilon_step_crits)
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if parallel in ("prange", "batch"):
+        # One row per channel and epsilon step, all run in the same numba parallel loop (or lfilter batch).
+        if parallel == "batch":
+            check_batch_engine(engine)
+        pattern_codes_per_row = [rve_pattern_codes(channel_signal, epsilon_step_i, samples_per_window)
+                                 for channel_signal in signals for epsilon_step_i in distinct_epsilon_steps]
+        if parallel == "batch":
+            entropy_rows = lfilter_entropy_rows(pattern_codes_per_row, frequency, τ_const, samples_per_window, dtype)
+        else:
+            entropy_rows = prange_entropy_rows(pattern_codes_per_row, frequency, τ_const, samples_per_window, engine, dtype)
+        scale_count = np.size(distinct_epsilon_steps)
+        entropy_per_channel = [composite_of_scales(entropy_rows[channel * scale_count:(channel + 1) * scale_count], epsilon_step_counts, signal_size, dtype)
+                               for channel in range(channel_count)]
+
+    elif parallel is None:
+        entropy_per_channel = [rve_channel_entropy(channel_signal, frequency, distinct_epsilon_steps, epsilon_step_counts, τ_const, samples_per_window, engine, chunk_size, dtype)
+                               for channel_signal in signals]
+
+    elif parallel == "thread":
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entropy_per_channel = list(pool.map(lambda channel_signal: rve_channel_entropy(channel_signal, frequency, distinct_epsilon_steps, epsilon_step_counts,
+                                                                                           τ_const, samples_per_window, engine, chunk_size, dtype),
+                                                signals))
+
+    elif parallel == "process":
+        entropy_per_channel = run_with_shared_signal(signals, rve_channel_from_shared_memory,
+                                                     [(channel, frequency, distinct_epsilon_steps, epsilon_step_counts, τ_const, samples_per_window, engine, chunk_size, dtype)
+                                                      for channel in range(channel_count)],
+                                                     workers)
+
+    else:
+        raise ValueError(f"Unknown parallel backend: {parallel}")
+
+    # Every channel is the same length so they all come out the same length.
+    return np.stack(entropy_per_channel)
+
+# The composite entropy of one channel, going through its distinct epsilon steps one after another.
+def rve_channel_entropy(signal, frequency, distinct_epsilon_steps, epsilon_step_counts, τ_const, samples_per_window, engine = "incremental", chunk_size = None, dtype = np.float64):
+
+    entropy_arrays_per_scale = (rve_scale_entropy(signal, frequency, τ_const, epsilon_step_i, samples_per_window, engine, chunk_size, dtype)
+                                for epsilon_step_i in distinct_epsilon_steps)
+
+    return composite_of_scales(entropy_arrays_per_scale, epsilon_step_counts, np.size(signal), dtype)
+
+# Puts signal into shared memory once and runs worker(shared_name, signal_shape, *job_args) for every job in a process
+# pool, so each worker reads the signal instead of getting its own pickled copy. Results come back in job order.
+def run_with_shared_signal(signal, worker, job_args_list, workers = None):
+
+    signal = np.ascontiguousarray(signal, dtype=np.float64)
+    shared_block = shared_memory.SharedMemory(create=True, size=max(signal.nbytes, 1))
+    try:
+        shared_signal = np.ndarray(signal.shape, dtype=np.float64, buffer=shared_block.buf)
+        shared_signal[:] = signal
+        del shared_signal
+
+        # spawn rather than fork, numba's thread pool is not safe to fork once prange has started it.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            jobs = [pool.submit(worker, shared_block.name, signal.shape, *job_args) for job_args in job_args_list]
+            return [job.result() for job in jobs]
+    finally:
+        shared_block.close()
+        shared_block.unlink()
+
+# Process pool worker: attaches to the shared signal and works out a single epsilon step.
+def rve_scale_from_shared_memory(shared_name, signal_shape, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size = None, dtype = np.float64):
+
+    shared_block = shared_memory.SharedMemory(name=shared_name)
+    try:
+        signal = np.ndarray(signal_shape, dtype=np.float64, buffer=shared_block.buf)
+        entropy_arrays = rve_scale_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype)
+        del signal
+    finally:
+        shared_block.close()
+
+    return entropy_arrays
+
+# Process pool worker: attaches to the shared (channels, samples) recording and works out one channel.
+def rve_channel_from_shared_memory(shared_name, signal_shape, channel, frequency, distinct_epsilon_steps, epsilon_step_counts, τ_const, samples_per_window, engine, chunk_size = None, dtype = np.float64):
+
+    shared_block = shared_memory.SharedMemory(name=shared_name)
+    try:
+        signals = np.ndarray(signal_shape, dtype=np.float64, buffer=shared_block.buf)
+        entropy_arrays = rve_channel_entropy(signals[channel], frequency, distinct_epsilon_steps, epsilon_step_counts, τ_const, samples_per_window, engine, chunk_size, dtype)
+        del signals
+    finally:
+        shared_block.close()
+
+    return entropy_arrays
+
+# Runs a list of bin number arrays through the prange backend and hands back one entropy array per input.
+def prange_entropy_rows(pattern_codes_per_row, frequency, τ_const, samples_per_window, engine = "incremental", dtype = np.float64):
+
+    if engine not in PRANGE_ENGINES:
+        raise ValueError(f"Unknown RVE engine: {engine}")
+
+    # The sparse engine works on slot numbers, each row's patterns numbered in order from 0.
+    row_slot_counts = np.zeros(len(pattern_codes_per_row), dtype=np.int64)
+    if engine == "sparse":
+        pattern_codes_per_row = list(pattern_codes_per_row)
+        for row, pattern_codes in enumerate(pattern_codes_per_row):
+            observed_codes, pattern_codes_per_row[row] = np.unique(pattern_codes, return_inverse=True)
+            row_slot_counts[row] = np.size(observed_codes)
+
+    # Every input gets a row, padded out to the longest one, and numba spreads the rows over its threads.
+    row_sizes = np.array([np.size(pattern_codes) for pattern_codes in pattern_codes_per_row], dtype=np.int64)
+    pattern_code_rows = np.zeros((len(pattern_codes_per_row), np.max(row_sizes)), dtype=pattern_code_dtype(samples_per_window))
+    for row, pattern_codes in enumerate(pattern_codes_per_row):
+        pattern_code_rows[row, :row_sizes[row]] = pattern_codes
+
+    alpha_filter = np.exp(-1 / (frequency * τ_const))
+    with RVE_trace.span("entropy_loop", samples=int(np.sum(row_sizes)), scales=np.size(row_sizes)) as stage:
+        signatures_before = compiled_signature_count(prange_scales_rve)
+        entropy_rows = prange_scales_rve(pattern_code_rows, row_sizes, row_slot_counts, alpha_filter, math.factorial(samples_per_window),
+                                         PRANGE_ENGINES[engine], np.zeros(pattern_code_rows.shape, dtype))
+        stage.count("compiles", compiled_signature_count(prange_scales_rve) - signatures_before)
+
+    return [entropy_rows[row, :row_sizes[row]] for row in range(np.size(row_sizes))]
+
+# The engines prange_scales_rve can run, by the number it knows them as.
+PRANGE_ENGINES = {"dense": 0, "incremental": 1, "sparse": 2}
+
+# The prange backend, one padded row of bin numbers per epsilon step (or channel). Each row gets its own histogram and
+# runs through the same kernel as the sequential path, so the numbers come out the same. For the sparse engine the
+# rows hold slot numbers and row_slot_counts says how many slots each row needs. Fills in and returns entropy_rows,
+# whose dtype the histograms are kept in.
+@njit(parallel=True, cache=True)
+def prange_scales_rve(pattern_code_rows, row_sizes, row_slot_counts, alpha_filter, total_bins, engine_number, entropy_rows):
+
+    for row in prange(np.size(row_sizes)):
+        row_size = row_sizes[row]
+        if engine_number == 2:
+            slot_values = np.ones(row_slot_counts[row], entropy_rows.dtype)
+            entropy_rows[row, :row_size] = sparse_rve(pattern_code_rows[row, :row_size], slot_values, 1.0, total_bins - row_slot_counts[row],
+                                                      alpha_filter, total_bins, row_size)[0]
+        elif engine_number == 1:
+            histy_stuff = np.ones(total_bins, entropy_rows.dtype)
+            entropy_rows[row, :row_size] = incremental_rve(pattern_code_rows[row, :row_size], histy_stuff, alpha_filter, total_bins, row_size)
+        else:
+            histy_stuff = np.ones(total_bins, entropy_rows.dtype)
+            entropy_rows[row, :row_size] = optimised_rve(pattern_code_rows[row, :row_size], histy_stuff, alpha_filter, total_bins, row_size)
+
+    return entropy_rows
+
+# Flags the entropy drops and spikes. Anything further than fence_factor interquartile ranges below the lower quartile
+# or above the upper quartile counts (Tukey's fences, 3 is "far out"). The quartiles come from np.partition, which only
+# has to put three values in place rather than sort the lot, so this is O(N). Returns the indices and times of the
+# anomalous points. For entropy arriving in blocks see RVE_stream.StreamingAnomalyFinder.
+def anomalous_point_finder(time_entropy, entropy_signal, fence_factor = 3):
+
+    entropy_signal = np.asarray(entropy_signal)
+    lower_fence, upper_fence = anomaly_fences(entropy_signal, fence_factor)
+
+    anomalous_indices = np.flatnonzero((entropy_signal < lower_fence) | (entropy_signal > upper_fence))
+
+    return anomalous_indices, np.asarray(time_entropy)[anomalous_indices]
+
+# The (lower, upper) thresholds anomalous_point_finder uses, from the quartiles of the values.
+def anomaly_fences(entropy_values, fence_factor = 3):
+
+    entropy_values = np.asarray(entropy_values).ravel()
+    entropy_values = entropy_values[np.isfinite(entropy_values)]
+    if np.size(entropy_values) == 0:
+        return -np.inf, np.inf
+
+    # Same positions np.quantile(..., method="nearest") would pick.
+    quartile_positions = np.rint(np.array([0.25, 0.75]) * (np.size(entropy_values) - 1)).astype(np.int64)
+    partitioned_values = np.partition(entropy_values, quartile_positions)
+    lower_quartile, upper_quartile = partitioned_values[quartile_positions]
+    interquartile_range = upper_quartile - lower_quartile
+
+    return lower_quartile - fence_factor * interquartile_range, upper_quartile + fence_factor * interquartile_range
+
+# Runs every kernel once on a tiny signal so they are compiled (or loaded from numba's cache) before the first real
+# run needs them. Bin numbers are uint8 up to samples_per_window = 5 and uint16 above, which are compiled separately.
+def warm_up_kernels(samples_per_window_values = (5, 8), engines = ("incremental", "dense", "sparse")):
+
+    # Nothing gets compiled without numba.
+    if not numba_available:
+        return
+
+    warm_up_signal = np.sin(np.arange(64) * 0.7)
+    for engine in engines:
+        for samples_per_window in samples_per_window_values:
+            entropy_arrays = rve_scale_entropy(warm_up_signal, 600, 1, 1, samples_per_window, engine)
 
-def anomalous_point_finder(entropy_signal):
-    sorted_entropy_signal = np.sort(entropy_signal, axis=0)
+    entropy_smooth_and_differentiate(np.arange(np.size(entropy_arrays)), entropy_arrays, 4, 1, 4)
@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import scipy.io
+
+import RVE_trace
+
+# Sidecars live in this folder next to the signal file.
+SIDECAR_FOLDER = ".signal_cache"
+
+# Every MATLAB v5 (and v6/v7) file starts with this text in its 128 byte header, the example text signals do not.
+MATLAB_HEADER = b"MATLAB 5.0 MAT-file"
+
+# Loads a signal file once and then keeps a binary .npy copy of it next to the file, so later loads skip parsing and
+# just memory-map the copy (read only). The copy is named after the file's size and modification time so editing or
+# replacing the file makes a new one. Works with the text signals in Fourier_Filtering/ and with real MATLAB v5 .mat
+# files (variable_name picks the variable, otherwise the first numeric one is used). Multi-row files come back as a
+# (channels, samples) array. If the folder can't be written to the file is just parsed every time.
+def load_signal(file_path, variable_name = None, use_sidecar = True, mmap_mode = "r"):
+
+    with RVE_trace.span("load") as stage:
+        signal = load_signal_untraced(file_path, variable_name, use_sidecar, mmap_mode)
+        stage.count("samples", np.size(signal))
+
+    return signal
+
+def load_signal_untraced(file_path, variable_name = None, use_sidecar = True, mmap_mode = "r"):
+
+    if not use_sidecar:
+        return parse_signal(file_path, variable_name)
+
+    sidecar_path = sidecar_path_for(file_path, variable_name)
+    if os.path.exists(sidecar_path):
+        return np.load(sidecar_path, mmap_mode=mmap_mode)
+
+    signal = parse_signal(file_path, variable_name)
+
+    try:
+        write_sidecar(file_path, sidecar_path, signal)
+    except OSError:
+        return signal
+
+    return np.load(sidecar_path, mmap_mode=mmap_mode)
+
+# Reads the file itself, no sidecar involved.
+def parse_signal(file_path, variable_name = None):
+
+    with open(file_path, "rb") as signal_file:
+        header = signal_file.read(len(MATLAB_HEADER))
+
+    if header == MATLAB_HEADER:
+        return load_matlab_signal(file_path, variable_name)
+
+    return np.loadtxt(file_path)
+
+# Pulls one variable out of a MATLAB v5 file. v7.3 files are HDF5 underneath and scipy.io can't read them.
+def load_matlab_signal(file_path, variable_name = None):
+
+    matlab_variables = scipy.io.loadmat(file_path)
+
+    if variable_name is None:
+        numeric_names = [name for name, value in matlab_variables.items()
+                         if not name.startswith("__") and isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.number)]
+        if not numeric_names:
+            raise ValueError(f"No numeric variables in {file_path}")
+        variable_name = numeric_names[0]
+
+    # MATLAB keeps everything at least 2D, a single recording comes back as a 1 x N row.
+    return np.squeeze(np.asarray(matlab_variables[variable_name], dtype=np.float64))
+
+# Where the sidecar for this exact version of the file would be.
+def sidecar_path_for(file_path, variable_name = None):
+
+    file_stats = os.stat(file_path)
+    folder, file_name = os.path.split(os.path.abspath(file_path))
+    variable_part = "" if variable_name is None else f".{variable_name}"
+
+    return os.path.join(folder, SIDECAR_FOLDER, f"{file_name}{variable_part}.{file_stats.st_size}_{file_stats.st_mtime_ns}.npy")
+
+# Writes the sidecar in one go (via a temporary file) and clears out any sidecars left over from older versions.
+def write_sidecar(file_path, sidecar_path, signal):
+
+    sidecar_folder = os.path.dirname(sidecar_path)
+    os.makedirs(sidecar_folder, exist_ok=True)
+
+    temporary_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as sidecar_file:
+        np.save(sidecar_file, signal)
+    os.replace(temporary_path, sidecar_path)
+
+    # Older versions of the same file only differ in the <size>_<mtime> part of the name.
+    stale_prefix = os.path.basename(sidecar_path).rsplit(".", 2)[0] + "."
+    for sidecar_name in os.listdir(sidecar_folder):
+        version_part = sidecar_name[len(stale_prefix):-len(".npy")]
+        is_older_version = (sidecar_name.startswith(stale_prefix) and sidecar_name.endswith(".npy")
+                            and version_part.replace("_", "", 1).isdigit())
+        if is_older_version and os.path.join(sidecar_folder, sidecar_name) != sidecar_path:
+            try:
+                os.remove(os.path.join(sidecar_folder, sidecar_name))
+            except OSError:
+                pass
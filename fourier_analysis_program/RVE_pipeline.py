@@ -0,0 +1,383 @@
+import json
+import math
+import os
+import re
+import numpy as np
+
+import RVE_function
+import RVE_loader
+import RVE_store
+
+# Everything one run of the pipeline needs to know, with the same names and defaults as TheWidget. duration can be
+# left as None to take the whole recording (time then runs at 1 / frequency per sample), offset_finish as None to run
+# to the end. size_of_window is the smoothing window, chunk_size the chunk for the single step progress (and the low
+# memory mode for composites). dtype is "float64" or "float32" for the entropy and everything worked out from it.
+class RVEParameters:
+    def __init__(self, frequency = 1200, duration = None, τ_const = 1, epsilon_step = 4, samples_per_window = 5,
+                 offset_start = 0, offset_finish = None, allow_offset = False,
+                 allow_composite = False, frequency_crits_min = 5, frequency_crits_max = 40, frequency_crits_step = 1,
+                 allow_smoothening = False, show_differentiated_graph = False, size_of_window = 400,
+                 engine = "incremental", chunk_size = None, dtype = "float64"):
+
+        self.frequency = frequency
+        self.duration = duration
+        self.τ_const = τ_const
+        self.epsilon_step = epsilon_step
+        self.samples_per_window = samples_per_window
+
+        self.offset_start = offset_start
+        self.offset_finish = offset_finish
+        self.allow_offset = allow_offset
+
+        self.allow_composite = allow_composite
+        self.frequency_crits_min = frequency_crits_min
+        self.frequency_crits_max = frequency_crits_max
+        self.frequency_crits_step = frequency_crits_step
+
+        self.allow_smoothening = allow_smoothening
+        self.show_differentiated_graph = show_differentiated_graph
+        self.size_of_window = size_of_window
+
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+
+    def as_dict(self):
+
+        return dict(vars(self))
+
+# The whole pipeline for one recording without any GUI: load, entropy (single step or composite), smoothing and
+# differentiation. Hands back the same dictionary GraphWorker gives draw_results. Multi-channel recordings are run a
+# channel at a time and every array in the answer gets one row per channel. result_cache is an optional
+# RVE_cache.RVEResultCache.
+def run_pipeline(file_path, parameters, result_cache = None):
+
+    time_signal, signal = load_recording(file_path, parameters)
+
+    if np.ndim(signal) == 1:
+        return run_pipeline_on_signal(time_signal, signal, parameters, result_cache)
+
+    channel_results = [run_pipeline_on_signal(time_signal, channel_signal, parameters, result_cache) for channel_signal in signal]
+    pipeline_results = {"time_signal": time_signal, "signal": signal, "frequency": parameters.frequency}
+    for result_name in ("entropy_arrays", "entropy_time", "diff_entropy_arrays", "diff_entropy_time"):
+        if channel_results[0][result_name] is None:
+            pipeline_results[result_name] = None
+        elif result_name.endswith("_time"):
+            pipeline_results[result_name] = channel_results[0][result_name]
+        else:
+            pipeline_results[result_name] = np.stack([channel_result[result_name] for channel_result in channel_results])
+
+    return pipeline_results
+
+def run_pipeline_on_signal(time_signal, signal, parameters, result_cache = None):
+
+    entropy_arrays, entropy_time = np.zeros(0), time_signal[:0]
+    for _, _, entropy_arrays, entropy_time in entropy_steps(time_signal, signal, parameters, result_cache):
+        pass
+
+    entropy_arrays, entropy_time, diff_entropy_arrays, diff_entropy_time = smooth_and_differentiate(entropy_time, entropy_arrays, parameters)
+
+    return {"time_signal": time_signal, "signal": signal, "frequency": parameters.frequency,
+            "entropy_arrays": entropy_arrays, "entropy_time": entropy_time,
+            "diff_entropy_arrays": diff_entropy_arrays, "diff_entropy_time": diff_entropy_time}
+
+# run_pipeline, but the results go into a RVE_store results store at store_path rather than memory, one channel at a
+# time, so however long the recording is only about a chunk of entropy is ever held. Everything runs a chunk at a time
+# (parameters.chunk_size, 65536 if it isn't set), so the answers are the same as run_pipeline with that chunk_size.
+#
+#   single step     each chunk's entropy is appended as soon as it's worked out
+#   composite       every epsilon step is added into a scratch memory-mapped file in the store folder, then the
+#                   average is appended from it a chunk at a time
+#   smoothing       the raw entropy goes in as unsmoothed_entropy_arrays first, then the smoothed (and differentiated)
+#                   entropy is worked out from it in blocks lined up with the smoothing window
+#
+# Times aren't stored, the store works them out from the offset start and the sample rate of the time axis. Returns
+# the store, open to read.
+def run_pipeline_to_store(file_path, parameters, store_path, store_chunk_size = RVE_store.DEFAULT_CHUNK_SIZE):
+
+    signal = RVE_loader.load_signal(file_path)
+    if parameters.duration is not None:
+        signal = signal[..., :int(parameters.duration * parameters.frequency)]
+    offset_start, offset_finish = offset_range(np.shape(signal)[-1], parameters)
+    signal = signal[..., offset_start:offset_finish]
+    channel_signals = signal if np.ndim(signal) == 2 else signal[np.newaxis]
+
+    chunk_size = parameters.chunk_size or 65536
+    smoothing = parameters.allow_smoothening == True or parameters.show_differentiated_graph == True
+    entropy_series = "unsmoothed_entropy_arrays" if smoothing else "entropy_arrays"
+
+    with RVE_store.create_store(store_path, parameters.frequency, time_axis_rate(parameters), offset_start, np.shape(signal)[-1], len(channel_signals),
+                                parameters.dtype, store_chunk_size, parameters.as_dict()) as results_store:
+        for channel, channel_signal in enumerate(channel_signals):
+            if parameters.allow_composite == True:
+                entropy_chunks = composite_entropy_chunks(channel_signal, parameters, chunk_size, os.path.join(store_path, "composite_sum.npy"))
+            else:
+                entropy_chunks = (chunk_entropy for _, _, _, chunk_entropy in
+                                  RVE_function.rve_entropy_chunks(channel_signal, parameters.frequency, parameters.τ_const, parameters.epsilon_step,
+                                                                  parameters.samples_per_window, parameters.engine, chunk_size, np.dtype(parameters.dtype)))
+
+            results_store.append(entropy_series, np.zeros(0), channel)
+            for chunk_entropy in entropy_chunks:
+                results_store.append(entropy_series, chunk_entropy, channel)
+
+            if smoothing:
+                for series_name, block_values in smoothed_blocks(results_store, entropy_series, channel, parameters, chunk_size):
+                    results_store.append(series_name, block_values, channel)
+
+    return RVE_store.open_store(store_path)
+
+# The composite of rve_frequency_averager_progressive a chunk at a time. The sum of the epsilon steps goes in a scratch
+# .npy at scratch_path rather than memory and is added up in the same order and dtype, so the answer is the same. The
+# scratch file is deleted once every chunk has been handed out.
+def composite_entropy_chunks(signal, parameters, chunk_size, scratch_path):
+
+    dtype = np.dtype(parameters.dtype)
+    epsilon_step_crits = RVE_function.epsilon_steps_for_crits(parameters.frequency, parameters.frequency_crits_min,
+                                                              parameters.frequency_crits_max, parameters.frequency_crits_step)
+    distinct_epsilon_steps, epsilon_step_counts = RVE_function.distinct_epsilon_steps_with_counts(epsilon_step_crits)
+
+    entropy_arrays_summer = np.lib.format.open_memmap(scratch_path, mode="w+", dtype=dtype, shape=(max(np.size(signal), 1),))
+    try:
+        lowest_array_size = np.size(signal)
+        for epsilon_step_i, epsilon_step_count in zip(distinct_epsilon_steps, epsilon_step_counts):
+            current_array_size = 0
+            for chunk_start, chunk_finish, current_array_size, chunk_entropy in RVE_function.rve_entropy_chunks(signal, parameters.frequency, parameters.τ_const,
+                                                                                                                epsilon_step_i, parameters.samples_per_window,
+                                                                                                                parameters.engine, chunk_size, dtype):
+                entropy_arrays_summer[chunk_start:chunk_finish] = entropy_arrays_summer[chunk_start:chunk_finish] + chunk_entropy * dtype.type(epsilon_step_count)
+            lowest_array_size = min(lowest_array_size, current_array_size)
+
+        for chunk_start in range(0, lowest_array_size, chunk_size):
+            yield entropy_arrays_summer[chunk_start:min(chunk_start + chunk_size, lowest_array_size)] / dtype.type(np.sum(epsilon_step_counts))
+    finally:
+        del entropy_arrays_summer
+        os.remove(scratch_path)
+
+# smooth_and_differentiate on the entropy already in the store, yielding (series name, values) a block at a time so
+# only about block_size values (rounded up to a whole number of smoothing windows) are read at once. The smoothing
+# kernel adds its sums up again from scratch every window, so blocks that start on a window boundary give exactly the
+# same values as doing the lot in one go.
+def smoothed_blocks(results_store, entropy_series, channel, parameters, block_size):
+
+    entropy_count = results_store.length(entropy_series, channel)
+
+    if parameters.show_differentiated_graph == True:
+        smoothing_window = parameters.size_of_window if parameters.allow_smoothening == True else 1
+        diff_window = parameters.size_of_window
+        block_size = math.ceil(block_size / math.lcm(smoothing_window, diff_window)) * math.lcm(smoothing_window, diff_window)
+        yield "entropy_arrays", np.zeros(0)
+        yield "diff_entropy_arrays", np.zeros(0)
+
+        for block_start in range(0, max(entropy_count - smoothing_window + 1, 0), block_size):
+            entropy_arrays = results_store.read(entropy_series, block_start, block_start + block_size + smoothing_window + diff_window - 1, channel)
+            entropy_averaged, _, diff_averaged, _ = RVE_function.entropy_smooth_and_differentiate(np.zeros(0), entropy_arrays, smoothing_window, 1, diff_window)
+            yield "entropy_arrays", entropy_averaged[:block_size]
+            yield "diff_entropy_arrays", diff_averaged[:block_size]
+        return
+
+    yield "entropy_arrays", np.zeros(0)
+
+    block_size = math.ceil(block_size / parameters.size_of_window) * parameters.size_of_window
+    for block_start in range(0, max(entropy_count - parameters.size_of_window + 1, 0), block_size):
+        entropy_arrays = results_store.read(entropy_series, block_start, block_start + block_size + parameters.size_of_window - 1, channel)
+        yield "entropy_arrays", RVE_function.entropy_window_averager(np.zeros(0), entropy_arrays, parameters.size_of_window)[0]
+
+# Samples per second of the time array load_whole_recording makes: the frequency, unless the time array is stretched
+# over the given duration.
+def time_axis_rate(parameters):
+
+    if parameters.duration is None:
+        return parameters.frequency
+
+    sample_count = int(parameters.duration * parameters.frequency)
+    if sample_count < 2:
+        return parameters.frequency
+
+    return (sample_count - 1) / parameters.duration
+
+# Loads the recording and builds its time array, cut down to the offset if there is one. If duration is set the
+# recording is trimmed to duration * frequency samples, like the GUI's time axis.
+def load_recording(file_path, parameters):
+
+    time_signal, signal = load_whole_recording(file_path, parameters)
+    offset_start, offset_finish = offset_range(np.shape(signal)[-1], parameters)
+
+    return time_signal[offset_start:offset_finish], signal[..., offset_start:offset_finish]
+
+# load_recording before the offset is applied.
+def load_whole_recording(file_path, parameters):
+
+    signal = RVE_loader.load_signal(file_path)
+    sample_count = np.shape(signal)[-1]
+
+    if parameters.duration is None:
+        time_signal = np.arange(sample_count) / parameters.frequency
+    else:
+        time_signal = np.linspace(0, parameters.duration, int(parameters.duration * parameters.frequency))
+        signal = signal[..., :np.size(time_signal)]
+        time_signal = time_signal[:np.shape(signal)[-1]]
+
+    return time_signal, signal
+
+# The (start, finish) samples of the whole recording the offset keeps, the whole lot if there's no offset. Same
+# meaning as slicing with [offset_start:offset_finish], so negative or too big values work the same way.
+def offset_range(sample_count, parameters):
+
+    # This will section the graph (If needed at all)
+    if parameters.allow_offset == True:
+        offset_start, offset_finish, _ = slice(parameters.offset_start, parameters.offset_finish).indices(sample_count)
+        return offset_start, max(offset_finish, offset_start)
+
+    return 0, sample_count
+
+# The entropy one step at a time: every epsilon step for a composite, otherwise every chunk. Yields (steps done, total
+# steps, entropy so far, time so far) like the progressive functions in RVE_function, the last one is the answer.
+def entropy_steps(time_signal, signal, parameters, result_cache = None):
+
+    rve = RVE_function if result_cache is None else result_cache
+
+    if parameters.allow_composite == True:
+        return rve.rve_frequency_averager_progressive(time_signal, signal, parameters.frequency, parameters.frequency_crits_min,
+                                                      parameters.frequency_crits_max, parameters.frequency_crits_step, parameters.τ_const,
+                                                      parameters.samples_per_window, parameters.engine, parameters.chunk_size,
+                                                      dtype=np.dtype(parameters.dtype))
+
+    return rve.rve_of_singal_progressive(time_signal, signal, parameters.frequency, parameters.τ_const, parameters.epsilon_step,
+                                         parameters.samples_per_window, parameters.engine, parameters.chunk_size or 65536, np.dtype(parameters.dtype))
+
+# Smoothing and the differentiated graph, whichever of them the parameters ask for. Returns the (maybe smoothened)
+# entropy and its time, then the differentiated entropy and its time (both None if it isn't wanted).
+def smooth_and_differentiate(entropy_time, entropy_arrays, parameters):
+
+    # When the differentiated graph is wanted as well both are done in the one pass (a window of 1 means no smoothing first).
+    diff_entropy_arrays, diff_entropy_time = None, None
+    if parameters.show_differentiated_graph == True:
+        smoothing_window = parameters.size_of_window if parameters.allow_smoothening == True else 1
+        entropy_arrays, entropy_time, diff_entropy_arrays, diff_entropy_time = RVE_function.entropy_smooth_and_differentiate(
+            entropy_time, entropy_arrays, smoothing_window, 1, parameters.size_of_window)
+    elif parameters.allow_smoothening == True:
+        entropy_arrays, entropy_time = RVE_function.entropy_window_averager(entropy_time, entropy_arrays, parameters.size_of_window)
+
+    return entropy_arrays, entropy_time, diff_entropy_arrays, diff_entropy_time
+
+# Saves the entropy results of run_pipeline as a compressed .npz (via a temporary file), along with the parameters as
+# JSON. The signal itself isn't saved, it's already in the recording.
+def save_results(output_path, pipeline_results, parameters):
+
+    saved_arrays = {result_name: pipeline_results[result_name]
+                    for result_name in ("entropy_arrays", "entropy_time", "diff_entropy_arrays", "diff_entropy_time")
+                    if pipeline_results[result_name] is not None}
+    saved_arrays["parameters"] = np.array(json.dumps(parameters.as_dict(), ensure_ascii=False))
+
+    temporary_path = f"{output_path}.tmp"
+    with open(temporary_path, "wb") as output_file:
+        np.savez_compressed(output_file, **saved_arrays)
+    os.replace(temporary_path, output_path)
+
+# The names used in Fourier_Filtering/instructions.txt (lower case, spaces taken out) and the parameters they set.
+PARAMETER_NAMES = {
+    "freq": "frequency",
+    "frequency": "frequency",
+    "time": "duration",
+    "critfreqstart": "frequency_crits_min",
+    "critfreqend": "frequency_crits_max",
+    "critfreqstep": "frequency_crits_step",
+    "critfreq": "critical_frequency",
+    "epsstep": "epsilon_step",
+    "t_const": "τ_const",
+    "samples_per_window": "samples_per_window",
+    "offsetstart": "offset_start",
+    "offsetend": "offset_finish",
+    "smoothingwindow": "size_of_window",
+    "engine": "engine",
+    "chunksize": "chunk_size",
+    "dtype": "dtype",
+}
+
+# Lines that switch an option on.
+PARAMETER_FLAGS = {
+    "compositegraph": "allow_composite",
+    "smoothened": "allow_smoothening",
+    "differentiated": "show_differentiated_graph",
+}
+
+# Reads a parameter file written like Fourier_Filtering/instructions.txt:
+#
+#   signal.mat                  a line with just a file name starts the settings for that recording
+#   Freq = 1200
+#   time = 40s (Required)       only the first number counts, anything after it is a comment
+#   CritFreqStart=6
+#   COMPOSITE GRAPH             flags: COMPOSITE GRAPH, Smoothened, Differentiated
+#
+# Settings before the first file name apply to every recording without its own section. CritFreq on its own picks the
+# epsilon step ceil(Freq / 2 CritFreq), EpsStep sets it directly. Returns {file name in lower case (None for the
+# settings for everything): RVEParameters}.
+def read_parameter_file(file_path):
+
+    with open(file_path, "r", encoding="utf-8", errors="replace") as parameter_file:
+        parameter_lines = parameter_file.read().splitlines()
+
+    section_settings = {}
+    section_name = None
+    for line_number, line in enumerate(parameter_lines, start=1):
+        line = line.strip()
+        if not line or line.endswith(":"):
+            continue
+
+        if "=" in line:
+            name, value = line.split("=", 1)
+            name = name.strip().lower().replace(" ", "")
+            if name not in PARAMETER_NAMES:
+                raise ValueError(f"{file_path}:{line_number}: unknown parameter {name!r}")
+            section_settings.setdefault(section_name, {})[PARAMETER_NAMES[name]] = parameter_value(value, file_path, line_number)
+            continue
+
+        flag = line.lower().replace(" ", "")
+        if flag in PARAMETER_FLAGS:
+            section_settings.setdefault(section_name, {})[PARAMETER_FLAGS[flag]] = True
+        elif " " not in line and "." in line:
+            section_name = line.lower()
+            section_settings.setdefault(section_name, {})
+        else:
+            raise ValueError(f"{file_path}:{line_number}: can't make sense of {line!r}")
+
+    return {section_name: parameters_from_settings(settings) for section_name, settings in section_settings.items()}
+
+# The first number in the value (so "40s (Required)" is 40), or the first word if it isn't a number (engine names).
+def parameter_value(value, file_path, line_number):
+
+    value = value.strip()
+    number = re.match(r"[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?", value)
+    if number is None:
+        if not value:
+            raise ValueError(f"{file_path}:{line_number}: missing value")
+        return value.split()[0]
+
+    number = number.group(0)
+    if re.fullmatch(r"[-+]?\d+", number):
+        return int(number)
+    return float(number)
+
+def parameters_from_settings(settings):
+
+    settings = dict(settings)
+    critical_frequency = settings.pop("critical_frequency", None)
+    parameters = RVEParameters(**settings)
+
+    if critical_frequency is not None and "epsilon_step" not in settings:
+        parameters.epsilon_step = math.ceil(parameters.frequency / (2 * critical_frequency))
+    if "offset_start" in settings or "offset_finish" in settings:
+        parameters.allow_offset = True
+
+    return parameters
+
+# The parameters for one recording: its own section if the file has one, otherwise the settings for everything.
+def parameters_for_recording(parameter_sections, file_path):
+
+    file_name = os.path.basename(file_path).lower()
+    if file_name in parameter_sections:
+        return parameter_sections[file_name]
+    if None in parameter_sections:
+        return parameter_sections[None]
+
+    raise ValueError(f"No parameters for {file_path}, and no settings for everything at the top of the parameter file")
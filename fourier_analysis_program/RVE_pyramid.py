@@ -0,0 +1,88 @@
+import numpy as np
+
+# A multi-resolution copy of a (time, value) curve for plotting. Level k splits the curve into buckets of 2^k samples
+# and keeps the index of the smallest and largest value in each bucket, so however far out you zoom every spike and
+# dip is still drawn. Built once per result, O(N) time and memory.
+class MinMaxPyramid:
+    def __init__(self, x_values, y_values):
+
+        self.x_values = np.asarray(x_values)
+        self.y_values = np.asarray(y_values)
+
+        # Level 0 is the curve itself, every bucket is one sample.
+        level_min = np.arange(np.size(self.y_values))
+        level_max = level_min
+        self.levels = [(level_min, level_max)]
+
+        # Each level joins neighbouring buckets of the one below in pairs.
+        while np.size(level_min) > 1:
+            if np.size(level_min) % 2 == 1:
+                level_min = np.append(level_min, level_min[-1])
+                level_max = np.append(level_max, level_max[-1])
+            left_min, right_min = level_min[0::2], level_min[1::2]
+            left_max, right_max = level_max[0::2], level_max[1::2]
+            level_min = np.where(self.y_values[left_min] <= self.y_values[right_min], left_min, right_min)
+            level_max = np.where(self.y_values[left_max] >= self.y_values[right_max], left_max, right_max)
+            self.levels.append((level_min, level_max))
+
+    # The points worth drawing between x_start and x_finish when there is room for pixel_width points across.
+    # Picks the level with about one bucket per pixel and draws each bucket's min and max in the order they happened.
+    def visible_points(self, x_start, x_finish, pixel_width):
+
+        sample_count = np.size(self.y_values)
+        if sample_count == 0:
+            return self.x_values[:0], self.y_values[:0]
+
+        # One sample either side so the line runs off the edge of the axes rather than stopping short of it.
+        first_index = max(np.searchsorted(self.x_values, x_start) - 1, 0)
+        last_index = min(np.searchsorted(self.x_values, x_finish, side="right") + 1, sample_count)
+        if last_index <= first_index:
+            return self.x_values[:0], self.y_values[:0]
+
+        visible_samples = last_index - first_index
+        level = int(np.floor(np.log2(visible_samples / max(pixel_width, 1)))) if visible_samples > pixel_width else 0
+        level = min(level, len(self.levels) - 1)
+
+        if level == 0:
+            point_indices = np.arange(first_index, last_index)
+        else:
+            level_min, level_max = self.levels[level]
+            first_bucket = first_index >> level
+            last_bucket = min(((last_index - 1) >> level) + 1, np.size(level_min))
+            point_indices = np.concatenate((level_min[first_bucket:last_bucket], level_max[first_bucket:last_bucket],
+                                            [first_index, last_index - 1]))
+            point_indices = np.unique(point_indices)
+            point_indices = point_indices[(point_indices >= first_index) & (point_indices < last_index)]
+
+        return self.x_values[point_indices], self.y_values[point_indices]
+
+# A Line2D that only ever holds about as many points as its axes are pixels wide. It follows the axes' x limits, so
+# zooming or panning with the NavigationToolbar just swaps the line's data for the matching level of its pyramid.
+class LevelOfDetailLine:
+    def __init__(self, axes, *plot_args, **plot_kwargs):
+
+        self.axes = axes
+        self.line, = axes.plot([], [], *plot_args, **plot_kwargs)
+        self.pyramid = MinMaxPyramid(np.zeros(0), np.zeros(0))
+
+        axes.callbacks.connect("xlim_changed", self.update_visible)
+
+    # New data for the line, the pyramid is rebuilt here and nowhere else.
+    def set_data(self, x_values, y_values):
+
+        self.pyramid = MinMaxPyramid(x_values, y_values)
+        if np.size(self.pyramid.x_values) == 0:
+            self.line.set_data([], [])
+            return
+
+        # Everything at first, so relim/autoscale sees the whole extent.
+        self.line.set_data(*self.pyramid.visible_points(self.pyramid.x_values[0], self.pyramid.x_values[-1], self.pixel_width()))
+
+    def update_visible(self, axes = None):
+
+        x_start, x_finish = self.axes.get_xlim()
+        self.line.set_data(*self.pyramid.visible_points(x_start, x_finish, self.pixel_width()))
+
+    def pixel_width(self):
+
+        return max(int(self.axes.get_window_extent().width), 1)
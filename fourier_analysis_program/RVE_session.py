@@ -0,0 +1,309 @@
+import copy
+import math
+import os
+import numpy as np
+
+import RVE_cache
+import RVE_function
+import RVE_pipeline
+
+# Keeps one recording's analysis in memory for the GUI, so editing the parameters only redoes the stages the edit
+# actually touches. The stages, and what each one depends on:
+#
+#   recording       the file (its size and modification time too), frequency, duration
+#   pattern codes   recording, epsilon_step, samples_per_window (one set per epsilon step, over the whole recording)
+#   scale entropy   pattern codes, τ_const, engine, dtype, offset_start (one per epsilon step, grown as far as it's needed)
+#   entropy         the scale entropies, epsilon_step or the composite settings, offset_finish
+#   smoothing       entropy, allow_smoothening, show_differentiated_graph, size_of_window
+#
+# So toggling smoothing or the differentiated graph only redoes the smoothing. Pulling offset_finish in is a slice of
+# the entropy already worked out, and pushing it out carries the histogram on from where it stopped. A new
+# offset_start does run the entropy loop again, since the histogram starts fresh at the offset, but the windowing and
+# argsort are reused. With a chunk_size (always, for a single step) the answers are exactly those of
+# RVE_pipeline.run_pipeline_on_signal on the cut recording. Without one the pipeline does each epsilon step in one go,
+# so a composite carried on past an old offset_finish agrees with it to about 1e-14 rather than exactly (the
+# incremental engine's running totals are rebuilt wherever a run stops). The lfilter engine adds up each chunk as one
+# block, so its rounding depends on where the chunk ends and a sliced result agrees to about 1e-15. Steps from
+# result_cache are only ever ones worked out with the same chunk_size, so they don't change any of this.
+# Single channel recordings only. result_cache is an optional RVE_cache.RVEResultCache, checked before an epsilon
+# step is worked out from scratch and filled with every step that gets worked out.
+class AnalysisSession:
+    def __init__(self, result_cache = None):
+
+        self.result_cache = result_cache
+        self.clear()
+
+    # Forgets every stage.
+    def clear(self):
+
+        self.recording_key = None
+        self.whole_time_signal = None
+        self.whole_signal = None
+
+        # (epsilon_step, samples_per_window): bin numbers of every window in the whole recording.
+        self.pattern_codes = {}
+
+        # (epsilon_step, samples_per_window, chunk_size): ScaleEntropy, all for the same scale_inputs.
+        self.scale_results = {}
+        self.scale_inputs = None
+
+        self.entropy_key = None
+        self.entropy_result = None
+        self.smoothing_key = None
+        self.smoothing_result = None
+
+        # The hash the result cache knows the cut recording by, worked out the first time it's needed.
+        self.cut_hash_key = None
+        self.cut_hash = None
+
+        # Names of the stages the last run actually had to work out, the rest were reused.
+        self.stages_worked_out = []
+
+    # The whole pipeline, with every stage reused where it can be. Returns the same dictionary as
+    # RVE_pipeline.run_pipeline_on_signal.
+    def run(self, file_path, parameters):
+
+        self.load(file_path, parameters)
+        for _ in self.entropy_steps(parameters):
+            pass
+
+        return self.results(parameters)
+
+    # The recording stage. Loads the file unless it (and the frequency and duration) are the same as last time, and
+    # hands back the time and signal cut down to the offset. Starts a new run as far as stages_worked_out goes.
+    def load(self, file_path, parameters):
+
+        self.stages_worked_out = []
+
+        file_stats = os.stat(file_path)
+        recording_key = (os.path.abspath(file_path), file_stats.st_size, file_stats.st_mtime_ns, parameters.frequency, parameters.duration)
+        if recording_key != self.recording_key:
+            whole_time_signal, whole_signal = RVE_pipeline.load_whole_recording(file_path, parameters)
+            if np.ndim(whole_signal) != 1:
+                raise ValueError(f"{file_path} has more than one channel, use RVE_pipeline.run_pipeline for those")
+
+            self.clear()
+            self.recording_key = recording_key
+            self.whole_time_signal, self.whole_signal = whole_time_signal, whole_signal
+            self.stages_worked_out.append("recording")
+
+        return self.cut_recording(parameters)
+
+    # The entropy stage, one step at a time like RVE_pipeline.entropy_steps: yields (steps done, total steps, entropy
+    # so far, time so far) and the last one is the answer. Needs load first. Stopping part way through is fine, every
+    # chunk that finished is kept.
+    def entropy_steps(self, parameters):
+
+        offset_start, offset_finish = RVE_pipeline.offset_range(np.size(self.whole_signal), parameters)
+        time_signal, signal = self.cut_recording(parameters)
+
+        if parameters.allow_composite == True:
+            entropy_settings = ("composite", parameters.frequency_crits_min, parameters.frequency_crits_max, parameters.frequency_crits_step)
+        else:
+            entropy_settings = ("single", parameters.epsilon_step)
+        dtype = np.dtype(parameters.dtype)
+        entropy_key = (self.recording_key, offset_start, offset_finish, parameters.τ_const, parameters.samples_per_window,
+                       parameters.engine, dtype, entropy_settings)
+
+        if entropy_key == self.entropy_key:
+            yield 1, 1, self.entropy_result[0], self.entropy_result[1]
+            return
+
+        self.stages_worked_out.append("entropy")
+
+        # Every epsilon step's entropy from the offset on, in the shape the progressive functions want.
+        def scale_entropy(signal, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype):
+
+            scale_steps = self.scale_entropy_steps(offset_start, offset_finish, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype)
+            entropy_arrays = np.zeros(0)
+            for _, _, entropy_arrays in scale_steps:
+                pass
+
+            return entropy_arrays
+
+        if parameters.allow_composite == True:
+            entropy_steps = RVE_function.rve_frequency_averager_progressive(time_signal, signal, parameters.frequency, parameters.frequency_crits_min,
+                                                                            parameters.frequency_crits_max, parameters.frequency_crits_step,
+                                                                            parameters.τ_const, parameters.samples_per_window, parameters.engine,
+                                                                            parameters.chunk_size, scale_entropy, dtype)
+        else:
+            entropy_steps = ((windows_done, total_windows, entropy_arrays, time_signal[:windows_done])
+                             for windows_done, total_windows, entropy_arrays in
+                             self.scale_entropy_steps(offset_start, offset_finish, parameters.frequency, parameters.τ_const, parameters.epsilon_step,
+                                                      parameters.samples_per_window, parameters.engine, parameters.chunk_size or 65536, dtype))
+
+        entropy_arrays, entropy_time = np.zeros(0), time_signal[:0]
+        for steps_done, total_steps, entropy_arrays, entropy_time in entropy_steps:
+            yield steps_done, total_steps, entropy_arrays, entropy_time
+
+        self.entropy_key = entropy_key
+        self.entropy_result = (entropy_arrays, entropy_time)
+
+    # The smoothing stage, on the entropy from the last entropy_steps. Returns the same four things as
+    # RVE_pipeline.smooth_and_differentiate.
+    def smooth_and_differentiate(self, parameters):
+
+        smoothing_key = (self.entropy_key, parameters.allow_smoothening, parameters.show_differentiated_graph, parameters.size_of_window)
+        if smoothing_key != self.smoothing_key:
+            self.stages_worked_out.append("smoothing")
+            self.smoothing_result = RVE_pipeline.smooth_and_differentiate(self.entropy_result[1], self.entropy_result[0], parameters)
+            self.smoothing_key = smoothing_key
+
+        return self.smoothing_result
+
+    # Everything draw_results needs, for the last load and entropy_steps.
+    def results(self, parameters):
+
+        time_signal, signal = self.cut_recording(parameters)
+        entropy_arrays, entropy_time, diff_entropy_arrays, diff_entropy_time = self.smooth_and_differentiate(parameters)
+
+        return {"time_signal": time_signal, "signal": signal, "frequency": parameters.frequency,
+                "entropy_arrays": entropy_arrays, "entropy_time": entropy_time,
+                "diff_entropy_arrays": diff_entropy_arrays, "diff_entropy_time": diff_entropy_time}
+
+    # The loaded recording cut down to the offset.
+    def cut_recording(self, parameters):
+
+        offset_start, offset_finish = RVE_pipeline.offset_range(np.size(self.whole_signal), parameters)
+
+        return self.whole_time_signal[offset_start:offset_finish], self.whole_signal[offset_start:offset_finish]
+
+    # The pattern codes stage for one epsilon step, worked out over the whole recording the first time it's asked for.
+    def pattern_codes_for(self, epsilon_step, samples_per_window):
+
+        codes_key = (int(epsilon_step), int(samples_per_window))
+        if codes_key not in self.pattern_codes:
+            self.stages_worked_out.append(f"pattern codes (ε={codes_key[0]})")
+            self.pattern_codes[codes_key] = RVE_function.rve_pattern_codes(self.whole_signal, epsilon_step, samples_per_window)
+
+        return self.pattern_codes[codes_key]
+
+    # The scale entropy stage for one epsilon step of the recording cut to [offset_start, offset_finish). Yields
+    # (windows done, total windows, entropy so far) after every chunk_size windows. Whatever was already worked out
+    # from the same offset_start is sliced or carried on from rather than done again.
+    def scale_entropy_steps(self, offset_start, offset_finish, frequency, τ_const, epsilon_step, samples_per_window, engine = "incremental", chunk_size = None, dtype = np.float64):
+
+        window_span = (samples_per_window - 1) * epsilon_step + 1
+        total_windows = max(offset_finish - offset_start - window_span + 1, 0)
+
+        # Every scale entropy kept was worked out with these, anything else starts them all over.
+        scale_inputs = (offset_start, frequency, τ_const, engine, np.dtype(dtype))
+        if scale_inputs != self.scale_inputs:
+            self.scale_results = {}
+            self.scale_inputs = scale_inputs
+
+        scale_key = (int(epsilon_step), int(samples_per_window), chunk_size)
+        scale_result = self.scale_results.get(scale_key)
+        if scale_result is None or (scale_result.windows_done < total_windows and scale_result.histy_stuff is None):
+            scale_result = self.cached_scale_entropy(offset_start, offset_finish, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype, total_windows)
+        if scale_result is None:
+            scale_result = ScaleEntropy(RVE_function.new_histogram(math.factorial(samples_per_window), engine, dtype), dtype=dtype)
+        self.scale_results[scale_key] = scale_result
+
+        if scale_result.windows_done >= total_windows:
+            yield total_windows, total_windows, scale_result.entropy_arrays(total_windows)
+            return
+
+        # A fresh run cuts the windows into chunks at every chunk_size, and where the cuts are changes the incremental
+        # engine's rounding. So a last chunk the old offset_finish cut short is done again from where it started.
+        if chunk_size is not None and scale_result.windows_done % chunk_size != 0:
+            scale_result.back_to_chunk_start()
+
+        self.stages_worked_out.append(f"scale entropy (ε={scale_key[0]})")
+        pattern_codes = self.pattern_codes_for(epsilon_step, samples_per_window)
+        alpha_filter = np.exp(-1 / (frequency * τ_const))
+        total_bins = math.factorial(samples_per_window)
+
+        scale_result.reserve(total_windows)
+        for chunk_start in range(scale_result.windows_done, total_windows, chunk_size or total_windows):
+            chunk_finish = min(chunk_start + (chunk_size or total_windows), total_windows)
+
+            # The kernels leave histy_stuff where they finished, so the next chunk (or a later, longer run) picks up from it.
+            if chunk_size is not None and chunk_finish % chunk_size != 0:
+                scale_result.keep_chunk_start()
+            chunk_codes = pattern_codes[offset_start + chunk_start:offset_start + chunk_finish]
+            scale_result.append(RVE_function.rve_entropy_kernel(chunk_codes, scale_result.histy_stuff, alpha_filter, total_bins, engine))
+
+            yield chunk_finish, total_windows, scale_result.entropy_arrays(chunk_finish)
+
+        if self.result_cache is not None:
+            self.result_cache.store(self.scale_cache_key(offset_start, offset_finish, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype),
+                                    scale_result.entropy_arrays(total_windows), self.whole_time_signal[offset_start:offset_start + total_windows])
+
+    # A ScaleEntropy from the result cache if it has this exact step, otherwise None. Those can only be sliced.
+    def cached_scale_entropy(self, offset_start, offset_finish, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype, total_windows):
+
+        if self.result_cache is None:
+            return None
+
+        cached_result = self.result_cache.load(self.scale_cache_key(offset_start, offset_finish, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype))
+        if cached_result is None or np.size(cached_result[0]) != total_windows:
+            return None
+
+        return ScaleEntropy(None, cached_result[0])
+
+    # The key RVE_cache.RVEResultCache keeps this step under, the same one RVE_pipeline's runs use (chunk_size included
+    # whenever it splits the windows up, so a cached step is always the exact answer for this chunk_size).
+    def scale_cache_key(self, offset_start, offset_finish, frequency, τ_const, epsilon_step, samples_per_window, engine, chunk_size, dtype):
+
+        cut_hash_key = (self.recording_key, offset_start, offset_finish)
+        if cut_hash_key != self.cut_hash_key:
+            self.cut_hash = RVE_cache.hash_signal_and_time(self.whole_time_signal[offset_start:offset_finish], self.whole_signal[offset_start:offset_finish])
+            self.cut_hash_key = cut_hash_key
+
+        return RVE_cache.scale_cache_key(self.cut_hash, frequency, τ_const, epsilon_step, samples_per_window, engine, dtype,
+                                         RVE_cache.key_chunk_size(offset_finish - offset_start, epsilon_step, samples_per_window, chunk_size))
+
+# One epsilon step's entropy from the offset on, along with the histogram it finished on so it can be carried on.
+# histy_stuff is None for results that came from the result cache. The entropy lives in a buffer that doubles when it
+# fills up, so carrying on a chunk at a time doesn't copy everything each time. If the last chunk was cut short, a copy
+# of the histogram from its start is kept too so it can be done again in full.
+class ScaleEntropy:
+    def __init__(self, histy_stuff, entropy_arrays = None, dtype = np.float64):
+
+        self.histy_stuff = histy_stuff
+        self.entropy_buffer = np.zeros(0, dtype) if entropy_arrays is None else np.asarray(entropy_arrays)
+        self.windows_done = np.size(self.entropy_buffer)
+
+        self.chunk_start_histy_stuff = None
+        self.chunk_start_windows = 0
+
+    # Remembers the histogram before a chunk that stops short of a full chunk_size.
+    def keep_chunk_start(self):
+
+        self.chunk_start_histy_stuff = copy.deepcopy(self.histy_stuff)
+        self.chunk_start_windows = self.windows_done
+
+    # Drops the short chunk, back to the histogram keep_chunk_start remembered. The buffer is copied so the views handed
+    # out before still don't change.
+    def back_to_chunk_start(self):
+
+        if self.chunk_start_histy_stuff is None:
+            return
+
+        self.entropy_buffer = self.entropy_buffer.copy()
+        self.histy_stuff = self.chunk_start_histy_stuff
+        self.windows_done = self.chunk_start_windows
+        self.chunk_start_histy_stuff = None
+
+    # The first window_count values. A view, later appends don't change it.
+    def entropy_arrays(self, window_count):
+
+        return self.entropy_buffer[:window_count]
+
+    # Makes room for window_count values in total.
+    def reserve(self, window_count):
+
+        if window_count > np.size(self.entropy_buffer):
+            grown_buffer = np.zeros(window_count, self.entropy_buffer.dtype)
+            grown_buffer[:self.windows_done] = self.entropy_buffer[:self.windows_done]
+            self.entropy_buffer = grown_buffer
+
+    def append(self, chunk_entropy):
+
+        windows_after = self.windows_done + np.size(chunk_entropy)
+        if windows_after > np.size(self.entropy_buffer):
+            self.reserve(max(windows_after, 2 * np.size(self.entropy_buffer)))
+
+        self.entropy_buffer[self.windows_done:windows_after] = chunk_entropy
+        self.windows_done = windows_after
@@ -0,0 +1,254 @@
+import json
+import math
+import os
+import numpy as np
+
+# Samples per chunk file, 1M (8 MB a chunk in float64).
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Name of the header inside a store folder.
+HEADER_NAME = "store.json"
+
+STORE_FORMAT = 1
+
+# Results of a run kept on disk in a folder, so an hour long multi-channel recording doesn't have to sit in RAM and can
+# be opened again without working it out again. Every result (entropy_arrays, diff_entropy_arrays, ...) is a series
+# with a row per channel, split into .npy files of chunk_size samples that are memory-mapped when read, so reading a
+# range only touches the chunks it covers. No time arrays are stored: sample i of every series is at
+# (start_sample + i) / sample_rate seconds, the same as the time array the pipeline would have handed back.
+#
+# Values are appended while they are worked out. The header (store.json) says how much of each series there is and is
+# only rewritten once the chunks are flushed, so anyone reading the store at the same time never sees half written
+# values. Use create_store and open_store rather than making one of these directly.
+class ResultsStore:
+    def __init__(self, store_path, header, writable = False):
+
+        self.store_path = store_path
+        self.header = header
+        self.writable = writable
+
+        self.frequency = header["frequency"]
+        self.sample_rate = header["sample_rate"]
+        self.start_sample = header["start_sample"]
+        self.sample_count = header["sample_count"]
+        self.channel_count = header["channel_count"]
+        self.chunk_size = header["chunk_size"]
+        self.dtype = np.dtype(header["dtype"])
+        self.parameters = header["parameters"]
+
+        # (series name, channel, chunk number): memory-mapped chunk, opened the first time it is needed. Chunks that
+        # have been filled up are let go of once they are flushed, so only the ones still being written stay open.
+        self.open_chunks = {}
+        # Keys of the chunks written to since the last flush.
+        self.unflushed_chunks = set()
+
+    # Names of every series in the store.
+    def series_names(self):
+
+        return list(self.header["series"])
+
+    # How many samples of the series there are for the channel (0 if there isn't a series by that name yet).
+    def length(self, series_name, channel = 0):
+
+        return self.header["series"].get(series_name, [0] * self.channel_count)[channel]
+
+    # Adds values onto the end of the series for one channel, then flushes. values is 1-D, or for every channel at
+    # once 2-D with a row per channel (channel left as None). Values are stored in the store's dtype.
+    def append(self, series_name, values, channel = None):
+
+        if not self.writable:
+            raise ValueError(f"{self.store_path} was opened read only")
+
+        values = np.asarray(values)
+        if channel is None and np.ndim(values) == 2:
+            if np.shape(values)[0] != self.channel_count:
+                raise ValueError(f"Expected {self.channel_count} rows (one per channel), got {np.shape(values)[0]}")
+            for channel_number, channel_values in enumerate(values):
+                self.append_channel(series_name, channel_values, channel_number)
+        else:
+            self.append_channel(series_name, values, 0 if channel is None else channel)
+
+        self.flush()
+
+    def append_channel(self, series_name, values, channel):
+
+        series_lengths = self.header["series"].setdefault(series_name, [0] * self.channel_count)
+        values = np.ravel(values)
+
+        values_done = 0
+        while values_done < np.size(values):
+            chunk_number, chunk_start = divmod(series_lengths[channel], self.chunk_size)
+            values_taken = min(self.chunk_size - chunk_start, np.size(values) - values_done)
+            chunk = self.chunk(series_name, channel, chunk_number)
+            chunk[chunk_start:chunk_start + values_taken] = values[values_done:values_done + values_taken]
+            self.unflushed_chunks.add((series_name, channel, chunk_number))
+            series_lengths[channel] += values_taken
+            values_done += values_taken
+
+    # Makes sure everything appended is on disk, then rewrites the header (via a temporary file) with the new lengths.
+    # Only the chunks written to since the last flush are flushed, so it costs the same however long the series are.
+    def flush(self):
+
+        if not self.writable:
+            return
+
+        for chunk_key in self.unflushed_chunks:
+            self.open_chunks[chunk_key].flush()
+            series_name, channel, chunk_number = chunk_key
+            if self.length(series_name, channel) >= (chunk_number + 1) * self.chunk_size:
+                del self.open_chunks[chunk_key]
+        self.unflushed_chunks = set()
+
+        write_header(self.store_path, self.header)
+
+    # Picks up whatever has been appended since the store was opened, for a reader following a run that's still going.
+    def refresh(self):
+
+        if not self.writable:
+            self.header = open_store(self.store_path).header
+
+    # Values start to finish (like [start:finish], so None means the end and negative counts back from it) of the
+    # series. With channel left as None a single channel store gives a 1-D array and otherwise a row per channel, like
+    # RVE_pipeline.run_pipeline. Only the chunks that cover the range are read.
+    def read(self, series_name, start = 0, finish = None, channel = None):
+
+        if series_name not in self.header["series"]:
+            raise KeyError(f"No series {series_name!r} in {self.store_path}")
+
+        if channel is not None:
+            return self.read_channel(series_name, start, finish, channel)
+        if self.channel_count == 1:
+            return self.read_channel(series_name, start, finish, 0)
+
+        channel_values = [self.read_channel(series_name, start, finish, channel_number) for channel_number in range(self.channel_count)]
+        shortest = min(np.size(values) for values in channel_values)
+
+        return np.stack([values[:shortest] for values in channel_values])
+
+    def read_channel(self, series_name, start, finish, channel):
+
+        start, finish, _ = slice(start, finish).indices(self.length(series_name, channel))
+        finish = max(finish, start)
+
+        chunk_values = []
+        sample = start
+        while sample < finish:
+            chunk_number, chunk_start = divmod(sample, self.chunk_size)
+            values_taken = min(self.chunk_size - chunk_start, finish - sample)
+            chunk_values.append(self.chunk(series_name, channel, chunk_number)[chunk_start:chunk_start + values_taken])
+            sample += values_taken
+
+        if not chunk_values:
+            return np.zeros(0, dtype=self.dtype)
+
+        return np.concatenate(chunk_values)
+
+    # The times of samples start to finish (same meaning as for read), worked out rather than stored.
+    def times(self, series_name, start = 0, finish = None, channel = 0):
+
+        start, finish, _ = slice(start, finish).indices(self.length(series_name, channel))
+
+        return (self.start_sample + np.arange(start, max(finish, start))) / self.sample_rate
+
+    # Every sample of the series between time_start and time_finish seconds (both included), and their times. For the
+    # GUI and anything else that only wants to look at part of a long recording.
+    def read_time_range(self, series_name, time_start, time_finish, channel = None):
+
+        start = self.samples_before(time_start)
+        finish = self.samples_before(time_finish, include_equal=True)
+        start, finish = max(start, 0), max(finish, start, 0)
+
+        values = self.read(series_name, start, finish, channel)
+
+        return values, self.times(series_name, start, start + np.shape(values)[-1], 0 if channel is None else channel)
+
+    # How many samples come before time_value (or are at it too, with include_equal), counted from sample 0 of the
+    # series. A guess from the sample rate, nudged so it agrees with the times the store hands out.
+    def samples_before(self, time_value, include_equal = False):
+
+        sample = math.ceil(time_value * self.sample_rate) - self.start_sample
+
+        def counted(sample):
+            sample_time = (self.start_sample + sample) / self.sample_rate
+            return sample_time <= time_value if include_equal else sample_time < time_value
+
+        while counted(sample):
+            sample += 1
+        while sample > 0 and counted(sample - 1) == False:
+            sample -= 1
+
+        return sample
+
+    # The memory-mapped chunk, made (full size, zeroed) if it's being written and doesn't exist yet.
+    def chunk(self, series_name, channel, chunk_number):
+
+        chunk_key = (series_name, channel, chunk_number)
+        if chunk_key not in self.open_chunks:
+            chunk_path = os.path.join(self.store_path, f"{series_name}.{channel}.{chunk_number:06d}.npy")
+            if self.writable and not os.path.exists(chunk_path):
+                self.open_chunks[chunk_key] = np.lib.format.open_memmap(chunk_path, mode="w+", dtype=self.dtype, shape=(self.chunk_size,))
+            else:
+                self.open_chunks[chunk_key] = np.load(chunk_path, mmap_mode="r+" if self.writable else "r")
+
+        return self.open_chunks[chunk_key]
+
+    # Flushes (if writable) and lets go of the memory maps.
+    def close(self):
+
+        self.flush()
+        self.open_chunks = {}
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exception_details):
+
+        self.close()
+
+# Makes a new, empty store folder (emptying the store that was there, if there was one). sample_rate is the samples per
+# second of the time axis (frequency unless the time array was stretched to a given duration) and start_sample is the
+# sample of the recording the results start at (the offset start). sample_count is how long the (cut down) signal was,
+# and parameters is saved along with it as a dictionary.
+def create_store(store_path, frequency, sample_rate = None, start_sample = 0, sample_count = None, channel_count = 1,
+                 dtype = np.float64, chunk_size = DEFAULT_CHUNK_SIZE, parameters = None):
+
+    os.makedirs(store_path, exist_ok=True)
+    for file_name in os.listdir(store_path):
+        if file_name == HEADER_NAME or file_name.endswith(".npy"):
+            os.remove(os.path.join(store_path, file_name))
+
+    header = {
+        "format": STORE_FORMAT,
+        "frequency": frequency,
+        "sample_rate": frequency if sample_rate is None else sample_rate,
+        "start_sample": int(start_sample),
+        "sample_count": None if sample_count is None else int(sample_count),
+        "channel_count": int(channel_count),
+        "chunk_size": int(chunk_size),
+        "dtype": np.dtype(dtype).name,
+        "parameters": parameters,
+        "series": {},
+    }
+    write_header(store_path, header)
+
+    return ResultsStore(store_path, header, writable=True)
+
+# Opens a store made by create_store. Read only unless writable, which is for carrying on appending to it.
+def open_store(store_path, writable = False):
+
+    with open(os.path.join(store_path, HEADER_NAME), "r", encoding="utf-8") as header_file:
+        header = json.load(header_file)
+
+    if header.get("format") != STORE_FORMAT:
+        raise ValueError(f"{store_path} isn't a results store this version can read")
+
+    return ResultsStore(store_path, header, writable)
+
+def write_header(store_path, header):
+
+    header_path = os.path.join(store_path, HEADER_NAME)
+    temporary_path = f"{header_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as header_file:
+        json.dump(header, header_file, ensure_ascii=False)
+    os.replace(temporary_path, header_path)
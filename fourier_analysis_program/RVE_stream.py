@@ -0,0 +1,189 @@
+import math
+import numpy as np
+
+import RVE_function
+
+# Keeps everything rve_of_singal needs between calls so a live signal can be fed in blocks as it arrives.
+# Each push(block) hands back only the entropy values that the new samples complete, at a constant cost per sample:
+# the decayed histogram carries on through RVE_function.incremental_rve and only the trailing
+# (samples_per_window - 1) * epsilon_step samples are held back to finish the windows that straddle two blocks.
+# Pushing a whole recording in blocks gives the same values as rve_of_singal on the whole recording (to within the
+# 1e-10 tolerance of the incremental engine), apart from the smoothing which has to wait for a full window of entropy.
+# The smoothing is a running sum carried between pushes (RVE_function.running_average_kernel), so it's constant cost
+# per sample too.
+class StreamingRVE:
+    def __init__(self, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, allow_smoothening = False, size_of_window = 400):
+
+        self.frequency = frequency
+        self.τ_const = τ_const
+        self.epsilon_step = epsilon_step
+        self.samples_per_window = samples_per_window
+        self.allow_smoothening = allow_smoothening
+        self.size_of_window = size_of_window
+
+        # α = exp(−1/fτ), same dampening as rve_of_singal.
+        self.total_bins = math.factorial(samples_per_window)
+        self.alpha_filter = np.exp(-1 / (frequency * τ_const))
+
+        self.reset()
+
+    # Throws away all the history, as if no samples had been pushed yet.
+    def reset(self):
+
+        # The histogram starts at 1 in every bin like rve_of_singal.
+        self.histy_stuff = np.ones(self.total_bins)
+
+        # Samples that do not have enough after them to make a full window yet.
+        self.window_span = (self.samples_per_window - 1) * self.epsilon_step + 1
+        self.trailing_signal = np.zeros(0)
+
+        # The last size_of_window entropy values and their running sum, to carry the smoothing across block boundaries.
+        self.entropy_ring = np.zeros(self.size_of_window)
+        self.window_sum = 0.0
+        self.entropy_values_seen = 0
+
+        # How many samples and entropy values have gone through so far, for working out times.
+        self.samples_pushed = 0
+        self.entropy_emitted = 0
+
+    # Feeds in the next block of samples and returns the new entropy values (smoothened if allow_smoothening is set).
+    def push(self, block):
+
+        block = np.asarray(block, dtype=np.float64).ravel()
+        self.samples_pushed += np.size(block)
+
+        signal = np.concatenate((self.trailing_signal, block))
+        if np.size(signal) < self.window_span:
+            self.trailing_signal = signal
+            return np.zeros(0)
+
+        pattern_codes = RVE_function.rve_pattern_codes(signal, self.epsilon_step, self.samples_per_window)
+        self.trailing_signal = signal[np.size(pattern_codes):]
+
+        # incremental_rve leaves histy_stuff decayed and counted up to the last window, ready for the next block.
+        entropy_arrays = RVE_function.incremental_rve(pattern_codes, self.histy_stuff, self.alpha_filter, self.total_bins,
+                                                      np.size(pattern_codes))
+
+        if self.allow_smoothening == True:
+            entropy_arrays = self.smoothen(entropy_arrays)
+
+        self.entropy_emitted += np.size(entropy_arrays)
+
+        return entropy_arrays
+
+    # Same moving average as entropy_window_averager, carried over block boundaries.
+    def smoothen(self, entropy_arrays):
+
+        entropy_averaged, self.window_sum = RVE_function.running_average_kernel(entropy_arrays, self.entropy_ring,
+                                                                                self.entropy_values_seen, self.window_sum)
+        self.entropy_values_seen += np.size(entropy_arrays)
+
+        return entropy_averaged
+
+    # Times that line up with the values returned by the last push, matching time_signal = index / frequency.
+    def latest_times(self, entropy_count):
+
+        return np.arange(self.entropy_emitted - entropy_count, self.entropy_emitted) / self.frequency
+
+# anomalous_point_finder for entropy that arrives in blocks (e.g. from StreamingRVE.push). The quartiles can't be
+# found exactly without keeping everything, so they come from a fixed size random sample of all the values seen so far
+# (reservoir sampling), which keeps each push O(block + reservoir_size) however long the recording runs. Each push
+# judges the new block against the fences of everything up to and including it and returns the anomalous indices
+# (counted from the first value ever pushed) and their times.
+class StreamingAnomalyFinder:
+    def __init__(self, fence_factor = 3, reservoir_size = 65536, seed = 0):
+
+        self.fence_factor = fence_factor
+        self.reservoir_size = reservoir_size
+        self.random_generator = np.random.default_rng(seed)
+
+        self.reservoir = np.zeros(reservoir_size)
+        # values_seen only counts the finite values that went through the reservoir, values_pushed counts everything.
+        self.values_seen = 0
+        self.values_pushed = 0
+
+    def push(self, entropy_block, time_block):
+
+        entropy_block = np.asarray(entropy_block, dtype=np.float64).ravel()
+        self.add_to_reservoir(entropy_block[np.isfinite(entropy_block)])
+
+        lower_fence, upper_fence = RVE_function.anomaly_fences(self.reservoir[:min(self.values_seen, self.reservoir_size)], self.fence_factor)
+
+        block_indices = np.flatnonzero((entropy_block < lower_fence) | (entropy_block > upper_fence))
+        first_index = self.values_pushed
+        self.values_pushed += np.size(entropy_block)
+
+        return first_index + block_indices, np.asarray(time_block)[block_indices]
+
+    # Algorithm R for a whole block at once: value number n (from 0) goes into a random slot below n + 1, and is only
+    # kept if that slot is inside the reservoir. The first reservoir_size values just fill it up.
+    def add_to_reservoir(self, values):
+
+        value_numbers = self.values_seen + np.arange(np.size(values))
+        self.values_seen += np.size(values)
+
+        filling = value_numbers < self.reservoir_size
+        self.reservoir[value_numbers[filling]] = values[filling]
+
+        slots = self.random_generator.integers(0, value_numbers[~filling] + 1) if np.any(~filling) else np.zeros(0, dtype=np.int64)
+        kept = slots < self.reservoir_size
+        self.reservoir[slots[kept]] = values[~filling][kept]
+
+# Generator front end, takes any iterable of sample blocks (a file reader, a socket reader, an acquisition callback
+# queue...) and yields the entropy values and their times block by block.
+def stream_rve(signal_blocks, frequency, τ_const = 1, epsilon_step = 4, samples_per_window = 5, allow_smoothening = False, size_of_window = 400):
+
+    streaming_rve = StreamingRVE(frequency, τ_const, epsilon_step, samples_per_window, allow_smoothening, size_of_window)
+
+    for block in signal_blocks:
+        entropy_arrays = streaming_rve.push(block)
+        yield entropy_arrays, streaming_rve.latest_times(np.size(entropy_arrays))
+
+# Reads a text signal file like Fourier_Filtering/signal.mat a bit at a time, yielding blocks of block_size samples
+# without ever holding the whole recording. source can be a file path or anything with a read(n) method, such as an
+# open file or socket.makefile(). Only the first row is read, so multi-channel files give their first channel.
+def read_signal_blocks(source, block_size = 512, read_size = 65536):
+
+    if isinstance(source, str):
+        with open(source, "r") as signal_file:
+            yield from read_signal_blocks(signal_file, block_size, read_size)
+        return
+
+    pending_values = []
+    leftover_text = ""
+    values_seen = False
+
+    while True:
+        text = source.read(read_size)
+        if isinstance(text, bytes):
+            text = text.decode()
+        end_of_row = not text
+
+        text = leftover_text + text
+        leftover_text = ""
+
+        # Stops at the end of the first row, but only once it has some values in it.
+        search_from = 0 if values_seen else len(text) - len(text.lstrip())
+        newline_at = text.find("\n", search_from)
+        if newline_at != -1:
+            text = text[:newline_at]
+            end_of_row = True
+        elif not end_of_row:
+            # The last number might be cut in half by the read, so hold it back until the next one.
+            cut_at = max(text.rfind(" "), text.rfind("\t"))
+            leftover_text = text[cut_at + 1:]
+            text = text[:cut_at + 1]
+
+        new_values = text.split()
+        values_seen = values_seen or len(new_values) > 0
+        pending_values.extend(float(value) for value in new_values)
+
+        while len(pending_values) >= block_size:
+            yield np.array(pending_values[:block_size])
+            del pending_values[:block_size]
+
+        if end_of_row:
+            break
+
+    if pending_values:
+        yield np.array(pending_values)
@@ -0,0 +1,125 @@
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Named timing spans for the pipeline stages (load, windowing, pattern_encoding, entropy_loop, composite_sum,
+# smoothing, plotting and the top level calls around them). Off by default, and while off span() hands back the same
+# do-nothing object every time so the cost is one global lookup per stage. Switch it on with
+#
+#   with RVE_trace.tracing("trace.json"):      everything inside is recorded, and written out as a trace at the end
+#       ...
+#
+# or by setting the RVE_TRACE environment variable: RVE_TRACE=1 just records, RVE_TRACE=some_file.json also writes the
+# trace when Python exits. The file is in the Chrome trace event format, so chrome://tracing or https://ui.perfetto.dev
+# can open it. summary() gives the totals per span name as a dict. Spans from process pool workers aren't collected.
+enabled = False
+recorded_spans = []
+
+# perf_counter has no fixed zero, so span times are kept relative to when this module was loaded.
+clock_origin = time.perf_counter()
+
+class Span:
+    def __init__(self, name, counters):
+
+        self.name = name
+        self.counters = counters
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception_details):
+
+        finish = time.perf_counter()
+        recorded_spans.append({"name": self.name, "start": self.start - clock_origin, "duration": finish - self.start,
+                               "pid": os.getpid(), "tid": threading.get_ident(), "counters": self.counters})
+
+    # Adds to one of the span's counters, e.g. span.count("samples", n).
+    def count(self, counter_name, amount = 1):
+
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+# What span() hands out while tracing is off.
+class DisabledSpan:
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exception_details):
+
+        return False
+
+    def count(self, counter_name, amount = 1):
+
+        pass
+
+DISABLED_SPAN = DisabledSpan()
+
+# with RVE_trace.span("entropy_loop", samples=n) as stage: ... times the block, extra counters go on with stage.count().
+def span(name, **counters):
+
+    if not enabled:
+        return DISABLED_SPAN
+
+    return Span(name, counters)
+
+# Turns tracing on for the with block (starting from an empty record) and writes the trace to output_path afterwards
+# if one is given. Hands back the list the spans are recorded into.
+@contextlib.contextmanager
+def tracing(output_path = None):
+
+    global enabled
+    was_enabled = enabled
+
+    reset()
+    enabled = True
+    try:
+        yield recorded_spans
+    finally:
+        enabled = was_enabled
+        if output_path is not None:
+            write_trace(output_path)
+
+def reset():
+
+    del recorded_spans[:]
+
+# Totals per span name: how many times it ran, the seconds spent in it and every counter added up.
+def summary(spans = None):
+
+    totals = {}
+    for recorded_span in (recorded_spans if spans is None else spans):
+        name_totals = totals.setdefault(recorded_span["name"], {"calls": 0, "seconds": 0.0, "counters": {}})
+        name_totals["calls"] += 1
+        name_totals["seconds"] += recorded_span["duration"]
+        for counter_name, amount in recorded_span["counters"].items():
+            name_totals["counters"][counter_name] = name_totals["counters"].get(counter_name, 0) + amount
+
+    return totals
+
+# Writes the spans as complete ("X") events in the Chrome trace event format, times in microseconds.
+def write_trace(output_path, spans = None):
+
+    trace_events = [{"name": recorded_span["name"], "ph": "X", "ts": recorded_span["start"] * 1e6, "dur": recorded_span["duration"] * 1e6,
+                     "pid": recorded_span["pid"], "tid": recorded_span["tid"], "args": recorded_span["counters"]}
+                    for recorded_span in list(recorded_spans if spans is None else spans)]
+
+    with open(output_path, "w") as trace_file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+def enable_from_environment():
+
+    global enabled
+    trace_setting = os.environ.get("RVE_TRACE", "")
+    if trace_setting in ("", "0"):
+        return
+
+    enabled = True
+    if trace_setting != "1":
+        atexit.register(write_trace, trace_setting)
+
+enable_from_environment()
@@ -1,8 +1,12 @@
-import RVE_function
+# RVE_cache, RVE_function, RVE_loader, RVE_pipeline, RVE_session and RVE_store (numba, scipy) and matplotlib.pyplot are only
+# imported where they are used, so the window can show up before they have loaded. warm_up_in_background loads them
+# straight after.
+import RVE_pyramid
+import RVE_trace
 
 import numpy as np
-import matplotlib.pyplot
 import sys
+import threading
 
 import time
 
@@ -33,13 +37,30 @@ class TheWidget(QtWidgets.QMainWindow):
         self.allow_smoothening = False
         self.show_differentiated_graph = False
 
+        # Results of earlier runs are kept on disk, so re-running the same file and parameters is just a load.
+        # Made on the first graph, see begin_graph.
+        self.result_cache = None
+
+        # The loaded signal and every stage of the last graph, so a parameter edit only redoes what it changes.
+        self.analysis_session = None
+
         # Inherits methods and properties from another class.
         super().__init__()
 
         # Defines a push button.
         self.button_start = QtWidgets.QPushButton("Start Graph")
         self.button_open = QtWidgets.QPushButton("Open")
+        self.button_open_results = QtWidgets.QPushButton("Open Results")
         self.button_parameters = QtWidgets.QPushButton("Edit Parameters")
+        self.button_cancel = QtWidgets.QPushButton("Cancel Graph")
+        self.button_cancel.setDisabled(True)
+
+        # Shows how many epsilon steps (or chunks) of the graph are done.
+        self.progress_bar = QtWidgets.QProgressBar()
+
+        # The background graph job, when one is running.
+        self.graph_thread = None
+        self.graph_worker = None
 
         # Defines a text box for file selected
         self.text_box = QtWidgets.QLabel("File Path: None")
@@ -62,6 +83,20 @@ class TheWidget(QtWidgets.QMainWindow):
         self.dynamic_axes_1 = self.dynamic_canvas_1.figure.subplots()
         self.dynamic_axes_2 = self.dynamic_canvas_2.figure.subplots()
 
+        # The lines are made once and only ever have their data swapped. Each keeps a min/max pyramid of its data and
+        # draws about as many points as the axes are pixels wide, picking the level to match when zooming or panning.
+        self.signal_line = RVE_pyramid.LevelOfDetailLine(self.dynamic_axes_1, 'b')
+        self.entropy_line_1 = RVE_pyramid.LevelOfDetailLine(self.dynamic_axes_1, 'r')
+        self.entropy_line_2 = RVE_pyramid.LevelOfDetailLine(self.dynamic_axes_2, 'r')
+        self.signal_max = 1
+
+        self.dynamic_axes_1.set_title('A graph of the signal and the entropy over time, with y axes adjusted to fit')
+        self.dynamic_axes_1.set_xlabel('Time (s)')
+        self.dynamic_axes_1.set_ylabel('Amplitude')
+        self.dynamic_axes_2.set_title('A graph of the entropy over time.')
+        self.dynamic_axes_2.set_xlabel('Time (s)')
+        self.dynamic_axes_2.set_ylabel('Amplitude')
+
         # Create a widget in layout to create a sub layout. This structures the layouts to be vertical in order.
         widget_sub = QtWidgets.QWidget()
         layout.addWidget(widget_sub)
@@ -70,99 +105,195 @@ class TheWidget(QtWidgets.QMainWindow):
         # Adds a push button
         layout_sub.addWidget(self.button_start)
         layout_sub.addWidget(self.button_open)
+        layout_sub.addWidget(self.button_open_results)
         layout_sub.addWidget(self.button_parameters)
+        layout_sub.addWidget(self.button_cancel)
 
         # Adds a text button
         layout.addWidget(self.text_box)
+        layout.addWidget(self.progress_bar)
 
         # When start button clicked, run a function
         self.button_start.clicked.connect(self.begin_graph)
         self.button_open.clicked.connect(self.select_file)
+        self.button_open_results.clicked.connect(self.open_results)
         self.button_parameters.clicked.connect(self.parameter_edit)
+        self.button_cancel.clicked.connect(self.cancel_graph)
 
         # Sets the central widget
         self.setCentralWidget(widget)
 
-    # This function runs main.
+    # This function runs main. The loading and number crunching happens on a worker thread (see GraphWorker) so the
+    # window stays responsive, and the canvases get redrawn as each epsilon step (or chunk) finishes.
     def begin_graph(self):
-        # Prepares all the data for input.
-        time_duration = self.duration
-        time_points = int(self.duration * self.frequency)
-        time_signal = np.linspace(0, time_duration, time_points)
-
-        signal = np.loadtxt(self.file_path[0])
 
-        # This will section the graph (If needed at all)
-        if self.allow_offset == True:
-            time_signal = time_signal[self.offset_start:self.offset_finish]
-            signal = signal[self.offset_start:self.offset_finish]
-
-        # This will take a composite of the graph.
-        if self.allow_composite == True:
-            entropy_arrays, entropy_time = RVE_function.rve_frequency_averager(time_signal, signal, self.frequency, self.frequency_crits_min, self.frequency_crits_max, self.frequency_crits_step, self.τ_const, self.samples_per_window)
-        else:
-            entropy_arrays, entropy_time = RVE_function.rve_of_singal(time_signal, signal, self.frequency, self.τ_const,
-                                                                      self.epsilon_step, self.samples_per_window)
-
-        # If certain conditions are met, this will further smoothen the graph.
-        if self.allow_smoothening == True:
-            entropy_arrays, entropy_time = RVE_function.entropy_window_averager(entropy_time, entropy_arrays)
+        # Only one graph at a time.
+        if self.graph_thread is not None:
+            return
+
+        if not self.file_path or not self.file_path[0]:
+            QtWidgets.QMessageBox.warning(self, "No file", "Open a signal file first.")
+            return
+
+        if self.result_cache is None:
+            import RVE_cache
+            self.result_cache = RVE_cache.RVEResultCache()
+        if self.analysis_session is None:
+            import RVE_session
+            self.analysis_session = RVE_session.AnalysisSession(self.result_cache)
+
+        self.graph_worker = GraphWorker(self)
+        self.graph_thread = QtCore.QThread()
+        self.graph_worker.moveToThread(self.graph_thread)
+
+        self.graph_thread.started.connect(self.graph_worker.run)
+        self.graph_worker.signal_loaded.connect(self.draw_signal)
+        self.graph_worker.progress.connect(self.show_progress)
+        self.graph_worker.partial_result.connect(self.draw_partial_entropy)
+        self.graph_worker.finished.connect(self.draw_results)
+        self.graph_worker.failed.connect(self.show_failure)
+        self.graph_worker.cancelled.connect(self.show_cancelled)
+        for worker_done in (self.graph_worker.finished, self.graph_worker.failed, self.graph_worker.cancelled):
+            worker_done.connect(self.graph_thread.quit)
+        self.graph_thread.finished.connect(self.graph_done)
+
+        self.button_start.setDisabled(True)
+        self.button_cancel.setDisabled(False)
+        self.progress_bar.setValue(0)
+        self.graph_thread.start()
+
+    # Asks the worker to stop after the step it is on.
+    def cancel_graph(self):
+        if self.graph_worker is not None:
+            self.graph_worker.cancel_requested = True
+            self.button_cancel.setDisabled(True)
+
+    def graph_done(self):
+        self.graph_thread.deleteLater()
+        self.graph_worker.deleteLater()
+        self.graph_thread = None
+        self.graph_worker = None
+        self.button_start.setDisabled(False)
+        self.button_cancel.setDisabled(True)
+
+    def show_progress(self, steps_done, total_steps):
+        self.progress_bar.setMaximum(max(total_steps, 1))
+        self.progress_bar.setValue(steps_done)
+
+    def show_failure(self, message):
+        QtWidgets.QMessageBox.warning(self, "Graph failed", message)
+
+    def show_cancelled(self):
+        self.progress_bar.setValue(0)
+
+    # Draws the signal as soon as it is loaded and empties the entropy lines for the partial results to fill in.
+    def draw_signal(self, time_signal, signal):
+
+        with RVE_trace.span("plotting", samples=np.size(signal)):
+            self.signal_max = np.max(signal)
+
+            self.signal_line.set_data(time_signal, signal)
+            self.entropy_line_1.set_data(time_signal[:0], signal[:0])
+            self.entropy_line_2.set_data(time_signal[:0], signal[:0])
+            for dynamic_axes in (self.dynamic_axes_1, self.dynamic_axes_2):
+                dynamic_axes.relim()
+                dynamic_axes.autoscale_view()
+                dynamic_axes.figure.canvas.draw_idle()
+
+    # Swaps the entropy lines over to the latest (partial or final) entropy.
+    def draw_partial_entropy(self, entropy_arrays, entropy_time):
+
+        with RVE_trace.span("plotting", samples=np.size(entropy_arrays)):
+            self.entropy_line_1.set_data(entropy_time, entropy_arrays*self.signal_max*3 - self.signal_max*2.5)
+            self.dynamic_axes_1.relim()
+            self.dynamic_axes_1.autoscale_view()
+            self.dynamic_axes_1.figure.canvas.draw_idle()
+
+            self.entropy_line_2.set_data(entropy_time, entropy_arrays)
+            self.dynamic_axes_2.relim()
+            self.dynamic_axes_2.autoscale_view()
+            self.dynamic_axes_2.figure.canvas.draw_idle()
+
+    # The finished (and if asked, smoothened) entropy, plus the extra figures for the differentiated graph.
+    def draw_results(self, graph_results):
+        import matplotlib.pyplot
+
+        self.draw_partial_entropy(graph_results["entropy_arrays"], graph_results["entropy_time"])
 
         # If certain conditions are met, generates an external figure that shows a differentiated graph.
-        if self.show_differentiated_graph == True:
-            diff_entropy_arrays, diff_entropy_time = RVE_function.entropy_differentiator(entropy_time, entropy_arrays)
-            matplotlib.pyplot.figure()
-            matplotlib.pyplot.plot(time_signal, signal, 'b')
-            matplotlib.pyplot.title("Signal over an amount of time.")
-            matplotlib.pyplot.ylabel("Amplitude of signal")
-            matplotlib.pyplot.xlabel("Time ($s$)")
-            matplotlib.pyplot.figure()
-            matplotlib.pyplot.plot(entropy_time, entropy_arrays, 'r')
-            matplotlib.pyplot.title("The entropy of a signal over time.")
-            matplotlib.pyplot.ylabel("Entropy of signal")
-            matplotlib.pyplot.xlabel("Time ($s$)")
-            matplotlib.pyplot.figure()
-            matplotlib.pyplot.plot(diff_entropy_time, diff_entropy_arrays, 'g')
-            matplotlib.pyplot.title("First order differential of the entropy over time.")
-            matplotlib.pyplot.ylabel("Entropy change of signal")
-            matplotlib.pyplot.xlabel("Time ($s$)")
-
-            # DEBUG SHTUFF: fft graph for showing how to get vals.
-            signal_fft = np.fft.fft(signal)
-            time_fft = np.fft.fftfreq(np.size(signal_fft), 1/self.frequency)
-            time_fft_shifted = np.fft.fftshift(time_fft)
-            matplotlib.pyplot.figure()
-            matplotlib.pyplot.plot(time_fft, signal_fft)
-            matplotlib.pyplot.title("Fast fourier transform of the brain signal")
-            matplotlib.pyplot.ylabel("Amplitude of the fast fourier")
-            matplotlib.pyplot.xlabel("Frequency ($hz$)")
+        if graph_results["diff_entropy_arrays"] is not None:
+            time_signal, signal = graph_results["time_signal"], graph_results["signal"]
+            entropy_arrays, entropy_time = graph_results["entropy_arrays"], graph_results["entropy_time"]
+            diff_entropy_arrays, diff_entropy_time = graph_results["diff_entropy_arrays"], graph_results["diff_entropy_time"]
+            with RVE_trace.span("plotting", samples=np.size(signal)):
+                matplotlib.pyplot.figure()
+                matplotlib.pyplot.plot(time_signal, signal, 'b')
+                matplotlib.pyplot.title("Signal over an amount of time.")
+                matplotlib.pyplot.ylabel("Amplitude of signal")
+                matplotlib.pyplot.xlabel("Time ($s$)")
+                matplotlib.pyplot.figure()
+                matplotlib.pyplot.plot(entropy_time, entropy_arrays, 'r')
+                matplotlib.pyplot.title("The entropy of a signal over time.")
+                matplotlib.pyplot.ylabel("Entropy of signal")
+                matplotlib.pyplot.xlabel("Time ($s$)")
+                matplotlib.pyplot.figure()
+                matplotlib.pyplot.plot(diff_entropy_time, diff_entropy_arrays, 'g')
+                matplotlib.pyplot.title("First order differential of the entropy over time.")
+                matplotlib.pyplot.ylabel("Entropy change of signal")
+                matplotlib.pyplot.xlabel("Time ($s$)")
+
+                # DEBUG SHTUFF: fft graph for showing how to get vals.
+                signal_fft = np.fft.fft(signal)
+                time_fft = np.fft.fftfreq(np.size(signal_fft), 1/graph_results["frequency"])
+                time_fft_shifted = np.fft.fftshift(time_fft)
+                matplotlib.pyplot.figure()
+                matplotlib.pyplot.plot(time_fft, signal_fft)
+                matplotlib.pyplot.title("Fast fourier transform of the brain signal")
+                matplotlib.pyplot.ylabel("Amplitude of the fast fourier")
+                matplotlib.pyplot.xlabel("Frequency ($hz$)")
             matplotlib.pyplot.show()
 
-        # This part will plot the data by clearing the canvas and replotting
-        self.dynamic_axes_1.figure.clf()
-        self.dynamic_axes_1 = self.dynamic_canvas_1.figure.subplots()
-        self.dynamic_axes_1.plot(time_signal, signal, 'b')
-        self.dynamic_axes_1.plot(entropy_time, entropy_arrays*np.max(signal)*3 - np.max(signal)*2.5, 'r')
-        self.dynamic_axes_1.set_title('A graph of the signal and the entropy over time, with y axes adjusted to fit')
-        self.dynamic_axes_1.set_xlabel('Time (s)')
-        self.dynamic_axes_1.set_ylabel('Amplitude')
-        self.dynamic_axes_1.figure.canvas.draw()
-
-        self.dynamic_axes_2.figure.clf()
-        self.dynamic_axes_2 = self.dynamic_canvas_2.figure.subplots()
-        self.dynamic_axes_2.plot(entropy_time, entropy_arrays, 'r')
-        self.dynamic_axes_2.set_title('A graph of the entropy over time.')
-        self.dynamic_axes_2.set_xlabel('Time (s)')
-        self.dynamic_axes_2.set_ylabel('Amplitude')
-        self.dynamic_axes_2.figure.canvas.draw()
-
-
-
     # This function will run a file explorer to select a file
     def select_file(self):
         self.file_path = QtWidgets.QFileDialog.getOpenFileName(self, "Open mat file", "", "Mat Files (*.mat)")
         self.text_box.setText(f"File Path: {self.file_path[0]}")
 
+    # Shows part of a results store saved by RVE_batch.py --store (or RVE_pipeline.run_pipeline_to_store). Asks for the
+    # range of time to show, ten minutes from the start to begin with, and only that range is read from the store. The
+    # first channel's entropy is drawn, there's no signal to draw with it.
+    def open_results(self):
+        import RVE_store
+
+        store_path = QtWidgets.QFileDialog.getExistingDirectory(self, "Open results store (.rvestore folder)")
+        if not store_path:
+            return
+
+        try:
+            results_store = RVE_store.open_store(store_path)
+            entropy_count = results_store.length("entropy_arrays")
+        except (OSError, ValueError) as error:
+            QtWidgets.QMessageBox.warning(self, "Can't open results", str(error))
+            return
+        if entropy_count == 0:
+            QtWidgets.QMessageBox.warning(self, "Can't open results", f"{store_path} has no entropy in it.")
+            return
+
+        first_time = float(results_store.times("entropy_arrays", 0, 1)[0])
+        last_time = float(results_store.times("entropy_arrays", -1)[0])
+        time_start, chosen = QtWidgets.QInputDialog.getDouble(self, "Results range", "From (s):", first_time, first_time, last_time, 3)
+        if not chosen:
+            return
+        time_finish, chosen = QtWidgets.QInputDialog.getDouble(self, "Results range", "To (s):", min(time_start + 600, last_time), time_start, last_time, 3)
+        if not chosen:
+            return
+
+        entropy_arrays, entropy_time = results_store.read_time_range("entropy_arrays", time_start, time_finish, channel=0)
+        self.text_box.setText(f"Results: {store_path} ({time_start:g} s to {time_finish:g} s)")
+
+        self.signal_max = 1
+        self.signal_line.set_data(entropy_time[:0], entropy_arrays[:0])
+        self.draw_partial_entropy(entropy_arrays, entropy_time)
+
     # This function will open a dialog box to edit some parameters.
     def parameter_edit(self):
 
@@ -393,8 +524,76 @@ class TheWidget(QtWidgets.QMainWindow):
         dialog_init = DialogWidget(self)
         dialog_init.exec_()
 
+# Does the loading, entropy, smoothing and differentiation for TheWidget on a worker thread. It takes a copy of the
+# settings when it is made, so editing the parameters while it runs doesn't change the graph being worked on.
+class GraphWorker(QtCore.QObject):
+
+    # time_signal, signal once the file is loaded.
+    signal_loaded = QtCore.Signal(object, object)
+    # Steps done, total steps.
+    progress = QtCore.Signal(int, int)
+    # entropy_arrays, entropy_time of the composite (or single step) so far.
+    partial_result = QtCore.Signal(object, object)
+    # Dictionary of everything draw_results needs.
+    finished = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+
+    def __init__(self, outer_widget):
+        # Inherits methods and properties from another class.
+        super().__init__()
+
+        import RVE_pipeline
+
+        self.file_path = outer_widget.file_path[0]
+        self.parameters = RVE_pipeline.RVEParameters(
+            frequency=outer_widget.frequency, duration=outer_widget.duration, τ_const=outer_widget.τ_const,
+            epsilon_step=outer_widget.epsilon_step, samples_per_window=outer_widget.samples_per_window,
+            offset_start=outer_widget.offset_start, offset_finish=outer_widget.offset_finish, allow_offset=outer_widget.allow_offset,
+            allow_composite=outer_widget.allow_composite, frequency_crits_min=outer_widget.frequency_crits_min,
+            frequency_crits_max=outer_widget.frequency_crits_max, frequency_crits_step=outer_widget.frequency_crits_step,
+            allow_smoothening=outer_widget.allow_smoothening, show_differentiated_graph=outer_widget.show_differentiated_graph)
+
+        self.analysis_session = outer_widget.analysis_session
+
+        # Set from the GUI thread, checked after every step.
+        self.cancel_requested = False
+
+    def run(self):
+        try:
+            self.work_out_graph()
+        except Exception as error:
+            self.failed.emit(str(error))
+
+    # The same steps as RVE_pipeline.run_pipeline, with the signals to the GUI in between. Goes through the analysis
+    # session, so whatever the last graph already worked out for these parameters is reused.
+    def work_out_graph(self):
+
+        # Parsed once, after that the binary sidecar copy is memory-mapped. Cut down to the offset if there is one.
+        time_signal, signal = self.analysis_session.load(self.file_path, self.parameters)
+
+        self.signal_loaded.emit(time_signal, signal)
+
+        # This will take a composite of the graph, one epsilon step at a time, otherwise one chunk at a time.
+        graph_steps = self.analysis_session.entropy_steps(self.parameters)
+
+        for steps_done, total_steps, entropy_arrays, entropy_time in graph_steps:
+            if self.cancel_requested:
+                graph_steps.close()
+                self.cancelled.emit()
+                return
+            self.progress.emit(steps_done, total_steps)
+            self.partial_result.emit(entropy_arrays, entropy_time)
+
+        # If certain conditions are met, this will further smoothen the graph and work out the differentiated one.
+        self.finished.emit(self.analysis_session.results(self.parameters))
+
 # Leftover debugging, probably will be removed later.
 def grapher():
+    import RVE_function
+    import RVE_loader
+    import matplotlib.pyplot
+
     # FREQUENCY
     frequency = 600
     # FOR THE WINDOW
@@ -410,8 +609,8 @@ def grapher():
 
     # Lets try loading in some noice data
     t_2 = np.linspace(0, tot_time, int(tot_time * frequency))
-    signal_noised_y = np.loadtxt("Brain_Scanning\data_1_actual.mat")
-    signal_noised_y = np.sum(signal_noised_y, axis=0)
+    signal_channels = RVE_loader.load_signal("Brain_Scanning\data_1_actual.mat")
+    signal_noised_y = np.sum(signal_channels, axis=0)
     amplitude = np.max(signal_noised_y)
 
     fft_signal = np.fft.fft(signal_noised_y)
@@ -423,18 +622,12 @@ def grapher():
     matplotlib.pyplot.xlabel("Frequency ($Hz$)")
     matplotlib.pyplot.show()
 
-    # entire_signal_entropied = np.zeros([np.size(signal_noised_y, axis=0), np.size(signal_noised_y, axis=1)])
-    # max_y_count = np.size(signal_noised_y, axis=0)
-    # max_x_count = np.size(signal_noised_y, axis=1)
-    # y_count = 0
-    # while y_count < max_y_count:
-    #     entropy_arrays, time_entropy = RVE_function.rve_of_singal(t_2, signal_noised_y[y_count, :], frequency, τ_const,
-    #                                                               epsilon_step, samples_per_window)
-    #     entire_signal_entropied[y_count, :] = entropy_arrays
+    # Entropy of each channel on its own, one row per channel.
+    entire_signal_entropied, time_entropy_channels = RVE_function.rve_of_channels(t_2, signal_channels, frequency, τ_const,
+                                                                                  epsilon_step, samples_per_window)
 
     entropy_arrays, time_entropy = RVE_function.rve_of_singal(t_2, signal_noised_y, frequency, τ_const, epsilon_step, samples_per_window)
-    entropy_averaged, time_entropy_averaged = RVE_function.entropy_window_averager(t_2, entropy_arrays)
-    diff_averaged, time_diff_averaged = RVE_function.entropy_differentiator(time_entropy_averaged, entropy_averaged)
+    entropy_averaged, time_entropy_averaged, diff_averaged, time_diff_averaged = RVE_function.entropy_smooth_and_differentiate(t_2, entropy_arrays)
 
     # EXPERIMENTATION
     # Lets do an experiment with a large amount of crit freqs this time. Lets say 5->40 crit freqs
@@ -468,6 +661,26 @@ def grapher():
     matplotlib.pyplot.xlabel("Time ($s$)")
     matplotlib.pyplot.show()
 
+# Loads the number crunching modules and compiles (or loads from numba's cache) the RVE kernels on a daemon thread, so
+# by the time Start Graph is pressed the first graph doesn't have to wait for them. A graph started before it's done
+# just waits for whatever is still loading.
+def warm_up_in_background():
+
+    def warm_up():
+        import RVE_cache
+        import RVE_function
+        import RVE_pipeline
+        import RVE_session
+        RVE_function.warm_up_kernels()
+
+    warm_up_thread = threading.Thread(target=warm_up, name="rve-warm-up", daemon=True)
+    warm_up_thread.start()
+
+    return warm_up_thread
+
+# Set to False to skip the warm up, the first graph then compiles whatever isn't in numba's cache yet.
+WARM_UP_AT_STARTUP = True
+
 if __name__ == "__main__":
 
     app = QtWidgets.QApplication([])
@@ -476,4 +689,7 @@ if __name__ == "__main__":
     widget.resize(1200, 800)
     widget.show()
 
+    if WARM_UP_AT_STARTUP:
+        warm_up_in_background()
+
     sys.exit(app.exec_())
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+import scipy.io
+
+import RVE_batch
+
+def write_recording(recording_path, seed = 0):
+
+    os.makedirs(os.path.dirname(recording_path), exist_ok=True)
+    scipy.io.savemat(recording_path, {"data": np.cumsum(np.random.default_rng(seed).standard_normal(3000))})
+
+# Same named recordings from different folders each get their own result.
+def test_same_names_in_different_folders_keep_their_own_results(tmp_path):
+
+    for seed, folder in enumerate(("r1", "r2")):
+        write_recording(str(tmp_path / folder / "one.mat"), seed)
+    parameter_path = tmp_path / "parameters.txt"
+    parameter_path.write_text("Freq = 1200\n")
+    output_folder = tmp_path / "out"
+
+    exit_code = RVE_batch.main([str(tmp_path / "r1"), str(tmp_path / "r2"), "--parameters", str(parameter_path),
+                                "--output", str(output_folder), "--workers", "1"])
+
+    assert exit_code == 0
+    first_result = np.load(output_folder / "r1" / "one.rve.npz")["entropy_arrays"]
+    second_result = np.load(output_folder / "r2" / "one.rve.npz")["entropy_arrays"]
+    assert not np.array_equal(first_result, second_result)
+
+def test_recordings_from_one_folder_keep_their_names(tmp_path):
+
+    recording_paths = [str(tmp_path / "a.mat"), str(tmp_path / "b.mat")]
+
+    output_paths = RVE_batch.output_paths_for("out", recording_paths)
+
+    assert output_paths == {recording_paths[0]: os.path.join("out", "a.rve.npz"), recording_paths[1]: os.path.join("out", "b.rve.npz")}
+
+def test_recordings_that_would_share_a_result_stop_the_batch(tmp_path):
+
+    with pytest.raises(ValueError):
+        RVE_batch.output_paths_for("out", [str(tmp_path / "one.mat"), str(tmp_path / "one.MAT")])
+
+def test_the_same_file_reached_two_ways_only_runs_once(tmp_path):
+
+    recording_path = str(tmp_path / "one.mat")
+    write_recording(recording_path)
+
+    assert len(RVE_batch.find_recordings([recording_path, os.path.join(str(tmp_path), ".", "one.mat")])) == 1
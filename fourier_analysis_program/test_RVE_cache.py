@@ -0,0 +1,27 @@
+import numpy as np
+
+import RVE_cache
+import RVE_function
+
+def random_walk(sample_count, seed = 0):
+
+    return np.cumsum(np.random.default_rng(seed).standard_normal(sample_count))
+
+# A step worked out in chunks mustn't be handed back for a run done in one go (or the other way round).
+def test_chunked_and_whole_runs_keep_their_own_results(tmp_path):
+
+    signal = random_walk(30000)
+    time_signal = np.arange(np.size(signal)) / 1200
+    result_cache = RVE_cache.RVEResultCache(str(tmp_path))
+
+    chunked_entropy, _ = result_cache.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5, chunk_size=4096)
+    whole_entropy, _ = result_cache.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5)
+
+    assert np.array_equal(chunked_entropy, RVE_function.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5, chunk_size=4096)[0])
+    assert np.array_equal(whole_entropy, RVE_function.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5)[0])
+
+# A chunk_size with room for every window is the same as none, so those runs do share.
+def test_chunk_size_past_the_end_is_the_same_key():
+
+    assert RVE_cache.key_chunk_size(30000, 4, 5, 65536) is None
+    assert RVE_cache.key_chunk_size(30000, 4, 5, 4096) == 4096
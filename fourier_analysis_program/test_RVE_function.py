@@ -0,0 +1,240 @@
+import ast
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import warnings
+import numpy as np
+import pytest
+
+import RVE_function
+import RVE_loader
+
+PROGRAM_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+SIGNAL_PATH = os.path.join(PROGRAM_FOLDER, "Fourier_Filtering", "signal.mat")
+
+# Modules that take a while to load, which the window shouldn't have to wait for.
+HEAVY_MODULES = ("scipy", "numba", "RVE_function", "RVE_cache", "RVE_loader", "RVE_pipeline", "RVE_session", "RVE_store")
+
+def random_walk(sample_count, seed = 0):
+
+    return np.cumsum(np.random.default_rng(seed).standard_normal(sample_count))
+
+# Every permutation, listed in itertools order, has to get its own position in that list as its bin number.
+@pytest.mark.parametrize("samples_per_window", range(2, 9))
+def test_pattern_codes_match_permutation_order(samples_per_window):
+
+    permutations = np.array(list(itertools.permutations(range(samples_per_window))))
+
+    pattern_codes = RVE_function.ordinal_pattern_codes(permutations)
+
+    assert np.array_equal(pattern_codes, np.arange(math.factorial(samples_per_window)))
+
+# The entropy loop as it was before the Lehmer codes: every window's argsort searched for in the permutation table, and
+# probabilities clamped to 1e-75.
+def table_search_rve(signal, frequency, τ_const, epsilon_step, samples_per_window):
+
+    window_span = (samples_per_window - 1) * epsilon_step + 1
+    signal_noised_window = np.lib.stride_tricks.sliding_window_view(signal, window_span)[:, ::epsilon_step]
+    signal_noised_window_indices = np.argsort(signal_noised_window, axis=1)
+    all_to_bin_list_sequential = np.array(list(itertools.permutations(range(samples_per_window), samples_per_window)))
+
+    histy_stuff = np.ones(math.factorial(samples_per_window))
+    alpha_filter = np.exp(-1 / (frequency * τ_const))
+    bin_numbers = np.zeros(np.size(signal_noised_window_indices, axis=0), dtype=np.int64)
+    entropy_arrays = np.zeros(np.size(signal_noised_window_indices, axis=0))
+    for i_x, ordering in enumerate(signal_noised_window_indices):
+        histy_stuff *= alpha_filter
+        bin_numbers[i_x] = np.where(np.all(all_to_bin_list_sequential == ordering, axis=1))[0][0]
+        histy_stuff[bin_numbers[i_x]] += 1
+        histy_stuff_normalised = histy_stuff / np.sum(histy_stuff)
+        histy_stuff_normalised = np.where(histy_stuff_normalised < 10 ** (-75), 10 ** (-75), histy_stuff_normalised)
+        entropy_arrays[i_x] = np.sum(-histy_stuff_normalised * np.log(histy_stuff_normalised)) / np.log(np.size(histy_stuff))
+
+    return bin_numbers, entropy_arrays
+
+def test_dense_engine_matches_table_search_on_signal_mat():
+
+    signal = np.asarray(RVE_loader.load_signal(SIGNAL_PATH, use_sidecar=False), dtype=np.float64)[:6000]
+    time_signal = np.arange(np.size(signal)) / 1200
+
+    bin_numbers, expected_entropy = table_search_rve(signal, 1200, 1, 4, 5)
+    entropy_arrays, _ = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5, engine="dense")
+
+    assert np.array_equal(RVE_function.rve_pattern_codes(signal, 4, 5), bin_numbers)
+    assert np.max(np.abs(entropy_arrays - expected_entropy)) <= 1e-12
+
+# Largest difference from float64 the README gives for each float32 stage.
+README_FLOAT32_BOUNDS = {"incremental": 7e-7, "sparse": 7e-7, "dense": 3e-6, "composite": 4e-7, "averages": 2e-7, "differences": 4e-10}
+
+# The whole of signal.mat with its time array at 1200 Hz, loaded once for every test that wants it.
+@pytest.fixture(scope="module")
+def signal_mat():
+
+    signal = np.asarray(RVE_loader.load_signal(SIGNAL_PATH, use_sidecar=False), dtype=np.float64)
+
+    return np.arange(np.size(signal)) / 1200, signal
+
+# The other engines only change the order things are added up in, so they have to land on the dense engine's answer.
+@pytest.mark.parametrize("engine", ["incremental", "sparse"])
+def test_engine_matches_dense_on_signal_mat(signal_mat, engine):
+
+    time_signal, signal = signal_mat
+
+    expected_entropy, _ = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5, engine="dense")
+    entropy_arrays, _ = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5, engine=engine)
+
+    assert np.shape(entropy_arrays) == np.shape(expected_entropy)
+    assert np.max(np.abs(entropy_arrays - expected_entropy)) <= 1e-10
+
+def test_lfilter_matches_incremental_on_signal_mat(signal_mat):
+
+    time_signal, signal = signal_mat
+
+    expected_entropy, _ = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5)
+    entropy_arrays, _ = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5, engine="lfilter")
+
+    assert np.shape(entropy_arrays) == np.shape(expected_entropy)
+    assert np.max(np.abs(entropy_arrays - expected_entropy)) <= 1e-10
+
+# Every parallel backend works each epsilon step out the same way and adds them up in the same order as the sequential
+# composite, so the answers are exactly the same.
+@pytest.mark.parametrize("parallel", ["thread", "process", "prange"])
+def test_parallel_composite_is_the_same_as_sequential(signal_mat, parallel):
+
+    time_signal, signal = signal_mat
+
+    expected_entropy, _ = RVE_function.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5)
+    entropy_arrays, _ = RVE_function.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5, parallel=parallel, workers=2)
+
+    assert np.array_equal(entropy_arrays, expected_entropy)
+
+# Working each distinct epsilon step out once and weighting it gives the composite of one pass per critical frequency
+# (only the order of the sum changes).
+def test_distinct_epsilon_steps_match_one_pass_per_frequency(signal_mat):
+
+    time_signal, signal = signal_mat
+    epsilon_step_crits = RVE_function.epsilon_steps_for_crits(1200, 5, 40, 1)
+
+    entropy_arrays_per_frequency = [RVE_function.rve_of_singal(time_signal, signal, 1200, 0.75, epsilon_step_i, 5)[0] for epsilon_step_i in epsilon_step_crits]
+    lowest_array_size = min(np.size(entropy_arrays_i) for entropy_arrays_i in entropy_arrays_per_frequency)
+    expected_entropy = sum(entropy_arrays_i[:lowest_array_size] for entropy_arrays_i in entropy_arrays_per_frequency) / np.size(epsilon_step_crits)
+    entropy_arrays, _ = RVE_function.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5)
+
+    assert np.size(RVE_function.distinct_epsilon_steps_with_counts(epsilon_step_crits)[0]) < np.size(epsilon_step_crits)
+    assert np.shape(entropy_arrays) == np.shape(expected_entropy)
+    assert np.max(np.abs(entropy_arrays - expected_entropy)) <= 1e-12
+
+def test_smooth_and_differentiate_matches_averager_then_differentiator(signal_mat):
+
+    time_signal, signal = signal_mat
+    entropy_arrays, time_entropy = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5)
+
+    expected_averaged, expected_time_averaged = RVE_function.entropy_window_averager(time_entropy, entropy_arrays, 400)
+    expected_diff, expected_time_diff = RVE_function.entropy_differentiator(expected_time_averaged, expected_averaged, 400, 1)
+    entropy_averaged, time_averaged, diff_averaged, time_diff = RVE_function.entropy_smooth_and_differentiate(time_entropy, entropy_arrays, 400, 1)
+
+    assert np.array_equal(time_averaged, expected_time_averaged) and np.array_equal(time_diff, expected_time_diff)
+    assert np.max(np.abs(entropy_averaged - expected_averaged)) <= 1e-12
+    assert np.max(np.abs(diff_averaged - expected_diff)) <= 1e-12
+
+@pytest.mark.parametrize("engine", ["incremental", "sparse", "dense"])
+def test_float32_engine_stays_within_readme_bound(signal_mat, engine):
+
+    time_signal, signal = signal_mat
+
+    expected_entropy, _ = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5, engine=engine)
+    entropy_arrays, _ = RVE_function.rve_of_singal(time_signal, signal, 1200, 1, 4, 5, engine=engine, dtype=np.float32)
+
+    assert entropy_arrays.dtype == np.float32
+    assert np.max(np.abs(entropy_arrays - expected_entropy)) <= README_FLOAT32_BOUNDS[engine]
+
+def test_float32_composite_and_smoothing_stay_within_readme_bounds(signal_mat):
+
+    time_signal, signal = signal_mat
+
+    expected_composite, _ = RVE_function.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5)
+    composite_entropy, _ = RVE_function.rve_frequency_averager(time_signal, signal, 1200, 5, 40, 1, 0.75, 5, dtype=np.float32)
+    expected_averaged, _, expected_diff, _ = RVE_function.entropy_smooth_and_differentiate(time_signal[:np.size(expected_composite)], expected_composite, 400, 1)
+    entropy_averaged, _, diff_averaged, _ = RVE_function.entropy_smooth_and_differentiate(time_signal[:np.size(expected_composite)], expected_composite, 400, 1, dtype=np.float32)
+
+    assert np.max(np.abs(composite_entropy - expected_composite)) <= README_FLOAT32_BOUNDS["composite"]
+    assert np.max(np.abs(entropy_averaged - expected_averaged)) <= README_FLOAT32_BOUNDS["averages"]
+    assert np.max(np.abs(diff_averaged - expected_diff)) <= README_FLOAT32_BOUNDS["differences"]
+
+# The warm-up halo has to keep every value within tolerance of the sequential answer, fτ = 60 gives short halos.
+@pytest.mark.parametrize("frequency, τ_const", [(60, 1), (1200, 0.75)])
+@pytest.mark.parametrize("tolerance", [1e-3, 1e-6, 1e-9])
+@pytest.mark.parametrize("segments", [2, 7])
+def test_parallel_in_time_stays_within_tolerance(frequency, τ_const, tolerance, segments):
+
+    signal = random_walk(60000)
+    time_signal = np.arange(np.size(signal)) / frequency
+
+    expected_entropy, _ = RVE_function.rve_of_singal(time_signal, signal, frequency, τ_const, 3, 5)
+    entropy_arrays, _ = RVE_function.rve_of_singal_parallel_in_time(time_signal, signal, frequency, τ_const, 3, 5,
+                                                                    tolerance=tolerance, segments=segments, workers=2)
+
+    assert np.shape(entropy_arrays) == np.shape(expected_entropy)
+    assert np.max(np.abs(entropy_arrays - expected_entropy)) <= tolerance
+
+def test_warm_up_halo_is_short_for_small_f_tau():
+
+    alpha_filter = np.exp(-1 / 60)
+
+    halo_lengths = [RVE_function.warm_up_halo_length(alpha_filter, 120, tolerance) for tolerance in (1e-3, 1e-6, 1e-9)]
+
+    assert halo_lengths == sorted(halo_lengths)
+    assert halo_lengths[-1] < 60000 // 7
+
+# Runs code in a fresh interpreter from the program folder (so nothing this test run already loaded or compiled counts)
+# and hands back whatever it printed as JSON.
+def run_fresh(code):
+
+    completed = subprocess.run([sys.executable, "-c", code], cwd=PROGRAM_FOLDER, capture_output=True, text=True, check=True)
+
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+# After warm_up_kernels every kernel a run needs straight away has been compiled, the dense and incremental loops for
+# both uint8 (samples_per_window = 5) and uint16 (= 8) bin numbers (sparse works on slot numbers, so one is enough).
+# Without numba it does nothing and there is nothing to compile.
+def test_warm_up_kernels_compiles_every_kernel():
+
+    signature_counts = run_fresh(
+        "import json, RVE_function\n"
+        "kernels = ('incremental_rve', 'optimised_rve', 'sparse_rve', 'smooth_differentiate_kernel')\n"
+        "before = [RVE_function.compiled_signature_count(getattr(RVE_function, kernel)) for kernel in kernels]\n"
+        "RVE_function.warm_up_kernels()\n"
+        "after = [RVE_function.compiled_signature_count(getattr(RVE_function, kernel)) for kernel in kernels]\n"
+        "print(json.dumps({'numba': RVE_function.numba_available, 'before': before, 'after': after}))")
+
+    assert signature_counts["before"] == [0, 0, 0, 0]
+    if signature_counts["numba"]:
+        assert signature_counts["after"][:2] == [2, 2]
+        assert min(signature_counts["after"]) >= 1
+    else:
+        assert signature_counts["after"] == [0, 0, 0, 0]
+
+# main.py only imports light modules at the top, and those don't pull in any of the heavy ones either.
+def test_main_defers_heavy_imports():
+
+    # main.py's example paths use backslashes, which parsing warns about.
+    with open(os.path.join(PROGRAM_FOLDER, "main.py"), encoding="utf-8") as main_file, warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        main_tree = ast.parse(main_file.read())
+    top_level_modules = set()
+    for node in main_tree.body:
+        if isinstance(node, ast.Import):
+            top_level_modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            top_level_modules.add(node.module.split(".")[0])
+
+    assert not top_level_modules & set(HEAVY_MODULES)
+
+    local_modules = sorted(module for module in top_level_modules if os.path.exists(os.path.join(PROGRAM_FOLDER, f"{module}.py")))
+    loaded_modules = run_fresh(f"import json, sys\nimport {', '.join(local_modules)}\nprint(json.dumps(sorted(sys.modules)))")
+
+    assert not set(loaded_modules) & set(HEAVY_MODULES)
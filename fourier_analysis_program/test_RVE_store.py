@@ -0,0 +1,18 @@
+import numpy as np
+
+import RVE_store
+
+# Appending a little at a time only keeps the chunk being written open, and everything reads back as it went in.
+def test_full_chunks_are_let_go_of_once_written(tmp_path):
+
+    values = np.random.default_rng(0).standard_normal((2, 10000))
+    results_store = RVE_store.create_store(str(tmp_path / "store"), 1200, channel_count=2, chunk_size=256)
+
+    for block_start in range(0, 10000, 100):
+        results_store.append("entropy_arrays", values[:, block_start:block_start + 100])
+        assert len(results_store.open_chunks) <= 2
+    results_store.close()
+
+    with RVE_store.open_store(str(tmp_path / "store")) as reopened_store:
+        assert np.array_equal(reopened_store.read("entropy_arrays"), values)
+        assert np.array_equal(reopened_store.read("entropy_arrays", 250, 1030, channel=1), values[1, 250:1030])